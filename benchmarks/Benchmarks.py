@@ -0,0 +1,709 @@
+'''
+Benchmarks for the Timeline engine. Kept outside server_code so they are not deployed with the app.
+Timings only; the equivalence checks of the same paths run fast in tests/test_timeline.py.
+Run locally from the app root: python -m benchmarks.Benchmarks
+Stage suite against the stored baselines only: python -m benchmarks.Benchmarks suite [--update-baselines]
+'''
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+from server_code.Timeline import (calculate_portfolio, build_loan, build_events, schedule_to_columns, LoanSchedule,
+                       partition_events_by_loan, aggregate_events, add_generated_dates, calculate_balances, balance_report,
+                       ScheduleIndex, BalanceSnapshots, AccrualSegments, portfolio_totals, scenario_delta)
+from server_code.EventBatch import EventBatch, calculate_batch
+from server_code.FxRates import FxRateIndex
+from server_code.ParallelPortfolio import calculate_portfolio_columns
+from server_code.ChartData import CHART_TARGET_POINTS, loan_chart_payload, portfolio_chart_payload
+from server_code.ScheduleExport import iter_schedule_rows, iter_csv_chunks, export_schedule_rows
+from server_code.EventImport import IMPORT_BATCH_SIZE, parse_records, import_records
+from server_code.EventStream import interest_rate_event, lending_event, repayment_event, fetch_event_streams, FETCH_CONCURRENCY
+
+
+# Local rates (pair,date,rate) for FX lookups without the fx_rates table
+FX_FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fixtures', 'fx_rates.csv')
+# Stored stage ratios of run_stage_suite(); refresh with: python -m benchmarks.Benchmarks suite --update-baselines
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+# Pipeline stages timed by run_stage_suite(), in pipeline order
+PIPELINE_STAGES = ('parse', 'aggregate', 'calendar', 'accrual', 'balance_report')
+# Suite sizes: loans -> events per loan
+SUITE_SIZES = {1: 500, 100: 200, 10000: 40}
+# Stage timings are stored as multiples of calibration_seconds() measured in the same run, so baselines
+# recorded on one machine hold on another. A stage regresses when its ratio exceeds the baseline ratio
+# by this factor and the excess is more than REGRESSION_MIN_SECONDS at this machine's speed.
+REGRESSION_FACTOR = 1.25
+REGRESSION_MIN_SECONDS = 0.005
+# Decimal operations per calibration run, and the best of how many runs is taken
+CALIBRATION_OPERATIONS = 200000
+CALIBRATION_REPEATS = 5
+# Loan and event currencies of synthetic_portfolio
+SYNTHETIC_CURRENCIES = ('USD', 'EUR', 'GBP')
+
+
+def synthetic_portfolio(loans_count: int,
+                        events_per_loan: int,
+                        seed: int = 1,
+                        foreign_currency_share: float = 0.2) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    '''
+    Reproducible loans (in the loans table shape) and raw events (in the Timeline engine input shape).
+    Loans mix interest_rate_base, counting and capitalization flags. Every loan starts with a lending
+    and an interest rate, followed by lendings, repayments and rate changes spread over roughly ten years;
+    foreign_currency_share of the amounts are in another currency with a manually entered rate.
+    '''
+    rnd = random.Random(seed)
+    loans_raw: List[Dict[str, Any]] = []
+    events_raw: List[Dict[str, Any]] = []
+    event_id = 0
+    def currency_keys(base_currency: str) -> Dict[str, Any]:
+        if rnd.random() >= foreign_currency_share:
+            return {}
+        currency = rnd.choice([ticker for ticker in SYNTHETIC_CURRENCIES if ticker != base_currency])
+        return {"currency": currency, "currency_to_loan_rate": round(rnd.uniform(0.5, 1.5), 4)}
+    for loan_number in range(loans_count):
+        loan_id = f"synthetic-{seed}-{loan_number + 1}"
+        base_currency = rnd.choice(SYNTHETIC_CURRENCIES)
+        start_date = date(2015, 1, 1) + timedelta(days=rnd.randrange(365))
+        loans_raw.append({
+            'loan_id': loan_id,
+            'credentials': f"Synthetic loan {loan_number + 1}",
+            'base_currency': base_currency,
+            'interest_rate_base': rnd.choice(['360', '365', 'calendar']),
+            'lending_date_exclusive_counting': rnd.random() < 0.5,
+            'repayment_date_exclusive_counting': rnd.random() < 0.5,
+            'capitalization': rnd.random() < 0.5,
+            'created_on': datetime(2024, 1, 1) + timedelta(minutes=loan_number),
+            'contract_start_date': start_date,
+        })
+        event_id += 1
+        events_raw.append({"event_id": event_id, "event_fact_date": start_date,
+                           "principal_lending_currency": rnd.randrange(10000, 500000), "loan_id": loan_id})
+        event_id += 1
+        events_raw.append({"event_id": event_id, "event_fact_date": start_date,
+                           "interest_rate": round(rnd.uniform(0.02, 0.15), 4), "loan_id": loan_id})
+        for _ in range(events_per_loan - 2):
+            event_id += 1
+            event = {"event_id": event_id,
+                     "event_fact_date": start_date + timedelta(days=rnd.randrange(1, 3650)),
+                     "loan_id": loan_id}
+            kind = rnd.random()
+            if kind < 0.3:
+                event["principal_lending_currency"] = rnd.randrange(100, 5000)
+                event.update(currency_keys(base_currency))
+            elif kind < 0.6:
+                event["principal_repayment_currency"] = rnd.randrange(100, 5000)
+                event.update(currency_keys(base_currency))
+            elif kind < 0.9:
+                event["interest_repayment_currency"] = rnd.randrange(10, 500)
+                event.update(currency_keys(base_currency))
+            else:
+                event["interest_rate"] = round(rnd.uniform(0.02, 0.15), 4)
+            events_raw.append(event)
+    return loans_raw, events_raw
+
+def benchmark_portfolio(loans_count: int = 1000,
+                        events_per_loan: int = 500,
+                        backend: str = 'decimal') -> Dict[str, float]:
+    """Time a full portfolio run of the Timeline engine ('numpy' is the cross-check backend, expected to be slower)."""
+    loans_raw, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+    started = time.perf_counter()
+    schedules = calculate_portfolio(loans_raw, events_raw, backend)
+    elapsed = time.perf_counter() - started
+    rows = sum(len(schedule) for schedule in schedules.values())
+    result = {
+        'loans': loans_count,
+        'events': len(events_raw),
+        'timeline_rows': rows,
+        'seconds': elapsed,
+        'ms_per_loan': elapsed * 1000 / loans_count,
+    }
+    print(f"[{backend}] {loans_count} loans x {events_per_loan} events: {elapsed:.2f}s "
+          f"({result['ms_per_loan']:.2f} ms/loan, {rows} timeline rows)")
+    return result
+
+def benchmark_incremental(events_count: int = 3000, years: int = 40) -> Dict[str, float]:
+    '''
+    Full rebuild vs incremental recalculation of a long-lived loan.
+    A repayment inserted near the end should only recompute the last few rows.
+    '''
+    rnd = random.Random(7)
+    loan = build_loan({'loan_id': 1, 'base_currency': 'USD', 'interest_rate_base': 'calendar', 'capitalization': True})
+    start_date = date(1990, 1, 1)
+    events_raw = [{"event_id": 0, "event_fact_date": start_date, "principal_lending_currency": 1000000, "loan_id": 1},
+                  {"event_id": -1, "event_fact_date": start_date, "interest_rate": 0.05, "loan_id": 1}]
+    events_raw += [{"event_id": i + 1, "event_fact_date": start_date + timedelta(days=rnd.randrange(1, years * 365)),
+                    "principal_repayment_currency": rnd.randrange(10, 200), "loan_id": 1} for i in range(events_count)]
+    last_date = max(event["event_fact_date"] for event in events_raw)
+
+    started = time.perf_counter()
+    schedule = LoanSchedule(loan, events_raw)
+    full_seconds = time.perf_counter() - started
+    result = {'rows': len(schedule.rows), 'full_seconds': full_seconds}
+    for new_event_id, (label, days_back) in enumerate((('tail_1_month', 20), ('tail_1_year', 365), ('tail_10_years', 3650)),
+                                                      start=events_count + 1):
+        started = time.perf_counter()
+        new_event_raw = {"event_id": new_event_id, "event_fact_date": last_date - timedelta(days=days_back),
+                         "principal_repayment_currency": 100, "loan_id": 1}
+        schedule.insert_event(new_event_raw)
+        result[f'{label}_seconds'] = time.perf_counter() - started
+        result[f'{label}_rows'] = schedule.recalculated_rows
+    print(f"Incremental, {result['rows']} rows: full rebuild {full_seconds * 1000:.1f} ms; " +
+          ", ".join(f"{label} {result[f'{label}_seconds'] * 1000:.1f} ms ({result[f'{label}_rows']} rows)"
+                    for label in ('tail_1_month', 'tail_1_year', 'tail_10_years')))
+    return result
+
+def synthetic_import_csv(loans_count: int = 100, events_per_loan: int = 500, invalid_share: float = 0.01) -> str:
+    """CSV in the EventImport format built from synthetic_portfolio, with a share of deliberately broken rows."""
+    rnd = random.Random(3)
+    _, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+    columns = ('event_type', 'loan_id', 'date', 'event_id', 'value', 'currency_sum',
+               'principal_currency_allocation', 'interest_currency_allocation', 'currency_ticker', 'currency_to_loan_rate')
+    output = io.StringIO()
+    writer = csv.DictWriter(output, columns)
+    writer.writeheader()
+    for event in events_raw:
+        row = {'loan_id': event['loan_id'], 'date': event['event_fact_date'].isoformat(),
+               'event_id': event['event_id'], 'currency_ticker': event.get('currency', '').lower(),
+               'currency_to_loan_rate': event.get('currency_to_loan_rate', '')}
+        if 'interest_rate' in event:
+            row.update(event_type='Interest rate', value=event['interest_rate'])
+        elif 'principal_lending_currency' in event:
+            row.update(event_type='Lending', currency_sum=event['principal_lending_currency'])
+        else:
+            row.update(event_type='Repayment',
+                       principal_currency_allocation=event.get('principal_repayment_currency', ''),
+                       interest_currency_allocation=event.get('interest_repayment_currency', ''))
+        if rnd.random() < invalid_share:
+            row['date'] = '2020-13-45'
+        writer.writerow(row)
+    return output.getvalue()
+
+def benchmark_event_import(loans_count: int = 100,
+                           events_per_loan: int = 500,
+                           batch_size: int = IMPORT_BATCH_SIZE) -> Dict[str, float]:
+    '''
+    Rows/second of the bulk event import pipeline (parse, validate, resolve loans, batch).
+    Table writes are replaced by an in-memory sink, so this measures the import path itself;
+    on Anvil add the cost of one add_rows transaction per batch.
+    '''
+    content = synthetic_import_csv(loans_count, events_per_loan)
+    loans = {loan_raw['loan_id']: object() for loan_raw in synthetic_portfolio(loans_count, 0)[0]}
+    resolve_calls = []
+    written = []
+    def resolve_loans(loan_ids):
+        resolve_calls.append(len(loan_ids))
+        return {loan_id: loans[loan_id] for loan_id in loan_ids if loan_id in loans}
+    started = time.perf_counter()
+    import_result = import_records(parse_records(content, 'csv'), resolve_loans,
+                                   lambda event_type, events: written.append(len(events)), batch_size)
+    elapsed = time.perf_counter() - started
+    result = {
+        'rows': import_result.rows_total,
+        'rows_imported': import_result.rows_imported,
+        'errors': len(import_result.errors),
+        'batches': len(written),
+        'seconds': elapsed,
+        'rows_per_second': import_result.rows_total / elapsed,
+    }
+    print(f"Event import, {result['rows']} rows ({result['errors']} rejected, {result['batches']} batches): "
+          f"{elapsed:.2f}s, {result['rows_per_second']:.0f} rows/s")
+    return result
+
+def benchmark_fx_fill(events_count: int = 20000, fixture_path: str = FX_FIXTURE_PATH) -> Dict[str, float]:
+    '''
+    Build foreign currency events without currency_to_loan_rate, filling rates from the fixture FxRateIndex.
+    '''
+    rnd = random.Random(5)
+    fx_rates = FxRateIndex.from_csv(fixture_path)
+    loan = build_loan({'loan_id': 1, 'base_currency': 'USD', 'interest_rate_base': 365})
+    events_raw = [{"event_id": i, "event_fact_date": date(2022, 1, 3) + timedelta(days=rnd.randrange(4 * 365 - 3)),
+                   "principal_lending_currency": rnd.randrange(100, 5000), "currency": rnd.choice(('EUR', 'GBP', 'JPY')),
+                   "loan_id": 1} for i in range(events_count)]
+    started = time.perf_counter()
+    events = build_events(loan, events_raw, fx_rates)
+    elapsed = time.perf_counter() - started
+    cache_info = fx_rates.cache_info()
+    result = {'events': events_count, 'seconds': elapsed, 'cache_hits': cache_info.hits, 'cache_misses': cache_info.misses}
+    print(f"FX fill, {events_count} events: {elapsed * 1000:.0f} ms "
+          f"({cache_info.misses} index lookups, {cache_info.hits} cache hits)")
+    return result
+
+def benchmark_row_memory(timeline_rows: int = 1000000, events_per_loan: int = 500) -> Dict[str, float]:
+    '''
+    Memory held by portfolio schedules (AggregatedEvent rows) measured with tracemalloc.
+    Loans are added until the portfolio has about timeline_rows rows (~570 rows per loan at 500 events).
+    '''
+    loans_count = max(1, round(timeline_rows / (events_per_loan * 1.15)))
+    loans_raw, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+    tracemalloc.start()
+    started = time.perf_counter()
+    schedules = calculate_portfolio(loans_raw, events_raw)
+    elapsed = time.perf_counter() - started
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = sum(len(schedule) for schedule in schedules.values())
+    result = {'rows': rows, 'bytes_per_row': retained / rows, 'peak_bytes_per_row': peak / rows, 'seconds': elapsed}
+    print(f"Row memory, {rows} timeline rows: {result['bytes_per_row']:.0f} bytes/row retained, "
+          f"{result['peak_bytes_per_row']:.0f} bytes/row peak ({elapsed:.1f}s traced)")
+    return result
+
+def benchmark_event_batch(loans_count: int = 1000, events_per_loan: int = 500) -> Dict[str, float]:
+    """Time the columnar pipeline on the benchmark_portfolio workload, parse and aggregate+accrual separately."""
+    loans_raw, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+    started = time.perf_counter()
+    batch = EventBatch.from_raw(loans_raw, events_raw)
+    parsed = time.perf_counter()
+    schedule_batch = calculate_batch(batch)
+    finished = time.perf_counter()
+    result = {
+        'loans': loans_count,
+        'events': len(events_raw),
+        'timeline_rows': len(schedule_batch),
+        'parse_seconds': parsed - started,
+        'calculate_seconds': finished - parsed,
+        'seconds': finished - started,
+        'ms_per_loan': (finished - started) * 1000 / loans_count,
+    }
+    print(f"[columnar] {loans_count} loans x {events_per_loan} events: {result['seconds']:.2f}s "
+          f"(parse {result['parse_seconds']:.2f}s, aggregate+accrual {result['calculate_seconds']:.2f}s, "
+          f"{result['ms_per_loan']:.2f} ms/loan, {result['timeline_rows']} timeline rows)")
+    return result
+
+def benchmark_parallel(loans_count: int = 1000,
+                       events_per_loan: int = 200,
+                       workers_counts: Tuple[int, ...] = (1, 2, 4, 8)) -> Dict[int, float]:
+    '''
+    Seconds per worker count for the process-pool portfolio path (1 = serial).
+    Speedup is bounded by the CPUs available.
+    '''
+    loans_raw, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+    seconds: Dict[int, float] = {}
+    for workers in workers_counts:
+        started = time.perf_counter()
+        calculate_portfolio_columns(loans_raw, events_raw, workers)
+        seconds[workers] = time.perf_counter() - started
+    print(f"Parallel, {loans_count} loans x {events_per_loan} events on {os.cpu_count()} CPUs: " +
+          ", ".join(f"{workers} workers {seconds[workers]:.2f}s (x{seconds[workers_counts[0]] / seconds[workers]:.2f})"
+                    for workers in workers_counts))
+    return seconds
+
+def synthetic_event_tables(loans_count: int = 100, events_per_loan: int = 60) -> Dict[str, List[Dict[str, Any]]]:
+    """synthetic_portfolio events as interest_rates / principal_lendings / repayments rows (plain dicts), ordered by date."""
+    _, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+    tables: Dict[str, List[Dict[str, Any]]] = {'interest_rates': [], 'principal_lendings': [], 'repayments': []}
+    for event in sorted(events_raw, key=lambda event: event["event_fact_date"]):
+        row = {'event_id': event["event_id"], 'date': event["event_fact_date"], 'loan_id': event["loan_id"],
+               'currency_ticker': event.get("currency"), 'currency_to_loan_rate': event.get("currency_to_loan_rate")}
+        if "interest_rate" in event:
+            tables['interest_rates'].append({**row, 'value': event["interest_rate"]})
+        elif "principal_lending_currency" in event:
+            tables['principal_lendings'].append({**row, 'currency_sum': event["principal_lending_currency"]})
+        else:
+            tables['repayments'].append({**row, 'principal_currency_allocation': event.get("principal_repayment_currency"),
+                                         'interest_currency_allocation': event.get("interest_repayment_currency")})
+    return tables
+
+def benchmark_concurrent_fetch(latency: float = 0.05,
+                               concurrency_levels: Tuple[int, ...] = (1, 2, 3),
+                               repeats: int = 5) -> Dict[int, float]:
+    '''
+    Event fetch with the three table reads one after another vs in a thread pool, against a local
+    stand-in whose every table query waits `latency` seconds (like a data tables round trip).
+    '''
+    tables = synthetic_event_tables()
+    def reader(table_name, to_event):
+        def read():
+            time.sleep(latency)
+            return [to_event(item, item['loan_id']) for item in tables[table_name]]
+        return read
+    readers = [reader('interest_rates', interest_rate_event),
+               reader('principal_lendings', lending_event),
+               reader('repayments', repayment_event)]
+    events_count = 0
+    seconds: Dict[int, float] = {}
+    for concurrency in concurrency_levels:
+        started = time.perf_counter()
+        for _ in range(repeats):
+            events_count = len(fetch_event_streams(readers, concurrency))
+        seconds[concurrency] = (time.perf_counter() - started) / repeats
+    print(f"Event fetch, 3 tables x {latency * 1000:.0f} ms latency, {events_count} events: " +
+          ", ".join(f"concurrency {concurrency} {seconds[concurrency] * 1000:.0f} ms" for concurrency in concurrency_levels))
+    return seconds
+
+class LocalRoundTrips:
+    """Counts the data tables round trips of a local stand-in, each waiting `latency` seconds."""
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            self.count += 1
+        time.sleep(self.latency)
+
+class LocalLinkedRow:
+    """Linked loan row of a LocalEventTable row: get_id() is free, reading a column costs a round trip the first time."""
+    def __init__(self, row_id: str, columns: Dict[str, Any], round_trips: LocalRoundTrips):
+        self._row_id = row_id
+        self._columns = columns
+        self._round_trips = round_trips
+        self._fetched = False
+
+    def get_id(self) -> str:
+        return self._row_id
+
+    def __getitem__(self, key: str) -> Any:
+        if not self._fetched:
+            self._round_trips.wait()
+            self._fetched = True
+        return self._columns[key]
+
+class LocalEventTable:
+    """Event table stand-in: every search is one round trip and returns rows linking their loan by row id."""
+    def __init__(self, rows: List[Dict[str, Any]], round_trips: LocalRoundTrips):
+        self._rows = rows
+        self._round_trips = round_trips
+
+    def search(self, loan_row_ids: Optional[set] = None) -> List[Dict[str, Any]]:
+        self._round_trips.wait()
+        return [{**{key: value for key, value in row.items() if key != 'loan_id'},
+                 'loan': LocalLinkedRow(f"loan-{row['loan_id']}", {'loan_id': row['loan_id']}, self._round_trips)}
+                for row in self._rows if loan_row_ids is None or f"loan-{row['loan_id']}" in loan_row_ids]
+
+def benchmark_event_fetch_latency(latency: float = 0.005, loans_count: int = 10, events_per_loan: int = 30) -> Dict[str, float]:
+    '''
+    Per-loan event fetch latency of the previous loader and of CalcCore.fetch_events_raw, against local table stand-ins
+    whose every query and first read of a linked loan row is a round trip of `latency` seconds.
+    before: three searches per loan, full row copies, and the linked loan read per row for its loan_id.
+    after: one projected search per table for the loans, run concurrently, loan_id resolved from the linked row id.
+    '''
+    round_trips = LocalRoundTrips(latency)
+    table_rows = synthetic_event_tables(loans_count, events_per_loan)
+    tables = {name: LocalEventTable(rows, round_trips) for name, rows in table_rows.items()}
+    loan_ids = {f"loan-{row['loan_id']}": row['loan_id'] for rows in table_rows.values() for row in rows}
+    def fetch_before(loan_row_id: str) -> List[Dict[str, Any]]:
+        return [{**item, "event_type": event_type, "loan_id": item['loan']['loan_id']}
+                for table_name, event_type in (('interest_rates', "Interest rate"), ('principal_lendings', "Lending"),
+                                               ('repayments', "Repayment"))
+                for item in tables[table_name].search({loan_row_id})]
+    def fetch_after(loan_row_ids: set) -> List[Dict[str, Any]]:
+        def reader(table_name, to_event):
+            def read():
+                events = [to_event(item, loan_ids[item['loan'].get_id()]) for item in tables[table_name].search(loan_row_ids)]
+                return [event for event in events if event is not None]
+            return read
+        return fetch_event_streams([reader('interest_rates', interest_rate_event), reader('principal_lendings', lending_event),
+                                    reader('repayments', repayment_event)], FETCH_CONCURRENCY)
+    result: Dict[str, float] = {'latency_ms': latency * 1000, 'loans': loans_count, 'events_per_loan': events_per_loan}
+    for name, fetch in (('before', lambda: [fetch_before(loan_row_id) for loan_row_id in loan_ids]),
+                        ('after', lambda: [fetch_after({loan_row_id}) for loan_row_id in loan_ids]),
+                        ('after_batched', lambda: fetch_after(set(loan_ids)))):
+        round_trips.count = 0
+        started = time.perf_counter()
+        fetch()
+        result[f'{name}_ms_per_loan'] = (time.perf_counter() - started) * 1000 / loans_count
+        result[f'{name}_round_trips_per_loan'] = round_trips.count / loans_count
+    print(f"Event fetch per loan at {latency * 1000:.0f} ms per round trip: "
+          f"before {result['before_ms_per_loan']:.1f} ms ({result['before_round_trips_per_loan']:.1f} round trips), "
+          f"after {result['after_ms_per_loan']:.1f} ms ({result['after_round_trips_per_loan']:.1f}), "
+          f"after, {loans_count} loans in one fetch {result['after_batched_ms_per_loan']:.1f} ms "
+          f"({result['after_batched_round_trips_per_loan']:.1f})")
+    return result
+
+def check_event_fetch(baselines_path: str = BASELINES_PATH, update_baselines: bool = False) -> List[str]:
+    """benchmark_event_fetch_latency() against the stored figures: round trips per loan must not grow."""
+    result = benchmark_event_fetch_latency()
+    baseline = load_baselines(baselines_path).get('event_fetch')
+    regressions = []
+    if baseline is not None:
+        for name in ('after', 'after_batched'):
+            if result[f'{name}_round_trips_per_loan'] > baseline[f'{name}_round_trips_per_loan']:
+                regressions.append(f"event fetch, {name}: {result[f'{name}_round_trips_per_loan']:.1f} round trips per loan "
+                                   f"vs baseline {baseline[f'{name}_round_trips_per_loan']:.1f}")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if update_baselines:
+        store_baselines({'event_fetch': result}, baselines_path)
+    return regressions
+
+def benchmark_portfolio_totals(loans_count: int = 1000, events_per_loan: int = 200, report_dates_count: int = 24) -> Dict[str, float]:
+    '''
+    Portfolio totals on many dates from stored BalanceSnapshots vs recomputing every schedule and indexing it.
+    '''
+    loans_raw, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+    report_dates = [date(2016, 1, 15) + timedelta(days=120 * i) for i in range(report_dates_count)]
+    started = time.perf_counter()
+    columns = [schedule_to_columns(schedule) for schedule in calculate_portfolio(loans_raw, events_raw).values()]
+    indexes = [ScheduleIndex(loan_columns) for loan_columns in columns]
+    for report_date in report_dates:
+        sum(index.as_of(report_date)['principal'] for index in indexes)
+    recompute_seconds = time.perf_counter() - started
+    snapshots = [BalanceSnapshots.from_simple_object(BalanceSnapshots.from_columns(loan_columns).to_simple_object())
+                 for loan_columns in columns]
+    started = time.perf_counter()
+    for report_date in report_dates:
+        portfolio_totals(snapshots, report_date)
+    snapshot_seconds = time.perf_counter() - started
+    result = {'loans': loans_count, 'report_dates': report_dates_count,
+              'recompute_seconds': recompute_seconds, 'snapshot_seconds': snapshot_seconds}
+    print(f"Portfolio totals, {loans_count} loans x {report_dates_count} dates: snapshots {snapshot_seconds * 1000:.1f} ms "
+          f"vs {recompute_seconds:.2f}s to recompute schedules")
+    return result
+
+def benchmark_export(loans_counts: Tuple[int, ...] = (100, 1000), events_per_loan: int = 100,
+                     export_format: str = 'csv') -> Dict[int, Dict[str, float]]:
+    '''
+    Streaming schedule export into a temporary file: traced peak memory (excluding the raw inputs),
+    time to the first CSV chunk and total time. Peak memory should not grow with the number of loans.
+    '''
+    results: Dict[int, Dict[str, float]] = {}
+    for loans_count in loans_counts:
+        loans_raw, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+        started = time.perf_counter()
+        next(iter_csv_chunks(iter_schedule_rows(loans_raw, events_raw), chunk_rows=100))
+        first_chunk_seconds = time.perf_counter() - started
+        tracemalloc.start()
+        started = time.perf_counter()
+        with tempfile.TemporaryFile() as file:
+            export_schedule_rows(iter_schedule_rows(loans_raw, events_raw), export_format, file)
+            size = file.tell()
+        seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[loans_count] = {'bytes': size, 'peak_bytes': peak, 'first_chunk_seconds': first_chunk_seconds, 'seconds': seconds}
+        print(f"Export {export_format}, {loans_count} loans: {size / 1e6:.1f} MB file, peak {peak / 1e6:.2f} MB traced, "
+              f"first chunk after {first_chunk_seconds * 1000:.0f} ms, total {seconds:.2f}s")
+    return results
+
+def benchmark_chart_payload(loans_count: int = 1000, events_per_loan: int = 40, long_loan_events: int = 2000,
+                            target_points: int = CHART_TARGET_POINTS) -> Dict[str, Dict[str, float]]:
+    '''
+    JSON size of downsampled chart payloads vs every point, for one long loan and for the portfolio.
+    '''
+    results: Dict[str, Dict[str, float]] = {}
+    long_loans_raw, long_events_raw = synthetic_portfolio(1, long_loan_events, seed=2)
+    long_columns = [schedule_to_columns(schedule) for schedule in calculate_portfolio(long_loans_raw, long_events_raw).values()]
+    loans_raw, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+    columns_list = [schedule_to_columns(schedule) for schedule in calculate_portfolio(loans_raw, events_raw).values()]
+    for name, build in (('loan', lambda points: loan_chart_payload(long_columns[0], points)),
+                        ('portfolio', lambda points: portfolio_chart_payload(columns_list, points))):
+        started = time.perf_counter()
+        payload = build(target_points)
+        seconds = time.perf_counter() - started
+        full_payload = build(payload['source_points'])
+        repayment_dates = set(payload['repayments']['x'])
+        size, full_size = len(json.dumps(payload)), len(json.dumps(full_payload))
+        points = len(payload['series']['principal_balance']['x'])
+        results[name] = {'source_points': payload['source_points'], 'points': points,
+                         'bytes': size, 'full_bytes': full_size, 'seconds': seconds}
+        print(f"Chart payload, {name}: {payload['source_points']} -> {points} points, {full_size / 1000:.0f} kB -> "
+              f"{size / 1000:.0f} kB JSON, {len(repayment_dates)} repayment markers, built in {seconds * 1000:.0f} ms")
+    return results
+
+def benchmark_accrual_intervals(loans_count: int = 100, events_per_loan: int = 200, queries_per_loan: int = 1000) -> Dict[str, float]:
+    '''
+    Accrued interest over random [from, to) intervals from AccrualSegments vs recomputing the schedule.
+    '''
+    rnd = random.Random(1)
+    loans_raw, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+    started = time.perf_counter()
+    schedules = calculate_portfolio(loans_raw, events_raw)
+    recompute_seconds = (time.perf_counter() - started) / loans_count
+    columns_list = [schedule_to_columns(schedule) for schedule in schedules.values()]
+    segments_list = [AccrualSegments.from_columns(columns) for columns in columns_list]
+    intervals = []
+    for _ in range(queries_per_loan):
+        from_date = date(2015, 1, 1) + timedelta(days=rnd.randrange(4000))
+        intervals.append((from_date, from_date + timedelta(days=rnd.randrange(1, 62))))
+    started = time.perf_counter()
+    for segments in segments_list:
+        for from_date, to_date in intervals:
+            segments.accrued(from_date, to_date)
+    query_seconds = (time.perf_counter() - started) / (loans_count * queries_per_loan)
+    segments_count = sum(len(segments.ordinals) for segments in segments_list)
+    rows_count = sum(len(columns['event_start_date']) for columns in columns_list)
+    result = {'query_seconds': query_seconds, 'recompute_seconds': recompute_seconds,
+              'segments': segments_count, 'rows': rows_count}
+    print(f"Accrual intervals: {query_seconds * 1e6:.1f} µs per query vs {recompute_seconds * 1000:.0f} ms to recompute a schedule; "
+          f"{segments_count} segments for {rows_count} rows")
+    return result
+
+def benchmark_scenarios(events_count: int = 2000, scenarios_count: int = 24) -> Dict[str, float]:
+    '''
+    What-if repayments and rate changes on forks of one baseline LoanSchedule vs rebuilding the schedule per question.
+    '''
+    rnd = random.Random(5)
+    loans_raw, events_raw = synthetic_portfolio(1, events_count, seed=3)
+    loan = build_loan(loans_raw[0])
+    baseline = LoanSchedule(loan, events_raw)
+    last_date = max(event_raw['event_fact_date'] for event_raw in events_raw)
+    questions = []
+    for i in range(scenarios_count):
+        event_raw = {'event_id': 10 ** 9 + i, 'loan_id': loan.loan_id,
+                     'event_fact_date': last_date - timedelta(days=rnd.randrange(1, 730))}
+        if i % 2:
+            event_raw['interest_rate'] = 0.13
+        else:
+            event_raw['principal_repayment_currency'] = 50000
+        questions.append(event_raw)
+    started = time.perf_counter()
+    reports = []
+    for event_raw in questions:
+        scenario = baseline.fork()
+        scenario.apply_changes([event_raw])
+        reports.append(scenario_delta(baseline, scenario))
+    fork_seconds = (time.perf_counter() - started) / scenarios_count
+    started = time.perf_counter()
+    for event_raw in questions:
+        LoanSchedule(loan, events_raw + [event_raw])
+    rebuild_seconds = (time.perf_counter() - started) / scenarios_count
+    shared_share = sum(report['shared_rows'] for report in reports) / (len(baseline.rows) * scenarios_count)
+    result = {'rows': len(baseline.rows), 'fork_seconds': fork_seconds, 'rebuild_seconds': rebuild_seconds,
+              'shared_share': shared_share}
+    print(f"Scenarios, {len(baseline.rows)} rows: fork + delta report {fork_seconds * 1000:.1f} ms vs rebuild "
+          f"{rebuild_seconds * 1000:.1f} ms per question; {shared_share:.0%} of rows shared with the baseline")
+    return result
+
+def benchmark_stages(loans_count: int, events_per_loan: int, report_dates_per_loan: int = 12) -> Dict[str, float]:
+    '''
+    Seconds spent in each Timeline pipeline stage over a synthetic portfolio:
+    parse (build_events), aggregate (aggregate_events), calendar (add_generated_dates / generate_date_list),
+    accrual (sorting + calculate_balances) and balance_report (report_dates_per_loan dates per loan).
+    '''
+    loans_raw, events_raw = synthetic_portfolio(loans_count, events_per_loan)
+    events_by_loan = partition_events_by_loan(events_raw)
+    timings = dict.fromkeys(PIPELINE_STAGES, 0.0)
+    rows = 0
+    clock = time.perf_counter
+    for loan_raw in loans_raw:
+        loan = build_loan(loan_raw)
+        started = clock()
+        events = build_events(loan, events_by_loan[loan.loan_id])
+        parsed = clock()
+        aggregated_events = aggregate_events(loan, events)
+        aggregated = clock()
+        capitalization_dates = add_generated_dates(loan, aggregated_events)
+        generated = clock()
+        schedule = sorted(aggregated_events.values(), key=lambda event: event.event_start_date)
+        calculate_balances(loan, schedule, capitalization_dates)
+        accrued = clock()
+        first_date = schedule[0].event_start_date
+        span_days = (schedule[-1].event_start_date - first_date).days
+        for i in range(report_dates_per_loan):
+            report_date = first_date + timedelta(days=span_days * (i + 1) // report_dates_per_loan)
+            balance_report(schedule, report_date.strftime("%Y-%m-%d"))
+        reported = clock()
+        timings['parse'] += parsed - started
+        timings['aggregate'] += aggregated - parsed
+        timings['calendar'] += generated - aggregated
+        timings['accrual'] += accrued - generated
+        timings['balance_report'] += reported - accrued
+        rows += len(schedule)
+    timings['total'] = sum(timings[stage] for stage in PIPELINE_STAGES)
+    timings['events'] = len(events_raw)
+    timings['timeline_rows'] = rows
+    return timings
+
+def calibration_seconds(operations: int = CALIBRATION_OPERATIONS, repeats: int = CALIBRATION_REPEATS) -> float:
+    """Best-of-repeats seconds of a fixed Decimal accrual loop, the unit stage timings are stored in."""
+    rate, base = Decimal('0.0525'), Decimal('365')
+    best = float('inf')
+    for _ in range(repeats):
+        started = time.perf_counter()
+        balance, interest = Decimal('1000000.00'), Decimal(0)
+        for i in range(operations):
+            interest += (balance * rate / base).quantize(Decimal('0.000001'))
+            if i % 30 == 29:
+                balance -= Decimal('100.00')
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def load_baselines(path: str = BASELINES_PATH) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def store_baselines(sections: Dict[str, Any], path: str = BASELINES_PATH) -> None:
+    """Replace the given top-level sections of the baselines file, keeping the others."""
+    baselines = {**load_baselines(path), **sections}
+    with open(path, 'w') as file:
+        json.dump(baselines, file, indent=2, sort_keys=True)
+        file.write('\n')
+    print(f"Baselines stored in {os.path.normpath(path)}")
+
+def run_stage_suite(sizes: Dict[int, int] = SUITE_SIZES,
+                    baselines_path: str = BASELINES_PATH,
+                    update_baselines: bool = False) -> List[str]:
+    '''
+    benchmark_stages() for every suite size, as multiples of calibration_seconds(), compared with the stored baselines.
+    Returns the regressions found (empty if none or no baseline); update_baselines stores this run instead.
+    '''
+    baselines = load_baselines(baselines_path)
+    if baselines.get('unit') != 'calibration_seconds':
+        # Older baselines in raw seconds only hold on the machine that recorded them
+        baselines = {}
+    results: Dict[str, Dict[str, float]] = {}
+    regressions: List[str] = []
+    for loans_count, events_per_loan in sizes.items():
+        size = str(loans_count)
+        # Calibrated on both sides of the run, as a shared machine's speed drifts over a long suite
+        before = calibration_seconds()
+        timings = benchmark_stages(loans_count, events_per_loan)
+        calibration = min(before, calibration_seconds())
+        ratios = {stage: timings[stage] / calibration for stage in PIPELINE_STAGES + ('total',)}
+        results[size] = {'events_per_loan': events_per_loan, 'events': timings['events'],
+                         'timeline_rows': timings['timeline_rows'], **ratios}
+        baseline = baselines.get('sizes', {}).get(size)
+        print(f"{loans_count} loans x {events_per_loan} events ({timings['timeline_rows']} rows, calibration {calibration:.3f}s): " +
+              ", ".join(f"{stage} {timings[stage]:.3f}s ({ratios[stage]:.2f}x)" for stage in PIPELINE_STAGES + ('total',)))
+        if baseline is None or baseline.get('events_per_loan') != events_per_loan:
+            continue
+        for stage in PIPELINE_STAGES + ('total',):
+            if (ratios[stage] > baseline[stage] * REGRESSION_FACTOR
+                    and (ratios[stage] - baseline[stage]) * calibration > REGRESSION_MIN_SECONDS):
+                regressions.append(f"{loans_count} loans, {stage}: {ratios[stage]:.2f}x vs baseline {baseline[stage]:.2f}x calibration")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if update_baselines:
+        store_baselines({'unit': 'calibration_seconds', 'sizes': results}, baselines_path)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Timeline engine benchmarks")
+    parser.add_argument('target', nargs='?', choices=('all', 'suite'), default='all',
+                        help="'suite': per-stage timings against the stored baselines only")
+    parser.add_argument('--update-baselines', action='store_true', help="store this run as the new baselines")
+    args = parser.parse_args()
+    regressions = []
+    if args.target == 'all':
+        for backend in ('decimal', 'numpy'):
+            benchmark_portfolio(backend=backend)
+        benchmark_event_batch()
+        benchmark_parallel()
+        benchmark_incremental()
+        benchmark_event_import()
+        benchmark_concurrent_fetch()
+        benchmark_portfolio_totals()
+        benchmark_export()
+        benchmark_export(loans_counts=(100,), export_format='xlsx')
+        benchmark_chart_payload()
+        benchmark_accrual_intervals()
+        benchmark_scenarios()
+        benchmark_fx_fill()
+        benchmark_row_memory()
+        regressions += check_event_fetch(update_baselines=args.update_baselines)
+    regressions += run_stage_suite(update_baselines=args.update_baselines)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,29 @@
+'''
+Sample input data of 20250209_sandbox_timeline.py (section 2) for engine checks and benchmarks.
+Kept with the benchmarks, outside server_code, so it is not deployed with the app.
+'''
+
+loans_list_raw = [
+    {'loan_id':101, 
+    'base_currency': 'USD',
+    'interest_rate_base': 'calendar',
+    'lending_date_exclusive_counting': False,
+    'repayment_date_exclusive_counting': True,
+    'capitalization': True
+    }
+]
+
+events_list_raw = [
+    {"event_id": 1, "event_fact_date": "2024-02-01", "principal_lending_currency": 300, "loan_id": 101},
+    {"event_id": 2, "event_fact_date": "2024-01-03", "principal_lending_currency": 400, "loan_id": 101},
+    {"event_id": 3, "event_fact_date": "2025-02-18", "principal_lending_currency": 140, "currency": "EUR", "loan_id": 101, "currency_to_loan_rate": 1.15},
+    {"event_id": 4, "event_fact_date": "2024-01-03", "principal_lending_currency": 333, "currency": "EUR", "loan_id": 101, "currency_to_loan_rate": 1.2},
+    {"event_id": 5, "event_fact_date": "2023-02-01", "principal_lending_currency": 3366, "loan_id": 101},
+    {"event_id": 6, "event_fact_date": "2024-01-04", "principal_repayment_currency": 21302, "currency": "USD", "loan_id": 101},
+    {"event_id": 7, "event_fact_date": "2023-02-01", "interest_rate": 0.06, "loan_id": 101},
+    {"event_id": 8, "event_fact_date": "2023-07-22", "principal_lending_currency": 43200, "currency": "USD", "loan_id": 101},
+    {"event_id": 9, "event_fact_date": "2024-03-14", "principal_repayment_currency": 10302, "currency": "USD", "loan_id": 101},
+    {"event_id": 10, "event_fact_date": "2024-01-15", "interest_repayment_currency": 130, "currency": "EUR", "loan_id": 101, "currency_to_loan_rate": 1.1},
+    {"event_id": 11, "event_fact_date": "2024-11-03", "interest_repayment_currency": 180, "currency": "USD", "loan_id": 101},
+    {"event_id": 7, "event_fact_date": "2024-07-05", "interest_rate": 0.13, "loan_id": 101},
+]
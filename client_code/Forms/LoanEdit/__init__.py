@@ -8,6 +8,7 @@ import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables
 import anvil.users
+from .. import get_reference_data
 
 class LoanEdit(LoanEditTemplate):
   def __init__(self, **properties):
@@ -19,11 +20,12 @@ class LoanEdit(LoanEditTemplate):
     self.dynamic_radio_button.group = self.interest_rate_type_radio_group_panel
     if self.item.get('interest_rate_type'):
       self.interest_rate_type_radio_group_panel.selected_value = self.item['interest_rate_type']
-    # fetch form values
-    self.lender_dropdown.items = anvil.server.call('fetch_companies_dropdown')
-    self.borrower_dropdown.items = anvil.server.call('fetch_companies_dropdown')
-    self.interest_rate_base_dropdown.items = anvil.server.call('get_interest_rate_bases')
-    self.base_currency_ticker_dropdown.items = anvil.server.call('get_currency_ticker')
+    # fetch form values (session cache, no round trip unless the reference data changed)
+    reference_data = get_reference_data()
+    self.lender_dropdown.items = reference_data['companies']
+    self.borrower_dropdown.items = reference_data['companies']
+    self.interest_rate_base_dropdown.items = reference_data['interest_rate_bases']
+    self.base_currency_ticker_dropdown.items = reference_data['currency_tickers']
     # populate foem values
   
       
@@ -16,3 +16,20 @@ from anvil.tables import app_tables
 
 def say_hello():
   print("Hello, world")
+
+
+# Reference data of Forms.LoanEdit (companies, interest rate bases, currency tickers),
+# fetched once and reused by every dialog open until the server reports another version.
+_reference_data = None
+
+def get_reference_data():
+  global _reference_data
+  if _reference_data is None:
+    _reference_data = anvil.server.call('fetch_reference_data')
+  return _reference_data
+
+def check_reference_data_version(version):
+  """Drop the cached reference data if the server reports a different version."""
+  global _reference_data
+  if _reference_data is not None and _reference_data['version'] != version:
+    _reference_data = None
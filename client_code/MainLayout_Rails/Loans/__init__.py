@@ -1,6 +1,7 @@
 from ._anvil_designer import LoansTemplate
 from anvil import *
 import anvil.server
+import anvil.media
 import anvil.google.auth, anvil.google.drive
 from anvil.google.drive import app_files
 import anvil.facebook.auth
@@ -9,6 +10,7 @@ import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables
 from ...Forms.LoanEdit import LoanEdit
+from ...Forms import check_reference_data_version
 
 class Loans(LoansTemplate):
   def __init__(self, **properties):
@@ -19,25 +21,97 @@ class Loans(LoansTemplate):
     self.refresh_loans_list()
     self.loans_repeating_panel.set_event_handler('x-delete-loan', self.delete_loan)
     self.loans_repeating_panel.set_event_handler('x-edit-loan', self.edit_loan)
-    #anvil.server.call('calc_fetch_loan_events')
-    anvil.server.call('loans_list')
+    # Stale schedules are recalculated in a background task (None if no task was started); the timer polls its progress
+    self.recalculation_task = anvil.server.call('launch_portfolio_recalculation')
+    if self.recalculation_task is not None:
+      self.recalculation_timer.interval = 2
     
+  def recalculation_timer_tick(self, **event_args):
+    """This method is called Every [interval] seconds. Does not trigger if [interval] is 0."""
+    if not self.recalculation_task.is_running():
+      self.recalculation_timer.interval = 0
+      self.recalculation_status_text.text = self.recalculation_outcome()
+      return
+    state = self.recalculation_task.get_state()
+    if state.get('total'):
+      eta = f", about {state['eta_seconds']:.0f}s left" if state.get('eta_seconds') is not None else ""
+      self.recalculation_status_text.text = f"Recalculating schedules: {state['done']} / {state['total']}{eta}"
+    
+  def recalculation_outcome(self):
+    """Status text of a finished recalculation; empty if it completed without errors."""
+    state = self.recalculation_task.get_state()
+    if self.recalculation_task.get_termination_status() != 'completed' or state.get('status') == 'failed':
+      return "Schedule recalculation failed, schedules are recalculated when opened"
+    if state.get('status') == 'completed_with_errors':
+      return f"Schedules of {state['failed']} loans could not be recalculated"
+    return ""
+
+  def export_button_click(self, **event_args):
+    """This method is called when the component is clicked."""
+    # The export runs as a background task; the timer downloads the file once it is stored
+    self.export_task = anvil.server.call('launch_schedule_export', 'csv')
+    self.export_button.enabled = False
+    self.export_button.text = "Preparing export..."
+    self.export_timer.interval = 2
+
+  def export_timer_tick(self, **event_args):
+    """This method is called Every [interval] seconds. Does not trigger if [interval] is 0."""
+    if self.export_task.is_running():
+      return
+    self.export_timer.interval = 0
+    self.export_button.enabled = True
+    self.export_button.text = "Export schedules"
+    if self.export_task.get_termination_status() != 'completed':
+      alert("Schedule export failed, please try again")
+      return
+    anvil.media.download(anvil.server.call('fetch_schedule_export', self.export_task.get_state()['export_id']))
+
   def edit_loan(self, loan, **event_args):
+    loan = loan['loan']
     loan_copy = dict(loan)
     save_clicked = alert(content = LoanEdit(item = loan_copy),
          title = "View and edit contract details",
          large = True,
          buttons = [("Save", True), ("Cancel", False)])
     if save_clicked:
-      anvil.server.call('update_loan', loan, loan_copy)
-      self.refresh_loans_list()
+      self.patch_loans_list(anvil.server.call('update_loan', loan, loan_copy))
     
   def delete_loan(self, loan, **event_args):
-    anvil.server.call('delete_loan', loan)
-    self.refresh_loans_list()
+    # Remove the card right away; put the list back if the server refuses
+    items = self.loans_repeating_panel.items
+    self.loans_repeating_panel.items = [item for item in items if item['loan_id'] != loan['loan_id']]
+    try:
+      tombstone = anvil.server.call('delete_loan', loan['loan'])
+    except Exception:
+      self.loans_repeating_panel.items = items
+      raise
+    self.patch_loans_list(tombstone)
+
+  def patch_loans_list(self, changed_item):
+    """Apply an item or tombstone returned by add_loan/update_loan/delete_loan without reloading the list."""
+    items = self.loans_repeating_panel.items
+    loan_ids = [item['loan_id'] for item in items]
+    if changed_item.get('deleted'):
+      items = [item for item in items if item['loan_id'] != changed_item['loan_id']]
+    elif changed_item['loan_id'] in loan_ids:
+      items = [changed_item if item['loan_id'] == changed_item['loan_id'] else item for item in items]
+    else:
+      items = [changed_item] + items
+    self.loans_repeating_panel.items = items
     
   def refresh_loans_list(self, **event_args):
-    self.loans_repeating_panel.items = anvil.server.call('fetch_loans_info')
+    page = anvil.server.call('fetch_loans_page')
+    check_reference_data_version(page['reference_data_version'])
+    self.loans_repeating_panel.items = page['items']
+    self.next_page_token = page['next_page_token']
+    self.load_more_button.visible = self.next_page_token is not None
+
+  def load_more_button_click(self, **event_args):
+    """This method is called when the component is clicked."""
+    page = anvil.server.call('fetch_loans_page', self.next_page_token)
+    self.loans_repeating_panel.items = self.loans_repeating_panel.items + page['items']
+    self.next_page_token = page['next_page_token']
+    self.load_more_button.visible = self.next_page_token is not None
     
   def add_loan_button_click(self, **event_args):
     """This method is called when the component is clicked."""
@@ -48,5 +122,4 @@ class Loans(LoansTemplate):
          title = 'Loan edit',
          buttons = [("Save", True, "elevated"), ("Cancel", False)])
     if save_cliked:
-      anvil.server.call('add_loan', new_loan)
-      self.refresh_loans_list()
+      self.patch_loans_list(anvil.server.call('add_loan', new_loan))
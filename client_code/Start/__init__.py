@@ -15,8 +15,11 @@ class Start(StartTemplate):
     # Set Form properties and Data Bindings.
     self.init_components(**properties)
     anvil.users.login_with_form()
-    self.repeating_panel_1.items = anvil.server.call('fetch_subscriptions')
-    self.repeating_panel_2.items = anvil.server.call('fetch_user_info')
+    session_bootstrap = anvil.server.call('fetch_session_bootstrap')
+    self.repeating_panel_1.items = session_bootstrap['subscriptions']
+    self.repeating_panel_2.items = [session_bootstrap['user']]
+    counts = session_bootstrap['counts']
+    self.counts_text.text = f"{counts['loans_count']} loans, {counts['companies_count']} companies"
 
     # Any code you write here will run before the form opens.
   def subscriptionSubmit_btn_click(self, **event_args):
@@ -0,0 +1,47 @@
+import anvil.google.auth, anvil.google.drive, anvil.google.mail
+from anvil.google.drive import app_files
+import anvil.facebook.auth
+import anvil.users
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+from .EventImport import IMPORT_BATCH_SIZE, parse_records, import_records
+from .ServerModule1 import EVENT_TABLES
+from .ScheduleStore import invalidate_loan_schedule
+
+# Bulk event import: validation lives in EventImport, this module only touches the tables.
+# Loans are resolved with one query for the whole file; every batch is written in its own transaction,
+# so a failing batch only rejects its own rows.
+
+
+def _resolve_loans(loan_ids):
+  if not loan_ids:
+    return {}
+  loans = app_tables.loans.search(q.fetch_only('loan_id'), loan_id=q.any_of(*loan_ids))
+  return {loan['loan_id']: loan for loan in loans}
+
+def _write_batch(event_type, events):
+  with tables.Transaction():
+    EVENT_TABLES[event_type].add_rows(events)
+
+@anvil.server.callable
+def import_loan_events(content, import_format=None, batch_size=IMPORT_BATCH_SIZE):
+  '''
+  Import lendings, repayments and interest rate changes from CSV/JSON text or an uploaded file (Media).
+  import_format defaults to the file extension ('csv' if unknown).
+  Returns rows_total, rows_imported, per-row errors and the loan_ids that received events.
+  '''
+  if not isinstance(content, str):
+    if import_format is None and content.name and content.name.lower().endswith('.json'):
+      import_format = 'json'
+    content = content.get_bytes().decode('utf-8-sig')
+  records = parse_records(content, import_format or 'csv')
+  loans = {}
+  def resolve_loans(loan_ids):
+    loans.update(_resolve_loans(loan_ids))
+    return loans
+  result = import_records(records, resolve_loans, _write_batch, batch_size)
+  for loan_id in result.loan_ids:
+    invalidate_loan_schedule(loans[loan_id])
+  return result.as_dict()
@@ -6,120 +6,224 @@ import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables
 import anvil.server
-from datetime import datetime, timedelta
-from uuid import uuid4
+import anvil.media
+from datetime import datetime
+import os
+import tempfile
+from contextlib import contextmanager
 # Additional import
-from dataclasses import dataclass, field, asdict
-from typing import Optional, List, Dict, Union, Literal
-from collections import defaultdict
-from decimal import Decimal, getcontext, localcontext
-import pandas as pd
-
+from .Timeline import build_loan, calculate_portfolio, schedule_to_columns
+from .EventStream import (INTEREST_RATE_COLUMNS, LENDING_COLUMNS, REPAYMENT_COLUMNS,
+                          interest_rate_event, lending_event, repayment_event, fetch_event_streams, FETCH_CONCURRENCY)
+from .FxRateStore import fx_rate_index
+from .ParallelPortfolio import calculate_portfolio_columns
+from .EventBatch import calculate_portfolio_batch
+from .ScheduleExport import EXPORT_CONTENT_TYPES, iter_schedule_rows, export_schedule_rows
+from .Instrumentation import INSTRUMENTATION, Instrumentation, stage, count, configure
+
+
+LOAN_INFO_KEYS = ['loan_id', 'base_currency', 'interest_rate_base', 'lending_date_exclusive_counting',
+                  'repayment_date_exclusive_counting', 'capitalization']
+# Loans whose events are fetched together while exporting schedules
+EXPORT_LOANS_CHUNK_SIZE = 50
+# Finished or running exports kept per user (schedule_exports), oldest deleted first
+SCHEDULE_EXPORTS_KEPT = 3
+
+def _loan_ids_by_row_id(loans):
+  """Resolve loan_id of each loan row once; event rows are matched by their linked row id."""
+  return {loan.get_id(): loan['loan_id'] for loan in loans}
+
+def fetch_events_raw(loans=None, concurrency=FETCH_CONCURRENCY):
+  '''
+  Raw events of the given loan rows (all loans if None), merged and ordered by date.
+  One query per event table for all loans (no loan filter for all loans), fetching only the columns the engine uses;
+  the three queries run in up to `concurrency` threads (1: one after another).
+  Rows without a date or amount are skipped and counted as events_skipped.
+  '''
+  all_loans = loans is None
+  if all_loans:
+    loans = app_tables.loans.search(q.fetch_only('loan_id'))
+  loans = list(loans)
+  if not loans:
+    return []
+  loan_ids = _loan_ids_by_row_id(loans)
+  loan_filter = {} if all_loans else {'loan': q.any_of(*loans)}
+  skipped = []
+  def reader(table, columns, to_event):
+    def read():
+      rows = table.search(q.fetch_only('loan', *columns), tables.order_by('date'), **loan_filter)
+      events = [to_event(item, loan_ids[item['loan'].get_id()])
+                for item in rows if item['loan'] is not None and item['loan'].get_id() in loan_ids]
+      usable = [event for event in events if event is not None]
+      skipped.append(len(events) - len(usable))
+      return usable
+    return read
+  with stage('fetch'):
+    events_raw = fetch_event_streams([
+      reader(app_tables.interest_rates, INTEREST_RATE_COLUMNS, interest_rate_event),
+      reader(app_tables.principal_lendings, LENDING_COLUMNS, lending_event),
+      reader(app_tables.repayments, REPAYMENT_COLUMNS, repayment_event)], concurrency)
+  count('events_fetched', len(events_raw))
+  if sum(skipped):
+    count('events_skipped', sum(skipped))
+    INSTRUMENTATION.log(f"fetch_events_raw: skipped {sum(skipped)} event rows without a date or amount")
+  return events_raw
 
 @anvil.server.callable
-def calc_fetch_loan_events():
-  interest_rates = [{**dict(item), "event_type":"Interest rate", "loan_id":item['loan']['loan_id']} for item in
-                   app_tables.interest_rates.search(loan=app_tables.loans.search()[0])]
-  lendings = [{**dict(item), "event_type": "Lending", "loan_id":item['loan']['loan_id']} for item in 
-              app_tables.principal_lendings.search(loan=app_tables.loans.search()[0])]
-  repayments = [{**dict(item), "event_type": "Repayment", "loan_id":item['loan']['loan_id']} for item in app_tables.repayments.search(loan=app_tables.loans.search()[0])]
-
-  events_list_raw = interest_rates + lendings + repayments
-  print(events_list_raw)
-  return events_list_raw
+def calc_fetch_loan_events(concurrency=FETCH_CONCURRENCY):
+  return fetch_events_raw(concurrency=concurrency)
 
 #@anvil.server.callable
-def calc_fetch_loan_info():
-  loans_list = [dict(app_tables.loans.search()[0])]
-  print(loans_list)
+def calc_fetch_loan_info(loans=None):
+  loans = app_tables.loans.search(q.fetch_only(*LOAN_INFO_KEYS)) if loans is None else loans
+  loans_list = [{key: loan[key] for key in LOAN_INFO_KEYS} for loan in loans]
   return loans_list
 
-
-# Set global precision to 6 decimal places
-getcontext().prec = 6
-# ==============================
-# 1. Define Data Classes
-# ==============================
-@dataclass
-class Loan:
-    loan_id: int
-    base_currency: str
-    interest_rate_base: Union[Literal[360, 365], Literal['calendar']] = 365
-    lending_date_exclusive_counting: bool = False
-    repayment_date_exclusive_counting: bool = True
-    capitalization: bool = False
-
-@dataclass
-class Currency:
-    currency_amount: Decimal
-    ticker: str
-    currency_to_loan_rate: Decimal = Decimal('1.0')  # Conversion rate to loan currency
-    def converted_amount(self) -> Decimal:
-        return self.currency_amount * self.currency_to_loan_rate
-
-@dataclass
-class Event:
-    '''
-    Populated with None values for safety reasons.
-    Default values do not make effect as they should be overwritten (None or input for each event in the event class builder loop (.:89-149)
-    '''
-    loan: Optional[Loan] = None
-    event_fact_date: Optional[datetime] = None
-    event_start_date: Optional[datetime] = None
-    event_id: Optional[int] = None
-    principal_lending_currency: Optional[Currency] = None
-    principal_lending: Optional[Decimal] = None
-    capitalization: Decimal = None
-    interest_rate: Optional[Decimal] = None
-    interest_rate_base: Decimal = None
-
-    principal_repayment_currency: Optional[Currency] = None
-    principal_repayment: Optional[Decimal] = None
-    interest_repayment_currency: Optional[Currency] = None
-    interest_repayment: Optional[Decimal] = None
-
-    principal_balance_correction: Optional[Decimal] = None
-    interest_balance_correction: Optional[Decimal] = None
-
-@dataclass
-class AggregatedEvent:
-    '''
-    Assign default values to Decimal('0.0') at aggregation stage (.:173-195) if values not provided.
-    Avoids NoneType errors when performing balance calculations (:248).
-    '''
-    loan: Loan
-    event_fact_date: datetime
-    event_start_date: Optional[datetime]
-    event_end_date: Optional[datetime] = None
-    days_count: int = 0
-    event_ids: List[int] = field(default_factory=list)
-    principal_lending_currency: Currency = field(default_factory=lambda: Currency(currency_amount=Decimal('0.0'), ticker=None, currency_to_loan_rate=None))
-    principal_lending: Decimal = Decimal('0.0')
-    capitalization: Decimal = Decimal('0.0')
-    interest_rate: Decimal = Decimal('0.0')
-    interest_rate_base: Decimal = None
-
-    principal_repayment_currency: Currency = field(default_factory=lambda: Currency(currency_amount=Decimal('0.0'), ticker=None, currency_to_loan_rate=None))
-    principal_repayment: Decimal = Decimal('0.0')
-    interest_repayment_currency: Currency = field(default_factory=lambda: Currency(currency_amount=Decimal('0.0'), ticker=None, currency_to_loan_rate=None))
-    interest_repayment: Decimal = Decimal('0.0')
-
-    principal_balance_correction: Decimal = Decimal('0.0')
-    interest_balance_correction: Decimal = Decimal('0.0')
-    principal_balance: Decimal = Decimal('0.0')
-    interest_accrued: Decimal  = Decimal('0.0')
-    interest_balance: Decimal  = Decimal ('0.0')
-
-# ==============================
-# 2. Sample input data (Loans, Events)
-# ==============================
-
 @anvil.server.callable
 def loans_list():
   loans_list_raw = calc_fetch_loan_info()
-  loans_list = [Loan(**loan) for loan in loans_list_raw]
-  print(loans_list)
-
-#loan_mapping = {loan.loan_id: loan for loan in loans_list}
-
+  loans_list = [build_loan(loan) for loan in loans_list_raw]
+  INSTRUMENTATION.log(f"loans_list: {len(loans_list)} loans")
+
+# Pipeline instrumentation (see Instrumentation) lives in the single calc_instrumentation row:
+# the server keeps no process between calls, so each instrumented call reads verbose and profiling
+# from the row and adds the stages, counters and profile it recorded to the totals stored there.
+# ScheduleStore.calc_balance_matrix is instrumented the same way.
+
+def _instrumentation_row():
+  """The calc_instrumentation row, added on first use; call inside a transaction."""
+  settings_row = app_tables.calc_instrumentation.get()
+  if settings_row is None:
+    settings_row = app_tables.calc_instrumentation.add_row(verbose=False, profiling=False, since=datetime.now())
+  return settings_row
+
+def _stored_instrumentation(settings_row):
+  stored = Instrumentation(verbose=bool(settings_row['verbose']), profiling=bool(settings_row['profiling']))
+  stored.since = settings_row['since']
+  stored.merge({'stages': settings_row['stages'], 'counters': settings_row['counters'], 'profiles': settings_row['profiles']})
+  return stored
+
+def _store_instrumentation(settings_row, stored):
+  snapshot = stored.snapshot()
+  settings_row.update(since=stored.since, stages=snapshot['stages'], counters=snapshot['counters'],
+                      profiles=snapshot['profiles'])
+
+@tables.in_transaction
+def _load_instrumentation_settings():
+  settings_row = _instrumentation_row()
+  return bool(settings_row['verbose']), bool(settings_row['profiling'])
+
+@tables.in_transaction
+def _add_instrumentation_totals(snapshot):
+  settings_row = _instrumentation_row()
+  stored = _stored_instrumentation(settings_row)
+  stored.merge(snapshot)
+  _store_instrumentation(settings_row, stored)
+
+@contextmanager
+def instrumented_call(label):
+  """Record one server call: stages start from zero, the block is profiled if enabled, and totals are stored after."""
+  verbose, profiling = _load_instrumentation_settings()
+  configure(verbose=verbose, profiling=profiling)
+  INSTRUMENTATION.reset()
+  with INSTRUMENTATION.profile(label):
+    yield
+  INSTRUMENTATION.dump()
+  _add_instrumentation_totals(INSTRUMENTATION.snapshot())
+
+def _server_workers(workers):
+  """Worker processes for a client-requested count: None means one per CPU, never more than the CPUs."""
+  cpu_count = os.cpu_count() or 1
+  if workers is None:
+    return cpu_count
+  return max(1, min(int(workers), cpu_count))
 
+@anvil.server.callable
+def calc_portfolio_schedules(workers=1, columnar=False):
+  '''
+  Schedules of all loans in one engine run, keyed by loan_id.
+  workers > 1 shards the loans across processes, at most one per CPU of the server.
+  columnar=True runs the EventBatch pipeline in this process instead (no per-event objects;
+  converted amounts are rounded to cents while parsing).
+  '''
+  workers = _server_workers(workers)
+  with instrumented_call('calc_portfolio_schedules'):
+    loans = list(app_tables.loans.search(q.fetch_only(*LOAN_INFO_KEYS)))
+    if columnar:
+      schedule_batch = calculate_portfolio_batch(calc_fetch_loan_info(loans), fetch_events_raw(loans), fx_rates=fx_rate_index())
+      with stage('render'):
+        columns = schedule_batch.to_columns()
+    elif workers != 1:
+      columns = calculate_portfolio_columns(calc_fetch_loan_info(loans), fetch_events_raw(loans), workers, fx_rates=fx_rate_index())
+    else:
+      schedules = calculate_portfolio(calc_fetch_loan_info(loans), fetch_events_raw(loans), fx_rates=fx_rate_index())
+      with stage('render'):
+        columns = {loan_id: schedule_to_columns(schedule) for loan_id, schedule in schedules.items()}
+  return columns
+
+def iter_portfolio_schedule_rows(chunk_size=EXPORT_LOANS_CHUNK_SIZE):
+  """Export rows of all loans; events are fetched per chunk of loans and schedules computed one loan at a time."""
+  loans = list(app_tables.loans.search(q.fetch_only(*LOAN_INFO_KEYS)))
+  fx_rates = fx_rate_index()
+  for chunk_start in range(0, len(loans), chunk_size):
+    chunk = loans[chunk_start:chunk_start + chunk_size]
+    yield from iter_schedule_rows(calc_fetch_loan_info(chunk), fetch_events_raw(chunk), fx_rates=fx_rates)
+
+@anvil.server.background_task
+def export_portfolio_schedules(export_row):
+  '''
+  Write the schedules of all loans into export_row['file'] as CSV or XLSX.
+  Rows are written to a temporary file while loans are being computed, so computing them takes flat memory,
+  and the file goes to the table as it is rather than back through a server call response.
+  '''
+  anvil.server.task_state['export_id'] = export_row.get_id()
+  export_format = export_row['export_format']
+  with tempfile.NamedTemporaryFile(suffix=f".{export_format}") as file:
+    export_schedule_rows(iter_portfolio_schedule_rows(), export_format, file)
+    file.flush()
+    export_row.update(file=anvil.media.from_file(file.name, EXPORT_CONTENT_TYPES[export_format], f"loan_schedules.{export_format}"),
+                      completed_on=datetime.now())
+
+@anvil.server.callable(require_user=True)
+def launch_schedule_export(export_format='csv'):
+  """Start exporting the schedules of all loans; the client polls the task and then calls fetch_schedule_export."""
+  if export_format not in EXPORT_CONTENT_TYPES:
+    raise Exception(f"Unknown export format: {export_format}")
+  user = anvil.users.get_user()
+  export_row = app_tables.schedule_exports.add_row(user=user, export_format=export_format, created_on=datetime.now())
+  previous_rows = app_tables.schedule_exports.search(q.fetch_only('created_on'), tables.order_by('created_on', ascending=False), user=user)
+  for previous_row in list(previous_rows)[SCHEDULE_EXPORTS_KEPT:]:
+    previous_row.delete()
+  return anvil.server.launch_background_task('export_portfolio_schedules', export_row)
+
+@anvil.server.callable(require_user=True)
+def fetch_schedule_export(export_id):
+  """File of a finished export of the current user (task_state['export_id'] of its task)."""
+  export_row = app_tables.schedule_exports.get_by_id(export_id)
+  if export_row is None or export_row['user'] != anvil.users.get_user():
+    raise Exception("Export does not exist")
+  if export_row['file'] is None:
+    raise Exception("Export is not finished")
+  return export_row['file']
+
+# Stored pipeline instrumentation, users with the admin flag only
+@anvil.server.callable(require_user=lambda user: user['admin'])
+@tables.in_transaction
+def fetch_calc_instrumentation(reset=False):
+  """Stage timings, counters and captured profiles of the instrumented calls since the last reset."""
+  settings_row = _instrumentation_row()
+  snapshot = _stored_instrumentation(settings_row).snapshot()
+  if reset:
+    _store_instrumentation(settings_row, Instrumentation())
+  return snapshot
+
+@anvil.server.callable(require_user=lambda user: user['admin'])
+@tables.in_transaction
+def configure_calc_instrumentation(verbose=None, profiling=None):
+  """Turn stdout dumps (verbose) and cProfile capture (profiling) on or off; None keeps the current setting."""
+  settings_row = _instrumentation_row()
+  if verbose is not None:
+    settings_row['verbose'] = verbose
+  if profiling is not None:
+    settings_row['profiling'] = profiling
+  return _stored_instrumentation(settings_row).snapshot(include_profiles=False)
@@ -0,0 +1,146 @@
+'''
+Downsampled chart payloads for balance timelines.
+
+Series are reduced with Largest-Triangle-Three-Buckets (LTTB) to about a target number of points,
+which keeps peaks, drops and slope changes rather than every n-th row. Rows carrying a repayment are
+always listed as markers, like the repayment markers of the principal chart in the sandbox timeline
+(section 8), and are anchors of the lines too, so each marker sits on a line vertex, as long as they
+take at most half of the point budget (a portfolio repays on most dates).
+Payloads hold only lists, ISO date strings and floats, so they can be stored as simpleObject.
+'''
+
+from datetime import date
+from typing import Any, Dict, Iterable, List, Sequence
+
+from .Timeline import BalanceSnapshots
+
+# Default points per series; a browser line chart gains nothing from more
+CHART_TARGET_POINTS = 1000
+# Below this LTTB has no buckets to choose from
+CHART_MIN_POINTS = 3
+CHART_SERIES = ('principal_balance', 'interest_balance')
+
+
+def _lttb_segment(xs: Sequence[float], ys: Sequence[float], start: int, end: int, count: int) -> List[int]:
+    """count indices strictly between the anchors start and end, one per bucket, by largest triangle area."""
+    interior = end - start - 1
+    if count >= interior:
+        return list(range(start + 1, end))
+    selected = []
+    previous = start
+    bucket_size = interior / count
+    for bucket in range(count):
+        bucket_start = start + 1 + int(bucket * bucket_size)
+        bucket_end = start + 1 + int((bucket + 1) * bucket_size)
+        # Third triangle vertex: average of the next bucket, or the closing anchor after the last bucket
+        if bucket < count - 1:
+            next_start, next_end = bucket_end, start + 1 + int((bucket + 2) * bucket_size)
+            next_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+            next_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+        else:
+            next_x, next_y = xs[end], ys[end]
+        previous_x, previous_y = xs[previous], ys[previous]
+        best, best_area = bucket_start, -1.0
+        for i in range(bucket_start, bucket_end):
+            area = abs((previous_x - next_x) * (ys[i] - previous_y) - (previous_x - xs[i]) * (next_y - previous_y))
+            if area > best_area:
+                best, best_area = i, area
+        selected.append(best)
+        previous = best
+    return selected
+
+def lttb_indices(xs: Sequence[float], ys: Sequence[float], target_points: int, keep: Iterable[int] = ()) -> List[int]:
+    '''
+    Sorted indices of about target_points points (xs ascending) chosen by LTTB.
+    The first, last and `keep` points are always included, so with many of them the result can exceed target_points;
+    the remaining budget is split between the gaps between kept points by their length.
+    '''
+    if target_points < CHART_MIN_POINTS:
+        raise ValueError(f"target_points must be at least {CHART_MIN_POINTS}, got {target_points}")
+    n = len(xs)
+    if n <= target_points:
+        return list(range(n))
+    anchors = sorted({0, n - 1} | {i for i in keep if 0 <= i < n})
+    budget = max(target_points - len(anchors), 0)
+    interior_total = n - len(anchors)
+    indices = []
+    for start, end in zip(anchors, anchors[1:]):
+        indices.append(start)
+        interior = end - start - 1
+        count = round(budget * interior / interior_total) if interior_total else 0
+        if interior and count:
+            indices.extend(_lttb_segment(xs, ys, start, end, count))
+    indices.append(anchors[-1])
+    return indices
+
+def chart_payload(ordinals: Sequence[int],
+                  series: Dict[str, Sequence[float]],
+                  principal_repayment: Sequence[float],
+                  interest_repayment: Sequence[float],
+                  target_points: int = CHART_TARGET_POINTS) -> Dict[str, Any]:
+    '''
+    {'source_points', 'target_points', 'series': {name: {'x', 'y'}}, 'repayments': {'x', 'principal_repayment',
+    'interest_repayment', name: [...] per series}} with x as ISO dates; every series is downsampled on its own.
+    '''
+    repayment_rows = [i for i in range(len(ordinals)) if principal_repayment[i] > 0 or interest_repayment[i] > 0]
+    payload: Dict[str, Any] = {
+        'source_points': len(ordinals),
+        'target_points': target_points,
+        'series': {},
+        'repayments': {
+            'x': [date.fromordinal(ordinals[i]).isoformat() for i in repayment_rows],
+            'principal_repayment': [principal_repayment[i] for i in repayment_rows],
+            'interest_repayment': [interest_repayment[i] for i in repayment_rows],
+        },
+    }
+    keep = repayment_rows if len(repayment_rows) <= target_points // 2 else ()
+    for name, ys in series.items():
+        indices = lttb_indices(ordinals, ys, target_points, keep)
+        payload['series'][name] = {'x': [date.fromordinal(ordinals[i]).isoformat() for i in indices],
+                                   'y': [ys[i] for i in indices]}
+        payload['repayments'][name] = [ys[i] for i in repayment_rows]
+    return payload
+
+def loan_chart_payload(columns: Dict[str, list], target_points: int = CHART_TARGET_POINTS) -> Dict[str, Any]:
+    """Chart payload of one schedule_to_columns() schedule: balances per row on its event_fact_date."""
+    return chart_payload([fact_date.toordinal() for fact_date in columns['event_fact_date']],
+                         {name: columns[name] for name in CHART_SERIES},
+                         columns['principal_repayment'], columns['interest_repayment'], target_points)
+
+def portfolio_chart_payload(columns_list: Iterable[Dict[str, list]], target_points: int = CHART_TARGET_POINTS) -> Dict[str, Any]:
+    '''
+    Chart payload of the summed balances of many schedules, as of the end of every date any loan changes on
+    (the BalanceSnapshots.as_of values). Each loan's principal is a step and its interest balance a line
+    per snapshot, so the totals are one sweep over the sorted snapshot dates rather than an as-of per loan and date.
+    Repayments are summed per event_start_date.
+    '''
+    # ordinal -> [principal delta, interest intercept delta, interest slope delta, principal repayment, interest repayment]
+    deltas: Dict[int, List[float]] = {}
+    for columns in columns_list:
+        snapshots = BalanceSnapshots.from_columns(columns)
+        principal = intercept = slope = 0.0
+        for i, ordinal in enumerate(snapshots.ordinals):
+            row_slope = snapshots.rate[i] / snapshots.base[i] * snapshots.principal[i]
+            # interest at the end of day d >= ordinal: interest[i] + row_slope * (d - ordinal + 1)
+            row_intercept = snapshots.interest[i] - row_slope * (ordinal - 1)
+            delta = deltas.setdefault(ordinal, [0.0, 0.0, 0.0, 0.0, 0.0])
+            delta[0] += snapshots.principal[i] - principal
+            delta[1] += row_intercept - intercept
+            delta[2] += row_slope - slope
+            delta[3] += columns['principal_repayment'][i]
+            delta[4] += columns['interest_repayment'][i]
+            principal, intercept, slope = snapshots.principal[i], row_intercept, row_slope
+    ordinals = sorted(deltas)
+    principal_balance, interest_balance, principal_repayment, interest_repayment = [], [], [], []
+    principal = intercept = slope = 0.0
+    for ordinal in ordinals:
+        delta = deltas[ordinal]
+        principal += delta[0]
+        intercept += delta[1]
+        slope += delta[2]
+        principal_balance.append(principal)
+        interest_balance.append(intercept + slope * ordinal)
+        principal_repayment.append(delta[3])
+        interest_repayment.append(delta[4])
+    return chart_payload(ordinals, {'principal_balance': principal_balance, 'interest_balance': interest_balance},
+                         principal_repayment, interest_repayment, target_points)
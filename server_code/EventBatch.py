@@ -0,0 +1,328 @@
+'''
+Columnar (struct-of-arrays) event batches.
+
+Raw events of a whole portfolio are parsed once into flat NumPy columns and then aggregated
+and accrued without creating an Event or AggregatedEvent per row:
+    loan_code    int32  index into EventBatch.loans
+    event_type   int8   index into EVENT_TYPES (NO_VALUE for events without any amount or rate)
+    fact_day     int32  event_fact_date as days since 1970-01-01
+    start_day    int32  event_start_date (exclusive counting applied) as days since 1970-01-01
+    amount       int64  minor units (1/MINOR_UNITS) in loan currency; rates in 1/RATE_SCALE
+    event_rank   int32  position of the event_id in event_id order (tie-break within a start date)
+    source_row   int32  position of the raw event in the input
+An event with several amounts (e.g. principal and interest repayment) gives one row per amount.
+
+Same timeline as Timeline.calculate_portfolio with the 'numpy' backend, except that converted
+amounts are rounded to minor units while parsing.
+'''
+
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List
+import numpy as np
+
+from .Timeline import Loan, build_loan, UNIX_EPOCH_ORDINAL
+from . import NumpyAccrual
+from .Instrumentation import stage
+
+# Amounts are stored in cents; rates with 8 decimals
+MINOR_UNITS = 100
+RATE_SCALE = 10 ** 8
+# Event type codes are positions in EVENT_TYPES: schedule column -> raw event key
+EVENT_TYPES = ('principal_lending', 'principal_repayment', 'interest_repayment', 'capitalization',
+               'principal_balance_correction', 'interest_balance_correction', 'interest_rate')
+RAW_EVENT_KEYS = {
+    'principal_lending': 'principal_lending_currency',
+    'principal_repayment': 'principal_repayment_currency',
+    'interest_repayment': 'interest_repayment_currency',
+    'capitalization': 'capitalization',
+    'principal_balance_correction': 'principal_balance_correction',
+    'interest_balance_correction': 'interest_balance_correction',
+    'interest_rate': 'interest_rate',
+}
+EVENT_TYPE_CODES = {event_type: code for code, event_type in enumerate(EVENT_TYPES)}
+# Amounts that may be in a currency other than the loan currency
+CURRENCY_EVENT_TYPES = ('principal_lending', 'principal_repayment', 'interest_repayment')
+NO_VALUE = -1
+INTEREST_RATE = EVENT_TYPE_CODES['interest_rate']
+
+
+def _day_number(value: Any) -> int:
+    if isinstance(value, datetime):
+        value = value.date()
+    elif not isinstance(value, date):
+        value = date.fromisoformat(value)
+    return value.toordinal() - UNIX_EPOCH_ORDINAL
+
+def _start_day_offset(loan: Loan, event_raw: Dict[str, Any]) -> int:
+    """Days between event_fact_date and event_start_date, as Timeline.build_event computes them."""
+    offset = 0
+    for key, exclusive in (("principal_lending_currency", loan.lending_date_exclusive_counting),
+                           ("principal_repayment_currency", loan.repayment_date_exclusive_counting),
+                           ("interest_repayment_currency", loan.repayment_date_exclusive_counting)):
+        if key in event_raw:
+            offset = offset + 1 if exclusive else 0
+    return offset
+
+def _loan_currency_amount(loan: Loan, event_raw: Dict[str, Any], amount_key: str, fx_rates=None) -> float:
+    """Event amount converted to loan currency; same rules as Timeline._convert_currency."""
+    currency_ticker = event_raw.get("currency", loan.base_currency)
+    if currency_ticker == loan.base_currency:
+        return float(event_raw[amount_key])
+    currency_rate = event_raw.get("currency_to_loan_rate", None)
+    if currency_rate is None and fx_rates is not None and loan.base_currency is not None:
+        currency_rate = fx_rates.rate(currency_ticker, loan.base_currency, event_raw["event_fact_date"])
+    if currency_rate is None:
+        raise ValueError(
+            f"Missing currency conversion rate for Event ID {event_raw['event_id']}: "
+            f"{currency_ticker} → {loan.base_currency}"
+        )
+    return float(event_raw[amount_key]) * float(currency_rate)
+
+
+@dataclass(slots=True)
+class EventBatch:
+    loans: List[Loan]
+    loan_code: np.ndarray
+    event_type: np.ndarray
+    fact_day: np.ndarray
+    start_day: np.ndarray
+    amount: np.ndarray
+    event_rank: np.ndarray
+    source_row: np.ndarray
+    event_ids: List[Any]
+
+    def __len__(self) -> int:
+        return len(self.amount)
+
+    @classmethod
+    def from_raw(cls, loans_raw: Iterable[Dict[str, Any]], events_raw: Iterable[Dict[str, Any]], fx_rates=None) -> 'EventBatch':
+        '''
+        Parse raw events (Timeline input shape) in one pass.
+        Raises ValueError for events referencing an unknown loan or missing a conversion rate.
+        '''
+        loans = [build_loan(loan_raw) for loan_raw in loans_raw]
+        loan_codes = {loan.loan_id: code for code, loan in enumerate(loans)}
+        loan_code, event_type, fact_day, start_day, amount, source_row = [], [], [], [], [], []
+        event_ids: List[Any] = []
+        for row, event_raw in enumerate(events_raw):
+            code = loan_codes.get(event_raw.get("loan_id"))
+            if code is None:
+                raise ValueError(f"Loan with ID {event_raw.get('loan_id')} not found.")
+            loan = loans[code]
+            event_fact_day = _day_number(event_raw["event_fact_date"])
+            event_start_day = event_fact_day + _start_day_offset(loan, event_raw)
+            event_ids.append(event_raw["event_id"])
+            values = []
+            for type_code, column in enumerate(EVENT_TYPES):
+                key = RAW_EVENT_KEYS[column]
+                if key not in event_raw:
+                    continue
+                if column == 'interest_rate':
+                    values.append((type_code, round(float(event_raw[key]) * RATE_SCALE)))
+                elif column in CURRENCY_EVENT_TYPES:
+                    values.append((type_code, round(_loan_currency_amount(loan, event_raw, key, fx_rates) * MINOR_UNITS)))
+                else:
+                    values.append((type_code, round(float(event_raw[key]) * MINOR_UNITS)))
+            for type_code, value in values or [(NO_VALUE, 0)]:
+                loan_code.append(code)
+                event_type.append(type_code)
+                fact_day.append(event_fact_day)
+                start_day.append(event_start_day)
+                amount.append(value)
+                source_row.append(row)
+        # Rank of each event_id, so ties on a start date resolve as in Timeline.build_events
+        rank_by_row = np.empty(len(event_ids), dtype=np.int32)
+        rank_by_row[sorted(range(len(event_ids)), key=event_ids.__getitem__)] = np.arange(len(event_ids), dtype=np.int32)
+        source_row = np.array(source_row, dtype=np.int32)
+        return cls(loans=loans,
+                   loan_code=np.array(loan_code, dtype=np.int32),
+                   event_type=np.array(event_type, dtype=np.int8),
+                   fact_day=np.array(fact_day, dtype=np.int32),
+                   start_day=np.array(start_day, dtype=np.int32),
+                   amount=np.array(amount, dtype=np.int64),
+                   event_rank=rank_by_row[source_row],
+                   source_row=source_row,
+                   event_ids=event_ids)
+
+
+@dataclass(slots=True)
+class ScheduleBatch:
+    '''
+    Timelines of all loans of an EventBatch, rows of loan i in [loan_offsets[i], loan_offsets[i + 1]).
+    Balance columns are floats in loan currency units.
+    '''
+    loan_ids: List[Any]
+    loan_offsets: np.ndarray
+    fact_day: np.ndarray
+    start_day: np.ndarray
+    columns: Dict[str, np.ndarray]
+    # Input rows of each timeline row's events (CSR layout: event_offsets per timeline row)
+    event_offsets: np.ndarray
+    event_source_rows: np.ndarray
+    event_ids: List[Any]
+
+    def __len__(self) -> int:
+        return len(self.start_day)
+
+    def loan_columns(self, loan_id: Any) -> Dict[str, list]:
+        """One loan's timeline in the Timeline.schedule_to_columns() shape."""
+        return self._code_columns(self.loan_ids.index(loan_id))
+
+    def to_columns(self) -> Dict[Any, Dict[str, list]]:
+        """{loan_id: schedule_to_columns()-shaped timeline} of every loan, like CalcCore.calc_portfolio_schedules."""
+        return {loan_id: self._code_columns(code) for code, loan_id in enumerate(self.loan_ids)}
+
+    def _code_columns(self, code: int) -> Dict[str, list]:
+        rows = slice(self.loan_offsets[code], self.loan_offsets[code + 1])
+        def dates(days: np.ndarray) -> List[date]:
+            return [date.fromordinal(day + UNIX_EPOCH_ORDINAL) for day in days.tolist()]
+        days_count = self.columns['days_count'][rows]
+        start_day = self.start_day[rows]
+        columns = {
+            'event_fact_date': dates(self.fact_day[rows]),
+            'event_start_date': dates(start_day),
+            'event_end_date': dates(np.where(days_count > 1, start_day + days_count - 1, start_day)),
+        }
+        for name in ('days_count', 'principal_lending', 'capitalization', 'principal_repayment', 'principal_balance',
+                     'interest_rate', 'interest_rate_base', 'interest_accrued', 'interest_repayment', 'interest_balance'):
+            columns[name] = self.columns[name][rows].tolist()
+        event_offsets = self.event_offsets[rows.start:rows.stop + 1].tolist()
+        columns['event_ids'] = [[self.event_ids[source_row] for source_row in self.event_source_rows[start:end].tolist()]
+                                for start, end in zip(event_offsets[:-1], event_offsets[1:])]
+        return columns
+
+
+def _generated_days(first_day: int, end_day: int, months_step: int) -> np.ndarray:
+    """Month (1), quarter (3) or year (12) start days in [first_day, end_day)."""
+    months = np.arange(np.datetime64(first_day, 'D').astype('datetime64[M]'),
+                       np.datetime64(end_day - 1, 'D').astype('datetime64[M]') + 1)
+    months = months[months.astype(np.int64) % months_step == 0]
+    days = months.astype('datetime64[D]').astype(np.int64)
+    return days[(days >= first_day) & (days < end_day)]
+
+def calculate_batch(batch: EventBatch) -> ScheduleBatch:
+    '''
+    Aggregate the batch by (loan, start_day), add generated MS/QS/YS dates and accrue each loan.
+    Python loops only run per loan, never per event or timeline row.
+    '''
+    # Aggregate: sort by loan, start date and event_id; a group is one (loan, start_day)
+    with stage('aggregate'):
+        order = np.lexsort((batch.event_rank, batch.start_day, batch.loan_code))
+        loan_code = batch.loan_code[order]
+        start_day = batch.start_day[order].astype(np.int64)
+        event_type = batch.event_type[order]
+        amount = batch.amount[order]
+        new_group = np.ones(len(order), dtype=bool)
+        new_group[1:] = (np.diff(loan_code) != 0) | (np.diff(start_day) != 0)
+        group_starts = np.flatnonzero(new_group)
+        group_id = np.cumsum(new_group) - 1
+        groups_count = len(group_starts)
+        group_sums = {}
+        for column in EVENT_TYPES:
+            if column == 'interest_rate':
+                continue
+            mask = event_type == EVENT_TYPE_CODES[column]
+            sums = np.zeros(groups_count, dtype=np.int64)
+            np.add.at(sums, group_id[mask], amount[mask])
+            group_sums[column] = sums
+        # Last positive rate of each group wins, as in Timeline.aggregate_events
+        rate_rows = np.flatnonzero((event_type == INTEREST_RATE) & (amount > 0))
+        group_rates = np.zeros(groups_count, dtype=np.int64)
+        if len(rate_rows):
+            rate_groups = group_id[rate_rows]
+            last_in_group = np.append(rate_groups[1:] != rate_groups[:-1], True)
+            group_rates[rate_groups[last_in_group]] = amount[rate_rows[last_in_group]]
+        group_loan = loan_code[group_starts].astype(np.int64)
+        group_day = start_day[group_starts]
+        group_fact_day = batch.fact_day[order][group_starts].astype(np.int64)
+
+    # Timeline rows: event dates plus generated dates of every loan with events
+    with stage('calendar'):
+        loan_bounds = np.searchsorted(group_loan, np.arange(len(batch.loans) + 1))
+        generated_loan, generated_day, capitalization_day = [], [], []
+        for code, loan in enumerate(batch.loans):
+            if loan_bounds[code] == loan_bounds[code + 1]:
+                continue
+            first_day = int(group_day[loan_bounds[code]])
+            end_day = int(group_day[loan_bounds[code + 1] - 1]) + 31
+            days = [_generated_days(first_day, end_day, 1)]
+            if loan.capitalization:
+                quarter_days = _generated_days(first_day, end_day, 3)
+                capitalization_day.append(code * 2 ** 32 + quarter_days + 2 ** 31)
+            if loan.interest_rate_base == 'calendar':
+                days.append(_generated_days(first_day, end_day, 12))
+            days = np.concatenate(days)
+            generated_loan.append(np.full(len(days), code, dtype=np.int64))
+            generated_day.append(days)
+        # (loan, day) packed in one int64 so np.unique sorts and deduplicates both at once
+        group_keys = group_loan * 2 ** 32 + group_day + 2 ** 31
+        generated_keys = (np.concatenate(generated_loan) * 2 ** 32 + np.concatenate(generated_day) + 2 ** 31
+                          if generated_loan else np.zeros(0, dtype=np.int64))
+        row_keys = np.unique(np.concatenate((group_keys, generated_keys)))
+        row_loan = row_keys // 2 ** 32
+        row_day = row_keys % 2 ** 32 - 2 ** 31
+        row_group = np.searchsorted(group_keys, row_keys)
+        has_group = row_group < groups_count
+        has_group[has_group] = group_keys[row_group[has_group]] == row_keys[has_group]
+        def row_values(values: np.ndarray) -> np.ndarray:
+            result = np.zeros(len(row_keys), dtype=values.dtype)
+            result[has_group] = values[row_group[has_group]]
+            return result
+        capitalization_mask = np.isin(row_keys, np.concatenate(capitalization_day)) if capitalization_day else np.zeros(len(row_keys), dtype=bool)
+        inputs = {column: row_values(sums) / MINOR_UNITS for column, sums in group_sums.items()}
+        inputs['interest_rate'] = row_values(group_rates) / RATE_SCALE
+        fact_day = np.where(has_group, row_values(group_fact_day), row_day)
+
+    # Accrual: one NumPy kernel call per loan
+    with stage('accrual'):
+        loan_offsets = np.searchsorted(row_loan, np.arange(len(batch.loans) + 1))
+        output_names = ('days_count', 'interest_rate', 'interest_rate_base', 'capitalization',
+                        'principal_balance', 'interest_accrued', 'interest_balance')
+        outputs = {name: np.zeros(len(row_keys), dtype=np.int64 if name in ('days_count', 'interest_rate_base') else np.float64)
+                   for name in output_names}
+        for code, loan in enumerate(batch.loans):
+            rows = slice(loan_offsets[code], loan_offsets[code + 1])
+            if rows.start == rows.stop:
+                continue
+            result = NumpyAccrual.accrue(
+                start_days=row_day[rows],
+                principal_lending=inputs['principal_lending'][rows],
+                capitalization=inputs['capitalization'][rows],
+                principal_repayment=inputs['principal_repayment'][rows],
+                principal_balance_correction=inputs['principal_balance_correction'][rows],
+                interest_rate=inputs['interest_rate'][rows],
+                interest_repayment=inputs['interest_repayment'][rows],
+                interest_balance_correction=inputs['interest_balance_correction'][rows],
+                interest_rate_base=loan.interest_rate_base,
+                capitalization_mask=capitalization_mask[rows])
+            for name in output_names:
+                outputs[name][rows] = result[name]
+
+    # Source events per timeline row (distinct input rows of each group, in event order)
+    first_of_event = np.ones(len(order), dtype=bool)
+    sorted_source = batch.source_row[order]
+    first_of_event[1:] = (sorted_source[1:] != sorted_source[:-1]) | new_group[1:]
+    event_group = group_id[first_of_event]
+    events_per_row = np.zeros(len(row_keys), dtype=np.int64)
+    events_per_row[has_group] = np.bincount(event_group, minlength=groups_count)[row_group[has_group]]
+    return ScheduleBatch(
+        loan_ids=[loan.loan_id for loan in batch.loans],
+        loan_offsets=loan_offsets,
+        fact_day=fact_day.astype(np.int32),
+        start_day=row_day.astype(np.int32),
+        columns={**outputs,
+                 'principal_lending': inputs['principal_lending'],
+                 'principal_repayment': inputs['principal_repayment'],
+                 'interest_repayment': inputs['interest_repayment']},
+        event_offsets=np.concatenate(([0], np.cumsum(events_per_row))),
+        event_source_rows=sorted_source[first_of_event],
+        event_ids=batch.event_ids)
+
+def calculate_portfolio_batch(loans_raw: Iterable[Dict[str, Any]],
+                              events_raw: Iterable[Dict[str, Any]],
+                              fx_rates=None) -> ScheduleBatch:
+    """Columnar counterpart of Timeline.calculate_portfolio: parse, aggregate and accrue on arrays."""
+    with stage('parse'):
+        batch = EventBatch.from_raw(loans_raw, events_raw, fx_rates)
+    return calculate_batch(batch)
@@ -0,0 +1,166 @@
+'''
+Bulk import of loan events (lendings, repayments, interest rate changes).
+
+Records come from CSV or JSON with one event per record:
+    event_type   'Lending' | 'Repayment' | 'Interest rate'
+    loan_id      loans.loan_id of the linked loan
+    date         ISO date (YYYY-MM-DD)
+    event_id     optional, generated if missing
+plus the event table columns of its type (see EventStream.*_COLUMNS).
+
+Kept free of anvil imports: loan resolution and batch writes are passed in as functions,
+so the whole pipeline also runs (and is benchmarked) on plain dicts.
+'''
+
+import csv
+import io
+import json
+import math
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+from uuid import uuid4
+
+IMPORT_FORMATS = ('csv', 'json')
+IMPORT_BATCH_SIZE = 500
+
+# Value columns accepted per event type: column -> required
+IMPORT_COLUMNS: Dict[str, Dict[str, bool]] = {
+    'Interest rate': {'value': True},
+    'Lending': {'currency_sum': True, 'currency_ticker': False, 'currency_to_loan_rate': False},
+    'Repayment': {'principal_currency_allocation': False, 'interest_currency_allocation': False,
+                  'currency_ticker': False, 'currency_to_loan_rate': False},
+}
+TEXT_COLUMNS = ('currency_ticker',)
+
+
+@dataclass
+class ImportResult:
+    rows_total: int = 0
+    rows_imported: int = 0
+    # One {'row': record number (1-based), 'error': message} per rejected record
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+    loan_ids: List[Any] = field(default_factory=list)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'rows_total': self.rows_total, 'rows_imported': self.rows_imported,
+                'errors': self.errors, 'loan_ids': self.loan_ids}
+
+
+def parse_records(content: str, import_format: str = 'csv') -> List[Dict[str, Any]]:
+    """CSV text (header row required) or a JSON list of objects -> list of records."""
+    if import_format == 'csv':
+        return list(csv.DictReader(io.StringIO(content)))
+    if import_format == 'json':
+        records = json.loads(content)
+        if not isinstance(records, list):
+            raise ValueError("JSON import expects a list of event objects")
+        return records
+    raise ValueError(f"Unknown import format: {import_format}")
+
+def _blank(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+def _to_date(value: Any) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value).strip())
+
+def _to_number(value: Any) -> float:
+    if isinstance(value, bool):
+        raise ValueError(f"not a number: {value!r}")
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"not a finite number: {value!r}")
+    return number
+
+def normalize_record(record: Dict[str, Any]) -> Tuple[str, Any, Dict[str, Any]]:
+    '''
+    Validate one record; returns (event_type, loan_id, event table columns).
+    Raises ValueError with a message suitable for the per-row error report.
+    '''
+    if not isinstance(record, dict):
+        raise ValueError(f"expected an event object, got {record!r}")
+    event_type = str(record.get('event_type') or '').strip()
+    if event_type not in IMPORT_COLUMNS:
+        raise ValueError(f"unknown event_type {record.get('event_type')!r}")
+    loan_id = record.get('loan_id')
+    if _blank(loan_id):
+        raise ValueError("loan_id is missing")
+    if _blank(record.get('date')):
+        raise ValueError("date is missing")
+    try:
+        event_date = _to_date(record['date'])
+    except ValueError:
+        raise ValueError(f"invalid date {record['date']!r}")
+    event = {'event_id': str(record['event_id']).strip() if not _blank(record.get('event_id')) else str(uuid4()),
+             'date': event_date}
+    for column, required in IMPORT_COLUMNS[event_type].items():
+        value = record.get(column)
+        if _blank(value):
+            if required:
+                raise ValueError(f"{column} is missing")
+            continue
+        if column in TEXT_COLUMNS:
+            event[column] = str(value).strip().upper()
+            continue
+        try:
+            event[column] = _to_number(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{column} is not a finite number: {value!r}")
+    if event_type == 'Repayment' and 'principal_currency_allocation' not in event and 'interest_currency_allocation' not in event:
+        raise ValueError("repayment has neither principal_currency_allocation nor interest_currency_allocation")
+    return event_type, str(loan_id).strip(), event
+
+def import_records(records: Iterable[Dict[str, Any]],
+                   resolve_loans: Callable[[List[Any]], Dict[Any, Any]],
+                   write_batch: Callable[[str, List[Dict[str, Any]]], None],
+                   batch_size: int = IMPORT_BATCH_SIZE) -> ImportResult:
+    '''
+    Validate and normalize all records in one pass, then write them in batches.
+    resolve_loans(loan_ids) -> {loan_id: loan} is called once for all distinct loan_ids;
+    records of unknown loans are reported, not written.
+    write_batch(event_type, events) writes up to batch_size events of one type, each with its 'loan'.
+    Invalid records never abort the import; a failing batch reports its records and the next batch continues.
+    '''
+    result = ImportResult()
+    normalized: List[Tuple[int, str, Any, Dict[str, Any]]] = []
+    for row_number, record in enumerate(records, start=1):
+        result.rows_total += 1
+        try:
+            normalized.append((row_number, *normalize_record(record)))
+        except ValueError as e:
+            result.errors.append({'row': row_number, 'error': str(e)})
+
+    loans = resolve_loans(sorted({loan_id for _, _, loan_id, _ in normalized}))
+    pending: Dict[str, List[Tuple[int, Any, Dict[str, Any]]]] = {event_type: [] for event_type in IMPORT_COLUMNS}
+    imported_loan_ids = set()
+
+    def flush(event_type: str) -> None:
+        batch = pending[event_type]
+        pending[event_type] = []
+        if not batch:
+            return
+        try:
+            write_batch(event_type, [event for _, _, event in batch])
+        except Exception as e:
+            result.errors.extend({'row': row_number, 'error': f"batch write failed: {e}"} for row_number, _, _ in batch)
+            return
+        result.rows_imported += len(batch)
+        imported_loan_ids.update(loan_id for _, loan_id, _ in batch)
+
+    for row_number, event_type, loan_id, event in normalized:
+        loan = loans.get(loan_id)
+        if loan is None:
+            result.errors.append({'row': row_number, 'error': f"loan {loan_id!r} does not exist"})
+            continue
+        pending[event_type].append((row_number, loan_id, {**event, 'loan': loan}))
+        if len(pending[event_type]) >= batch_size:
+            flush(event_type)
+    for event_type in IMPORT_COLUMNS:
+        flush(event_type)
+    result.errors.sort(key=lambda error: error['row'])
+    result.loan_ids = sorted(imported_loan_ids)
+    return result
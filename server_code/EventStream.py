@@ -0,0 +1,73 @@
+'''
+Event table rows -> compact raw events in the shape the Timeline engine expects.
+Kept free of anvil imports: rows only need item['column'] access, so plain dicts work too.
+Rows the engine cannot use (no date, or an empty rate or lending amount) convert to None;
+readers drop them so one empty cell does not abort a portfolio run.
+'''
+
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+# Columns each event table needs (used for q.fetch_only); 'loan' is resolved separately
+INTEREST_RATE_COLUMNS = ('event_id', 'date', 'value')
+LENDING_COLUMNS = ('event_id', 'date', 'currency_sum', 'currency_ticker', 'currency_to_loan_rate')
+REPAYMENT_COLUMNS = ('event_id', 'date', 'principal_currency_allocation', 'interest_currency_allocation',
+                     'currency_ticker', 'currency_to_loan_rate')
+# Event table reads in flight at once (one per table)
+FETCH_CONCURRENCY = 3
+
+
+def _currency_keys(item) -> Dict[str, Any]:
+    currency_keys = {}
+    if item['currency_ticker']:
+        currency_keys["currency"] = item['currency_ticker']
+    if item['currency_to_loan_rate'] is not None:
+        currency_keys["currency_to_loan_rate"] = item['currency_to_loan_rate']
+    return currency_keys
+
+def interest_rate_event(item, loan_id: Any) -> Optional[Dict[str, Any]]:
+    if item['date'] is None or item['value'] is None:
+        return None
+    return {"event_id": item['event_id'], "event_fact_date": item['date'], "interest_rate": item['value'],
+            "event_type": "Interest rate", "loan_id": loan_id}
+
+def lending_event(item, loan_id: Any) -> Optional[Dict[str, Any]]:
+    if item['date'] is None or item['currency_sum'] is None:
+        return None
+    return {"event_id": item['event_id'], "event_fact_date": item['date'],
+            "principal_lending_currency": item['currency_sum'], **_currency_keys(item),
+            "event_type": "Lending", "loan_id": loan_id}
+
+def repayment_event(item, loan_id: Any) -> Optional[Dict[str, Any]]:
+    if item['date'] is None:
+        return None
+    event = {"event_id": item['event_id'], "event_fact_date": item['date'], **_currency_keys(item),
+             "event_type": "Repayment", "loan_id": loan_id}
+    if item['principal_currency_allocation']:
+        event["principal_repayment_currency"] = item['principal_currency_allocation']
+    if item['interest_currency_allocation']:
+        event["interest_repayment_currency"] = item['interest_currency_allocation']
+    return event
+
+def merge_event_streams(*streams: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Merge per-table event lists, each already ordered by date, into one date-ordered list."""
+    merged: Iterator[Dict[str, Any]] = heapq.merge(*streams, key=lambda event: event["event_fact_date"])
+    return list(merged)
+
+def read_concurrently(readers: Sequence[Callable[[], List[Dict[str, Any]]]],
+                      concurrency: int = FETCH_CONCURRENCY) -> List[List[Dict[str, Any]]]:
+    '''
+    Run the table readers in a thread pool of at most `concurrency` threads; results keep the readers' order.
+    concurrency=1 reads one table after another in the calling thread. A reader's exception is re-raised.
+    '''
+    if concurrency <= 1 or len(readers) <= 1:
+        return [reader() for reader in readers]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(readers))) as executor:
+        futures = [executor.submit(reader) for reader in readers]
+        return [future.result() for future in futures]
+
+def fetch_event_streams(readers: Sequence[Callable[[], List[Dict[str, Any]]]],
+                        concurrency: int = FETCH_CONCURRENCY) -> List[Dict[str, Any]]:
+    """Read the per-table event streams (concurrently) and merge them by date."""
+    return merge_event_streams(*read_concurrently(readers, concurrency))
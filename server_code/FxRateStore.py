@@ -0,0 +1,78 @@
+import anvil.google.auth, anvil.google.drive, anvil.google.mail
+from anvil.google.drive import app_files
+import anvil.facebook.auth
+import anvil.users
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+import csv
+import io
+from .FxRates import LazyFxRateIndex, normalize_fx_rate
+
+# FX rates (fx_rates table: pair, date, rate) for events without a manually entered currency_to_loan_rate.
+# fx_rate_index() reads the whole table into an FxRateIndex on the first rate lookup of a server call,
+# so filling rates for thousands of events costs no table query per event, and a call whose events all
+# carry their rate (or are in the loan currency) never reads the table. Nothing is kept between calls.
+# Loading rates marks the stored schedules that may convert with them stale (loans whose base currency
+# is in a loaded pair), so they are recomputed against the new rates on their next read.
+
+FX_LOAD_BATCH_SIZE = 500
+
+
+
+def _fx_rate_rows():
+  return app_tables.fx_rates.search(q.fetch_only('pair', 'date', 'rate'))
+
+def fx_rate_index():
+  """Rates of the fx_rates table, loaded on the first lookup."""
+  return LazyFxRateIndex(_fx_rate_rows)
+
+def invalidate_schedules_for_pairs(pairs):
+  """Mark stale the stored schedules of loans whose base currency is one side of any of the pairs."""
+  tickers = {ticker for pair in pairs for ticker in pair.split('/')}
+  loans = [loan for loan in app_tables.loans.search(q.fetch_only('base_currency'))
+           if (loan['base_currency'] or '').upper() in tickers]
+  if not loans:
+    return 0
+  with tables.Transaction():
+    schedule_rows = list(app_tables.loan_schedules.search(q.fetch_only('stale'), loan=q.any_of(*loans)))
+    for schedule_row in schedule_rows:
+      schedule_row['stale'] = True
+  return len(schedule_rows)
+
+@anvil.server.callable(require_user=lambda user: user['admin'])
+def load_fx_rates(content, batch_size=FX_LOAD_BATCH_SIZE):
+  '''
+  Bulk load rates from CSV text or an uploaded CSV file with pair,date,rate columns.
+  Rows for a (pair, date) already in the table replace its rate; invalid rows are reported, not loaded.
+  Admin users only, since the rates apply to every loan.
+  '''
+  if not isinstance(content, str):
+    content = content.get_bytes().decode('utf-8-sig')
+  rates, errors = {}, []
+  for row_number, record in enumerate(csv.DictReader(io.StringIO(content)), start=1):
+    try:
+      row = normalize_fx_rate(record)
+    except (KeyError, TypeError, ValueError) as e:
+      errors.append({'row': row_number, 'error': str(e)})
+      continue
+    rates[(row['pair'], row['date'])] = row
+  existing = {}
+  if rates:
+    pairs = {pair for pair, _ in rates}
+    existing = {(row['pair'], row['date']): row
+                for row in app_tables.fx_rates.search(q.fetch_only('pair', 'date', 'rate'), pair=q.any_of(*pairs))}
+  new_rows = [row for key, row in rates.items() if key not in existing]
+  rows_updated = 0
+  with tables.Transaction():
+    for key, row in rates.items():
+      if key in existing and existing[key]['rate'] != row['rate']:
+        existing[key]['rate'] = row['rate']
+        rows_updated += 1
+  for batch_start in range(0, len(new_rows), batch_size):
+    with tables.Transaction():
+      app_tables.fx_rates.add_rows(new_rows[batch_start:batch_start + batch_size])
+  schedules_invalidated = invalidate_schedules_for_pairs({pair for pair, _ in rates}) if new_rows or rows_updated else 0
+  return {'rows_added': len(new_rows), 'rows_updated': rows_updated, 'errors': errors,
+          'schedules_invalidated': schedules_invalidated}
@@ -0,0 +1,140 @@
+'''
+FX rates indexed by currency pair and date.
+
+A pair 'EUR/USD' with rate 1.08 means 1 EUR = 1.08 USD.
+Lookups are as-of: the rate of the latest date on or before the requested date.
+The inverse pair is used when only the opposite quote is loaded.
+
+Kept free of anvil imports so it can be loaded from the fx_rates table (FxRateStore)
+or from a local CSV file with pair,date,rate columns (fixtures/fx_rates.csv).
+LazyFxRateIndex defers loading until the first lookup, for runs that may not need a rate at all.
+'''
+
+import csv
+from bisect import bisect_right
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# Distinct (pair, day) lookups kept per index; a portfolio run mostly repeats the same few
+FX_CACHE_SIZE = 16384
+
+
+def fx_pair(from_ticker: str, to_ticker: str) -> str:
+    return f"{from_ticker}/{to_ticker}"
+
+def _to_date(value: Any) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value).strip()[:10])
+
+def normalize_fx_rate(row: Dict[str, Any]) -> Dict[str, Any]:
+    """pair upper-cased, date as date, rate as a positive float; raises ValueError otherwise."""
+    pair = str(row.get('pair') or '').strip().upper()
+    if len(pair.split('/')) != 2:
+        raise ValueError(f"invalid pair {row.get('pair')!r}, expected e.g. 'EUR/USD'")
+    rate = float(row['rate'])
+    if not rate > 0:
+        raise ValueError(f"invalid rate {row['rate']!r} for {pair}")
+    return {'pair': pair, 'date': _to_date(row['date']), 'rate': rate}
+
+
+class FxRateIndex:
+    '''
+    Sorted per-pair index (day ordinals + rates) with an LRU cache in front of the as-of lookup.
+    load() takes any number of rows at once; a later row for the same pair and date replaces the earlier one.
+    '''
+    def __init__(self, rows: Iterable[Dict[str, Any]] = (), cache_size: int = FX_CACHE_SIZE):
+        self._days: Dict[str, List[int]] = {}
+        self._rates: Dict[str, List[float]] = {}
+        self._lookup = lru_cache(maxsize=cache_size)(self._lookup_uncached)
+        self.load(rows)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The LRU cache wraps a bound method and is rebuilt empty on unpickling (process pool workers)
+        return {'days': self._days, 'rates': self._rates, 'cache_size': self._lookup.cache_parameters()['maxsize']}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self._days = state['days']
+        self._rates = state['rates']
+        self._lookup = lru_cache(maxsize=state['cache_size'])(self._lookup_uncached)
+
+    @classmethod
+    def from_csv(cls, path: str, cache_size: int = FX_CACHE_SIZE) -> 'FxRateIndex':
+        with open(path, newline='') as file:
+            return cls(csv.DictReader(file), cache_size)
+
+    def load(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """Bulk load rows with 'pair', 'date' and 'rate'; each touched pair is re-sorted once."""
+        loaded: Dict[str, Dict[int, float]] = {}
+        for row in rows:
+            row = normalize_fx_rate(row)
+            loaded.setdefault(row['pair'], {})[row['date'].toordinal()] = row['rate']
+        for pair, rates_by_day in loaded.items():
+            merged = dict(zip(self._days.get(pair, []), self._rates.get(pair, [])))
+            merged.update(rates_by_day)
+            days = sorted(merged)
+            self._days[pair] = days
+            self._rates[pair] = [merged[day] for day in days]
+        if loaded:
+            self._lookup.cache_clear()
+
+    @property
+    def pairs(self) -> List[str]:
+        return sorted(self._days)
+
+    def cache_info(self):
+        return self._lookup.cache_info()
+
+    def _as_of(self, pair: str, day: int) -> Optional[float]:
+        days = self._days.get(pair)
+        if not days:
+            return None
+        i = bisect_right(days, day) - 1
+        return self._rates[pair][i] if i >= 0 else None
+
+    def _lookup_uncached(self, from_ticker: str, to_ticker: str, day: int) -> Optional[float]:
+        if from_ticker == to_ticker:
+            return 1.0
+        rate = self._as_of(fx_pair(from_ticker, to_ticker), day)
+        if rate is not None:
+            return rate
+        inverse_rate = self._as_of(fx_pair(to_ticker, from_ticker), day)
+        return 1 / inverse_rate if inverse_rate else None
+
+    def rate(self, from_ticker: str, to_ticker: str, on_date: Any) -> Optional[float]:
+        """Rate converting from_ticker amounts to to_ticker as of on_date; None if no rate is known by then."""
+        return self._lookup(from_ticker.upper(), to_ticker.upper(), _to_date(on_date).toordinal())
+
+
+class LazyFxRateIndex:
+    '''
+    FxRateIndex built from load_rows() on the first rate() call, so a run whose foreign currency events
+    all carry a currency_to_loan_rate never loads any rates. Pickled (process pool workers) as the built index.
+    '''
+    def __init__(self, load_rows: Callable[[], Iterable[Dict[str, Any]]], cache_size: int = FX_CACHE_SIZE):
+        self._load_rows = load_rows
+        self._cache_size = cache_size
+        self._index: Optional[FxRateIndex] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {'index': self.index}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self._load_rows = None
+        self._index = state['index']
+
+    @property
+    def loaded(self) -> bool:
+        return self._index is not None
+
+    @property
+    def index(self) -> FxRateIndex:
+        if self._index is None:
+            self._index = FxRateIndex(self._load_rows(), self._cache_size)
+        return self._index
+
+    def rate(self, from_ticker: str, to_ticker: str, on_date: Any) -> Optional[float]:
+        return self.index.rate(from_ticker, to_ticker, on_date)
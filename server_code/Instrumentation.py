@@ -0,0 +1,128 @@
+'''
+Timing, counters and optional cProfile capture for the calc pipeline.
+
+Stages (seconds and number of calls) and counters accumulate in a module-level Instrumentation.
+The server keeps no process between calls, so CalcCore resets it at the start of an instrumented call
+and merges the snapshot into a table row at the end; process pool workers send theirs back with their
+results the same way (merge()). Nothing is written to stdout unless verbose is on.
+Kept free of anvil imports so the Timeline engine can use it anywhere.
+'''
+
+import cProfile
+import io
+import pstats
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional
+
+# Pipeline stages in order; other names are accepted and listed after these
+PIPELINE_STAGES = ('fetch', 'parse', 'aggregate', 'calendar', 'accrual', 'render')
+# Functions listed per captured profile (by cumulative time)
+PROFILE_TOP_FUNCTIONS = 30
+# Captured profiles kept, oldest dropped first
+PROFILES_KEPT = 5
+
+
+class Instrumentation:
+    def __init__(self, verbose: bool = False, profiling: bool = False):
+        self.verbose = verbose
+        self.profiling = profiling
+        self.reset()
+
+    def reset(self) -> None:
+        self.stage_seconds: Dict[str, float] = {}
+        self.stage_calls: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {}
+        self.profiles: Dict[str, str] = {}
+        self.since = datetime.now()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+        self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def profile(self, label: str) -> Iterator[None]:
+        """cProfile the block when profiling is on; the top functions are kept under label."""
+        if not self.profiling:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+            self._keep_profile(label, output.getvalue())
+
+    def _keep_profile(self, label: str, text: str) -> None:
+        self.profiles.pop(label, None)
+        self.profiles[label] = text
+        while len(self.profiles) > PROFILES_KEPT:
+            self.profiles.pop(next(iter(self.profiles)))
+
+    def merge(self, snapshot: Dict[str, Any]) -> None:
+        """Add the stages, counters and profiles of a snapshot() taken elsewhere (a worker process or a stored total)."""
+        for name, stage in (snapshot.get('stages') or {}).items():
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + stage['seconds']
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + stage['calls']
+        for name, value in (snapshot.get('counters') or {}).items():
+            self.count(name, value)
+        for label, text in (snapshot.get('profiles') or {}).items():
+            self._keep_profile(label, text)
+
+    def log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
+
+    def snapshot(self, include_profiles: bool = True) -> Dict[str, Any]:
+        names = [name for name in PIPELINE_STAGES if name in self.stage_seconds]
+        names += sorted(name for name in self.stage_seconds if name not in PIPELINE_STAGES)
+        snapshot = {
+            'since': self.since,
+            'verbose': self.verbose,
+            'profiling': self.profiling,
+            'stages': {name: {'seconds': self.stage_seconds[name], 'calls': self.stage_calls[name]} for name in names},
+            'counters': dict(self.counters),
+        }
+        if include_profiles:
+            snapshot['profiles'] = dict(self.profiles)
+        return snapshot
+
+    def dump(self) -> None:
+        """Print the stage table and counters (verbose only)."""
+        if not self.verbose:
+            return
+        for name, stage in self.snapshot(include_profiles=False)['stages'].items():
+            print(f"{name:<16}{stage['seconds'] * 1000:>12.1f} ms{stage['calls']:>10} calls")
+        for name, value in sorted(self.counters.items()):
+            print(f"{name:<16}{value:>12}")
+
+
+# Shared by the engine and the server modules
+INSTRUMENTATION = Instrumentation()
+
+def stage(name: str):
+    return INSTRUMENTATION.stage(name)
+
+def count(name: str, value: int = 1) -> None:
+    INSTRUMENTATION.count(name, value)
+
+def configure(verbose: Optional[bool] = None, profiling: Optional[bool] = None) -> None:
+    if verbose is not None:
+        INSTRUMENTATION.verbose = verbose
+    if profiling is not None:
+        INSTRUMENTATION.profiling = profiling
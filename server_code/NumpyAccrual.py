@@ -0,0 +1,91 @@
+'''
+NumPy accrual kernel.
+
+Array version of Timeline.calculate_balances: principal balances are cumulative sums,
+days counts are diffs of the start dates and interest accrues for all periods at once.
+Capitalization resets only need one scalar step per capitalization date
+(interest capitalized on a date depends on the principal accrued since the previous one).
+'''
+
+from typing import Dict, Optional
+import numpy as np
+
+
+def forward_fill_rate(interest_rate: np.ndarray, initial_interest_rate: float = 0.0) -> np.ndarray:
+    """Carry the last positive rate forward; initial_interest_rate before the first rate is set."""
+    positions = np.where(interest_rate > 0, np.arange(len(interest_rate)), -1)
+    positions = np.maximum.accumulate(positions)
+    return np.where(positions >= 0, interest_rate[np.maximum(positions, 0)], initial_interest_rate)
+
+def interest_rate_bases(start_ordinals: np.ndarray, interest_rate_base) -> np.ndarray:
+    """Days count base per period: 366/365 by year of the period start for 'calendar'."""
+    if interest_rate_base != 'calendar':
+        return np.full(len(start_ordinals), int(interest_rate_base), dtype=np.int64)
+    years = start_ordinals.astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970
+    leap = ((years % 4 == 0) & (years % 100 != 0)) | (years % 400 == 0)
+    return np.where(leap, 366, 365).astype(np.int64)
+
+def accrue(start_days: np.ndarray,
+           principal_lending: np.ndarray,
+           capitalization: np.ndarray,
+           principal_repayment: np.ndarray,
+           principal_balance_correction: np.ndarray,
+           interest_rate: np.ndarray,
+           interest_repayment: np.ndarray,
+           interest_balance_correction: np.ndarray,
+           interest_rate_base,
+           capitalization_mask: Optional[np.ndarray] = None,
+           initial_principal_balance: float = 0.0,
+           initial_interest_balance: float = 0.0,
+           initial_interest_rate: float = 0.0) -> Dict[str, np.ndarray]:
+    '''
+    Balances and interest of a sorted timeline held as arrays.
+    start_days are day numbers since 1970-01-01 (datetime64[D] as int64).
+    capitalization_mask marks rows where the interest balance is capitalized;
+    on those rows the capitalized interest replaces the aggregated capitalization amount.
+    initial_* values are the accrual state before the first row (see Timeline.Checkpoint).
+    '''
+    rows_count = len(start_days)
+    if capitalization_mask is None:
+        capitalization_mask = np.zeros(rows_count, dtype=bool)
+    days_count = np.append(np.diff(start_days), 0).astype(np.int64)
+    current_interest_rate = forward_fill_rate(interest_rate, initial_interest_rate)
+    bases = interest_rate_bases(start_days, interest_rate_base)
+    accrual_factor = current_interest_rate / bases * days_count
+
+    capitalization_input = np.where(capitalization_mask, 0.0, capitalization)
+    principal_base = initial_principal_balance + np.cumsum(principal_lending + capitalization_input - principal_repayment + principal_balance_correction)
+    interest_other = interest_balance_correction - interest_repayment - capitalization_input
+
+    capitalization_rows = np.flatnonzero(capitalization_mask)
+    capitalized = np.zeros(rows_count)
+    if len(capitalization_rows):
+        # Prefix sums give each capitalization period's totals in O(1)
+        factor_principal_sum = np.concatenate(([0.0], np.cumsum(accrual_factor * principal_base)))
+        factor_sum = np.concatenate(([0.0], np.cumsum(accrual_factor)))
+        other_sum = np.concatenate(([0.0], np.cumsum(interest_other)))
+        capitalized_total = 0.0
+        period_start = 0
+        carried_interest = initial_interest_balance
+        for row in capitalization_rows:
+            # Interest balance just before the capitalization row; it was reset to 0 on period_start
+            amount = (carried_interest + factor_principal_sum[row] - factor_principal_sum[period_start]
+                      + capitalized_total * (factor_sum[row] - factor_sum[period_start])
+                      + other_sum[row] - other_sum[period_start])
+            capitalized[row] = amount
+            capitalized_total += amount
+            period_start = row
+            carried_interest = 0.0
+
+    principal_balance = principal_base + np.cumsum(capitalized)
+    interest_accrued = accrual_factor * principal_balance
+    interest_balance = initial_interest_balance + np.cumsum(interest_accrued + interest_other - capitalized)
+    return {
+        'days_count': days_count,
+        'interest_rate': current_interest_rate,
+        'interest_rate_base': bases,
+        'capitalization': np.where(capitalization_mask, capitalized, capitalization),
+        'principal_balance': principal_balance,
+        'interest_accrued': interest_accrued,
+        'interest_balance': interest_balance,
+    }
@@ -0,0 +1,118 @@
+'''
+Portfolio schedules computed on several cores.
+
+Loans are independent, so they are split into shards (balanced by event count) and each shard
+runs Timeline.calculate_portfolio in a worker process. Shards travel as compact tuples and
+schedules come back with dates as ordinals and float columns as array('d'); the parent decodes
+them into exactly what the serial path returns: {loan_id: schedule_to_columns(schedule)}.
+Each shard also returns the stage timings and counters recorded in its worker, which the parent
+merges into its own Instrumentation.
+'''
+
+import heapq
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .Timeline import calculate_portfolio, schedule_to_columns, partition_events_by_loan, SCHEDULE_DATE_COLUMNS
+from .Instrumentation import INSTRUMENTATION
+
+# Raw event keys the engine reads; an event travels as (bitmask of present keys, values of present keys)
+EVENT_KEYS = ('event_id', 'event_fact_date', 'loan_id', 'principal_lending_currency', 'principal_repayment_currency',
+              'interest_repayment_currency', 'currency', 'currency_to_loan_rate', 'capitalization',
+              'principal_balance_correction', 'interest_balance_correction', 'interest_rate')
+# Shards per worker; more shards even out loans of very different sizes
+SHARDS_PER_WORKER = 4
+# schedule_to_columns() columns holding ints or lists rather than floats
+NON_FLOAT_COLUMNS = SCHEDULE_DATE_COLUMNS + ('days_count', 'interest_rate_base', 'event_ids')
+
+
+def encode_event(event_raw: Dict[str, Any]) -> Tuple[int, tuple]:
+    mask = 0
+    values = []
+    for bit, key in enumerate(EVENT_KEYS):
+        if key in event_raw:
+            mask |= 1 << bit
+            values.append(event_raw[key])
+    return mask, tuple(values)
+
+def decode_event(encoded: Tuple[int, tuple]) -> Dict[str, Any]:
+    mask, values = encoded
+    keys = [key for bit, key in enumerate(EVENT_KEYS) if mask >> bit & 1]
+    return dict(zip(keys, values))
+
+def encode_columns(columns: Dict[str, list]) -> Dict[str, Any]:
+    encoded = {}
+    for name, values in columns.items():
+        if name in SCHEDULE_DATE_COLUMNS:
+            encoded[name] = array('l', [value.toordinal() for value in values])
+        elif name in NON_FLOAT_COLUMNS:
+            encoded[name] = values
+        else:
+            encoded[name] = array('d', values)
+    return encoded
+
+def decode_columns(encoded: Dict[str, Any]) -> Dict[str, list]:
+    columns = {}
+    for name, values in encoded.items():
+        if name in SCHEDULE_DATE_COLUMNS:
+            columns[name] = [date.fromordinal(value) for value in values]
+        else:
+            columns[name] = list(values)
+    return columns
+
+def _calculate_shard(shard: Tuple[List[Dict[str, Any]], List[Tuple[int, tuple]], str, Any]) -> Tuple[Dict[Any, Dict[str, Any]], Dict[str, Any]]:
+    """Worker: schedules of one shard of loans, encoded for the trip back, and the stages recorded for them."""
+    loans_raw, events_encoded, backend, fx_rates = shard
+    # A worker is forked with the parent's totals and reused across shards; report this shard only
+    INSTRUMENTATION.reset()
+    schedules = calculate_portfolio(loans_raw, [decode_event(event) for event in events_encoded], backend, fx_rates)
+    encoded = {loan_id: encode_columns(schedule_to_columns(schedule)) for loan_id, schedule in schedules.items()}
+    return encoded, INSTRUMENTATION.snapshot(include_profiles=False)
+
+def shard_loans(loans_raw: List[Dict[str, Any]],
+                events_by_loan: Dict[Any, List[Dict[str, Any]]],
+                shards_count: int) -> List[List[Dict[str, Any]]]:
+    """Longest-first assignment of loans to the shard with the fewest events so far."""
+    shards: List[List[Dict[str, Any]]] = [[] for _ in range(shards_count)]
+    heap = [(0, i) for i in range(shards_count)]
+    for loan_raw in sorted(loans_raw, key=lambda loan_raw: -len(events_by_loan.get(loan_raw['loan_id'], ()))):
+        events_count, i = heapq.heappop(heap)
+        shards[i].append(loan_raw)
+        heapq.heappush(heap, (events_count + len(events_by_loan.get(loan_raw['loan_id'], ())), i))
+    return [shard for shard in shards if shard]
+
+def calculate_portfolio_columns(loans_raw: Iterable[Dict[str, Any]],
+                                events_raw: Iterable[Dict[str, Any]],
+                                workers: Optional[int] = None,
+                                backend: str = 'decimal',
+                                fx_rates=None) -> Dict[Any, Dict[str, list]]:
+    '''
+    {loan_id: schedule_to_columns(schedule)} for every loan, computed by `workers` processes
+    (None: one per CPU). workers=1 runs serially in this process.
+    Raises ValueError for events referencing an unknown loan, like calculate_portfolio.
+    '''
+    loans_raw = list(loans_raw)
+    events_raw = list(events_raw)
+    if workers == 1:
+        schedules = calculate_portfolio(loans_raw, events_raw, backend, fx_rates)
+        return {loan_id: schedule_to_columns(schedule) for loan_id, schedule in schedules.items()}
+    events_by_loan = partition_events_by_loan(events_raw)
+    unknown_loan_ids = set(events_by_loan) - {loan_raw['loan_id'] for loan_raw in loans_raw}
+    if unknown_loan_ids:
+        raise ValueError(f"Loan with ID {sorted(map(str, unknown_loan_ids))[0]} not found.")
+    workers = workers or os.cpu_count() or 1
+    shards = shard_loans(loans_raw, events_by_loan, workers * SHARDS_PER_WORKER)
+    payloads = [(shard,
+                 [encode_event(event_raw) for loan_raw in shard for event_raw in events_by_loan.get(loan_raw['loan_id'], ())],
+                 backend, fx_rates)
+                for shard in shards]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results: Dict[Any, Dict[str, list]] = {}
+        for shard_result, shard_stages in executor.map(_calculate_shard, payloads):
+            results.update((loan_id, decode_columns(columns)) for loan_id, columns in shard_result.items())
+            INSTRUMENTATION.merge(shard_stages)
+    # Same key order as the serial path
+    return {loan_raw['loan_id']: results[loan_raw['loan_id']] for loan_raw in loans_raw}
@@ -0,0 +1,113 @@
+import anvil.google.auth, anvil.google.drive, anvil.google.mail
+from anvil.google.drive import app_files
+import anvil.facebook.auth
+import anvil.users
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+from datetime import datetime, timedelta
+import time
+from .Timeline import partition_events_by_loan
+from .CalcCore import LOAN_INFO_KEYS, calc_fetch_loan_info, fetch_events_raw
+from .ScheduleStore import store_loan_schedule
+
+# Portfolio recalculation runs as a background task so no form waits for it.
+# The task itself finds the loans whose schedule row is missing or stale, so launching it reads no
+# loans or schedules; fresh rows are left alone and a task with nothing to do completes right away.
+# Progress is published through anvil.server.task_state; clients poll the Task object.
+# task_state['status'] ends as 'completed', 'completed_with_errors' (failures lists the loans) or 'failed'.
+# Launches are serialized through a marker row in background_tasks, so two clients never start two tasks.
+
+RECALCULATION_CHUNK_SIZE = 50
+RECALCULATION_TASK = 'recalculate_portfolio'
+# Failed loans listed in task_state; the count covers all of them
+RECALCULATION_FAILURES_KEPT = 100
+# How long a caller waits for another caller's launch to record its task
+LAUNCH_WAIT_SECONDS = 10
+
+
+def loans_to_recalculate():
+  """Loan rows (with LOAN_INFO_KEYS) whose schedule row is missing or stale."""
+  fresh = {schedule_row['loan'].get_id()
+           for schedule_row in app_tables.loan_schedules.search(q.fetch_only('loan'), stale=False)}
+  return [loan for loan in app_tables.loans.search(q.fetch_only(*LOAN_INFO_KEYS)) if loan.get_id() not in fresh]
+
+@anvil.server.background_task
+def recalculate_portfolio(chunk_size=RECALCULATION_CHUNK_SIZE):
+  """Walk the loans to recalculate in chunks (one event query per table per chunk) and store their schedules."""
+  task_state = anvil.server.task_state
+  task_state['status'] = 'running'
+  try:
+    loans = loans_to_recalculate()
+    started = time.time()
+    task_state['total'] = len(loans)
+    task_state['done'] = 0
+    task_state['eta_seconds'] = None
+    task_state['failed'] = 0
+    task_state['failures'] = []
+    for chunk_start in range(0, len(loans), chunk_size):
+      chunk = loans[chunk_start:chunk_start + chunk_size]
+      events_by_loan = partition_events_by_loan(fetch_events_raw(chunk))
+      for loan, loan_raw in zip(chunk, calc_fetch_loan_info(chunk)):
+        try:
+          store_loan_schedule(loan, loan_raw, events_by_loan.get(loan_raw['loan_id'], []))
+        except Exception as e:
+          task_state['failed'] += 1
+          if len(task_state['failures']) < RECALCULATION_FAILURES_KEPT:
+            task_state['failures'] = task_state['failures'] + [{'loan_id': loan_raw['loan_id'], 'error': str(e)}]
+      done = chunk_start + len(chunk)
+      elapsed = time.time() - started
+      task_state['done'] = done
+      task_state['eta_seconds'] = round(elapsed / done * (len(loans) - done), 1)
+  except Exception as e:
+    task_state['status'] = 'failed'
+    task_state['error'] = str(e)
+    raise
+  task_state['status'] = 'completed_with_errors' if task_state['failed'] else 'completed'
+
+@tables.in_transaction
+def _claim_launch():
+  '''
+  ('running', task_id) if the task is running, ('pending', None) while another caller is launching it,
+  otherwise ('claimed', None): this caller launches and records the task.
+  '''
+  marker = app_tables.background_tasks.get(name=RECALCULATION_TASK)
+  if marker is None:
+    marker = app_tables.background_tasks.add_row(name=RECALCULATION_TASK)
+  if marker['task_id'] and anvil.server.get_background_task(marker['task_id']).is_running():
+    return 'running', marker['task_id']
+  if marker['task_id'] is None and marker['launched_on'] is not None \
+     and datetime.now() - marker['launched_on'] < timedelta(seconds=LAUNCH_WAIT_SECONDS):
+    return 'pending', None
+  marker.update(task_id=None, launched_on=datetime.now())
+  return 'claimed', None
+
+@anvil.server.callable
+def launch_portfolio_recalculation():
+  '''
+  Start a portfolio recalculation, or return the one already running.
+  None (idle) if another caller claimed the launch and gave it up without starting a task.
+  '''
+  state, task_id = _claim_launch()
+  if state == 'running':
+    return anvil.server.get_background_task(task_id)
+  if state == 'pending':
+    waited_until = time.time() + LAUNCH_WAIT_SECONDS
+    while time.time() < waited_until:
+      marker = app_tables.background_tasks.get(name=RECALCULATION_TASK)
+      if marker['task_id']:
+        return anvil.server.get_background_task(marker['task_id'])
+      if marker['launched_on'] is None:
+        return None
+      time.sleep(0.5)
+    return None
+  marker = app_tables.background_tasks.get(name=RECALCULATION_TASK)
+  try:
+    task = anvil.server.launch_background_task(RECALCULATION_TASK)
+  except Exception:
+    # Release the claim so waiting callers return instead of polling until LAUNCH_WAIT_SECONDS
+    marker['launched_on'] = None
+    raise
+  marker['task_id'] = task.get_id()
+  return task
@@ -0,0 +1,47 @@
+import anvil.google.auth, anvil.google.drive, anvil.google.mail
+from anvil.google.drive import app_files
+import anvil.facebook.auth
+import anvil.users
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+from .Timeline import build_loan, LoanSchedule, scenario_delta
+from .CalcCore import calc_fetch_loan_info, fetch_events_raw
+from .FxRateStore import fx_rate_index
+
+# What-if scenarios on a loan schedule.
+# Every call builds the baseline LoanSchedule of the loan once (with checkpoints) and answers all of its
+# questions from it: each question forks the baseline, so only the rows from the earliest hypothetical
+# change on are recomputed and the baseline itself is never modified. Nothing is written to the tables,
+# and nothing is kept between calls; ask related questions in one run_loan_scenarios call.
+
+
+def _scenario_events(loan_id, events, question_number):
+  return [{'event_id': f"scenario-{question_number}-{i}", **event, 'loan_id': loan_id}
+          for i, event in enumerate(events, start=1)]
+
+@anvil.server.callable
+def run_loan_scenarios(loan, scenarios):
+  '''
+  Schedule changes for each of several what-if questions on one loan, answered from a single baseline.
+  Every scenario is a dict with optional 'events' (hypothetical events to add) and 'deleted_event_ids', e.g.
+  [{'events': [{'event_fact_date': date(2025, 3, 15), 'principal_repayment_currency': 50000}]},
+   {'events': [{'event_fact_date': date(2025, 1, 1), 'interest_rate': 0.13}]}].
+  Returns Timeline.scenario_delta() against the current schedule per scenario, in order; stored data stays unchanged.
+  '''
+  if not app_tables.loans.has_row(loan):
+    raise Exception("Loan does not exist")
+  baseline = LoanSchedule(build_loan(calc_fetch_loan_info([loan])[0]), fetch_events_raw([loan]), fx_rates=fx_rate_index())
+  deltas = []
+  for question_number, question in enumerate(scenarios, start=1):
+    scenario = baseline.fork()
+    scenario.apply_changes(_scenario_events(baseline.loan.loan_id, question.get('events', ()), question_number),
+                           question.get('deleted_event_ids', ()))
+    deltas.append(scenario_delta(baseline, scenario))
+  return deltas
+
+@anvil.server.callable
+def run_loan_scenario(loan, events=(), deleted_event_ids=()):
+  """Schedule changes of one what-if question; see run_loan_scenarios for several questions on the same loan."""
+  return run_loan_scenarios(loan, [{'events': events, 'deleted_event_ids': deleted_event_ids}])[0]
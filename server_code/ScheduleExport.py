@@ -0,0 +1,112 @@
+'''
+Schedule export (CSV / XLSX) streamed row by row.
+
+Rows come from a generator that computes one loan at a time, so a loan's schedule is written
+out (and released) before the next loan is calculated; no DataFrame or full table is built.
+XLSX needs the xlsxwriter package (server_code/requirements.txt) and is written in its constant_memory mode.
+'''
+
+import csv
+import io
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Tuple
+
+from .Timeline import build_loan, calculate_schedule, partition_events_by_loan
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+EXPORT_COLUMNS = ('loan_id', 'event_fact_date', 'event_start_date', 'event_end_date', 'days_count',
+                  'principal_lending', 'capitalization', 'principal_repayment', 'principal_balance',
+                  'interest_rate', 'interest_rate_base', 'interest_accrued', 'interest_repayment',
+                  'interest_balance', 'event_ids')
+# CSV rows per yielded chunk
+EXPORT_CHUNK_ROWS = 1000
+# Rows per XLSX sheet (Excel limit 1,048,576 including the header)
+XLSX_SHEET_ROWS = 1000000
+
+
+def iter_schedule_rows(loans_raw: Iterable[Dict[str, Any]],
+                       events_raw: Iterable[Dict[str, Any]],
+                       backend: str = 'decimal',
+                       fx_rates=None) -> Iterator[Tuple]:
+    """Export rows (EXPORT_COLUMNS order), one loan's schedule computed at a time."""
+    events_by_loan = partition_events_by_loan(events_raw)
+    for loan_raw in loans_raw:
+        loan = build_loan(loan_raw)
+        for event in calculate_schedule(loan, events_by_loan.pop(loan.loan_id, []), backend, fx_rates):
+            yield (loan.loan_id,
+                   event.event_fact_date.date(),
+                   event.event_start_date.date(),
+                   event.event_end_date.date(),
+                   event.days_count,
+                   float(event.principal_lending),
+                   float(event.capitalization),
+                   float(event.principal_repayment),
+                   float(event.principal_balance),
+                   float(event.interest_rate),
+                   event.interest_rate_base,
+                   float(event.interest_accrued),
+                   float(event.interest_repayment),
+                   float(event.interest_balance),
+                   " ".join(str(event_id) for event_id in event.event_ids))
+
+def iter_csv_chunks(rows: Iterable[Tuple], chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[str]:
+    """CSV text in chunks of chunk_rows rows; the header goes out with the first chunk."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    buffered = 0
+    for row in rows:
+        writer.writerow(row)
+        buffered += 1
+        if buffered >= chunk_rows:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            buffered = 0
+    yield buffer.getvalue()
+
+def write_csv(rows: Iterable[Tuple], file: BinaryIO) -> int:
+    written = 0
+    for chunk in iter_csv_chunks(rows):
+        written += file.write(chunk.encode('utf-8'))
+    return written
+
+def write_xlsx(rows: Iterable[Tuple], file: BinaryIO) -> int:
+    """Rows written into sheets of XLSX_SHEET_ROWS rows each; returns the number of rows."""
+    if xlsxwriter is None:
+        raise RuntimeError("XLSX export needs the xlsxwriter package")
+    workbook = xlsxwriter.Workbook(file, {'constant_memory': True})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+    worksheet = None
+    sheet_row = XLSX_SHEET_ROWS
+    rows_count = 0
+    for row in rows:
+        if sheet_row >= XLSX_SHEET_ROWS:
+            worksheet = workbook.add_worksheet(f"Schedules {len(workbook.worksheets()) + 1}")
+            worksheet.write_row(0, 0, EXPORT_COLUMNS)
+            for column in (1, 2, 3):
+                worksheet.set_column(column, column, 12, date_format)
+            sheet_row = 0
+        sheet_row += 1
+        worksheet.write_row(sheet_row, 0, row)
+        rows_count += 1
+    if worksheet is None:
+        workbook.add_worksheet("Schedules 1").write_row(0, 0, EXPORT_COLUMNS)
+    workbook.close()
+    return rows_count
+
+def export_schedule_rows(rows: Iterable[Tuple], export_format: str, file: BinaryIO) -> None:
+    if export_format == 'csv':
+        write_csv(rows, file)
+    elif export_format == 'xlsx':
+        write_xlsx(rows, file)
+    else:
+        raise ValueError(f"Unknown export format {export_format!r}, expected one of {EXPORT_FORMATS}")
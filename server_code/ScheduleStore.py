@@ -0,0 +1,223 @@
+import anvil.google.auth, anvil.google.drive, anvil.google.mail
+from anvil.google.drive import app_files
+import anvil.facebook.auth
+import anvil.users
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+import anvil.server
+from datetime import datetime
+import hashlib
+from .Timeline import (build_loan, calculate_schedule, schedule_to_columns, schedule_version_hash,
+                       columns_to_simple_object, columns_from_simple_object, BalanceSnapshots, AccrualSegments,
+                       portfolio_totals, ScheduleIndex, balance_matrix)
+from .CalcCore import calc_fetch_loan_info, fetch_events_raw, instrumented_call
+from .Instrumentation import stage
+from .FxRateStore import fx_rate_index
+from .ChartData import CHART_TARGET_POINTS, loan_chart_payload, portfolio_chart_payload
+
+# Materialized schedules (loan_schedules table), one row per loan.
+# version_hash identifies the loan terms and events the stored schedule was computed from.
+# Loan and event write paths mark the row stale; a stale row is recomputed on the next read
+# only if the hash of the current terms, events and filled-in FX rates differs from version_hash.
+# snapshots (Timeline.BalanceSnapshots) are written with every schedule, so portfolio totals on a date
+# only read that column: one bisect and accrual top-up per loan.
+# segments (Timeline.AccrualSegments) are written alongside, so accrued interest over any interval is
+# two bisects on the stored segments, without rebuilding them from the snapshots.
+# charts holds downsampled chart payloads (ChartData) by target point count; it is cleared whenever
+# the schedule is recomputed, so a cached payload always belongs to the stored version_hash.
+# Portfolio chart payloads go to the portfolio_charts table, keyed by a digest of every schedule's version_hash.
+
+# Chart sizes cached per schedule row, and portfolio chart rows kept, oldest dropped first
+CHARTS_CACHED = 4
+
+
+def invalidate_loan_schedule(loan):
+  schedule_row = app_tables.loan_schedules.get(loan=loan)
+  if schedule_row is not None:
+    schedule_row['stale'] = True
+
+def delete_loan_schedule(loan):
+  schedule_row = app_tables.loan_schedules.get(loan=loan)
+  if schedule_row is not None:
+    schedule_row.delete()
+
+def materialize_loan_schedule(loan):
+  """Compute and store the schedule of a loan row unless the stored version is still current."""
+  return store_loan_schedule(loan, calc_fetch_loan_info([loan])[0], fetch_events_raw([loan]))
+
+@tables.in_transaction
+def _mark_schedule_current(loan, version_hash):
+  """The loan's schedule row marked fresh if it already holds version_hash, else None."""
+  schedule_row = app_tables.loan_schedules.get(loan=loan)
+  if schedule_row is not None and schedule_row['version_hash'] == version_hash \
+     and schedule_row['snapshots'] is not None and schedule_row['segments'] is not None:
+    schedule_row['stale'] = False
+    return schedule_row
+  return None
+
+@tables.in_transaction
+def _write_loan_schedule(loan, version_hash, columns):
+  """Get-or-create the loan's schedule row and store columns; one transaction, so concurrent writers never add two rows."""
+  schedule_row = app_tables.loan_schedules.get(loan=loan)
+  if schedule_row is None:
+    schedule_row = app_tables.loan_schedules.add_row(loan=loan)
+  snapshots = BalanceSnapshots.from_columns(columns)
+  schedule_row.update(version_hash=version_hash, schedule=columns_to_simple_object(columns),
+                      snapshots=snapshots.to_simple_object(),
+                      segments=AccrualSegments.from_snapshots(snapshots).to_simple_object(),
+                      charts=None, stale=False, computed_on=datetime.now())
+  return schedule_row
+
+def store_loan_schedule(loan, loan_raw, events_raw):
+  '''
+  Store the schedule computed from already fetched loan terms and events; skipped if version_hash matches.
+  The row is re-read inside each transaction rather than taken from the caller, and the schedule is computed
+  between the two so no transaction is held open while calculating.
+  '''
+  fx_rates = fx_rate_index()
+  version_hash = schedule_version_hash(loan_raw, events_raw, fx_rates)
+  schedule_row = _mark_schedule_current(loan, version_hash)
+  if schedule_row is not None:
+    return schedule_row
+  columns = schedule_to_columns(calculate_schedule(build_loan(loan_raw), events_raw, fx_rates=fx_rates))
+  return _write_loan_schedule(loan, version_hash, columns)
+
+def get_loan_schedule(loan):
+  """Stored schedule columns of a loan row; a single indexed fetch unless the row is missing or stale."""
+  schedule_row = app_tables.loan_schedules.get(loan=loan)
+  if schedule_row is None or schedule_row['stale']:
+    schedule_row = materialize_loan_schedule(loan)
+  return columns_from_simple_object(schedule_row['schedule'])
+
+@anvil.server.callable
+def fetch_loan_schedule(loan):
+  if not app_tables.loans.has_row(loan):
+    raise Exception("Loan does not exist")
+  return get_loan_schedule(loan)
+
+@anvil.server.callable
+def calc_balance_matrix(loan_ids, report_dates):
+  '''
+  Principal, interest and accrued interest for many loans x many report dates in one call.
+  Indexes the stored schedules (ScheduleIndex over their columns); only missing or stale ones are recomputed.
+  '''
+  with instrumented_call('calc_balance_matrix'):
+    with stage('fetch'):
+      loans = {loan['loan_id']: loan for loan in app_tables.loans.search(q.fetch_only('loan_id'), loan_id=q.any_of(*loan_ids))}
+      missing_loan_ids = [loan_id for loan_id in loan_ids if loan_id not in loans]
+      if missing_loan_ids:
+        raise Exception(f"Loan does not exist: {missing_loan_ids[0]}")
+      schedule_rows = {schedule_row['loan'].get_id(): schedule_row
+                       for schedule_row in app_tables.loan_schedules.search(q.fetch_only('loan', 'stale', 'schedule'),
+                                                                            loan=q.any_of(*loans.values()))}
+    indexes = {}
+    for loan_id, loan in loans.items():
+      schedule_row = schedule_rows.get(loan.get_id())
+      if schedule_row is None or schedule_row['stale']:
+        schedule_row = materialize_loan_schedule(loan)
+      indexes[loan_id] = ScheduleIndex(columns_from_simple_object(schedule_row['schedule']))
+    with stage('render'):
+      matrix = balance_matrix(indexes, loan_ids, report_dates)
+  return matrix
+
+def get_loan_accrual_segments(loan):
+  """AccrualSegments stored with the schedule of a loan row; recomputed first if missing or stale."""
+  schedule_row = app_tables.loan_schedules.get(loan=loan)
+  if schedule_row is None or schedule_row['stale'] or schedule_row['segments'] is None:
+    schedule_row = materialize_loan_schedule(loan)
+  return AccrualSegments.from_simple_object(schedule_row['segments'])
+
+@anvil.server.callable
+def fetch_accrued_interest(loan, from_date, to_date):
+  """Interest accrued from from_date (inclusive) to to_date (exclusive), e.g. for intra-month statements or payoff quotes."""
+  return fetch_accrued_interest_intervals(loan, [(from_date, to_date)])[0]
+
+@anvil.server.callable
+def fetch_accrued_interest_intervals(loan, intervals):
+  """Interest accrued over each (from_date, to_date) interval; the stored segments are read once for all of them."""
+  if not app_tables.loans.has_row(loan):
+    raise Exception("Loan does not exist")
+  segments = get_loan_accrual_segments(loan)
+  return [segments.accrued(from_date, to_date) for from_date, to_date in intervals]
+
+def get_portfolio_snapshots():
+  """BalanceSnapshots of every loan; missing or stale ones are recomputed first."""
+  schedule_rows = {schedule_row['loan'].get_id(): schedule_row
+                   for schedule_row in app_tables.loan_schedules.search(q.fetch_only('loan', 'stale', 'snapshots'))}
+  snapshots = []
+  for loan in app_tables.loans.search(q.fetch_only('loan_id')):
+    schedule_row = schedule_rows.get(loan.get_id())
+    if schedule_row is None or schedule_row['stale'] or schedule_row['snapshots'] is None:
+      schedule_row = materialize_loan_schedule(loan)
+    snapshots.append(BalanceSnapshots.from_simple_object(schedule_row['snapshots']))
+  return snapshots
+
+@anvil.server.callable
+def fetch_portfolio_totals(report_date):
+  """Principal, interest balance and accrued interest of all loans as of the end of report_date."""
+  return portfolio_totals(get_portfolio_snapshots(), report_date)
+
+def _cache_chart(charts, key, payload):
+  charts = dict(charts or {})
+  charts.pop(key, None)
+  charts[key] = payload
+  while len(charts) > CHARTS_CACHED:
+    charts.pop(next(iter(charts)))
+  return charts
+
+def get_loan_chart(loan, target_points=CHART_TARGET_POINTS):
+  """Downsampled chart payload of a loan row, computed once per schedule version and target size."""
+  schedule_row = app_tables.loan_schedules.get(loan=loan)
+  if schedule_row is None or schedule_row['stale']:
+    schedule_row = materialize_loan_schedule(loan)
+  key = str(target_points)
+  charts = schedule_row['charts'] or {}
+  if key not in charts:
+    payload = loan_chart_payload(columns_from_simple_object(schedule_row['schedule']), target_points)
+    schedule_row['charts'] = _cache_chart(charts, key, payload)
+    return payload
+  return charts[key]
+
+@anvil.server.callable
+def fetch_loan_chart(loan, target_points=CHART_TARGET_POINTS):
+  if not app_tables.loans.has_row(loan):
+    raise Exception("Loan does not exist")
+  return get_loan_chart(loan, target_points)
+
+@tables.in_transaction
+def _store_portfolio_chart(version_digest, target_points, payload):
+  """Add the payload unless a concurrent call already did, keeping the CHARTS_CACHED most recent rows."""
+  if app_tables.portfolio_charts.get(version_digest=version_digest, target_points=target_points) is None:
+    app_tables.portfolio_charts.add_row(version_digest=version_digest, target_points=target_points,
+                                        payload=payload, computed_on=datetime.now())
+  chart_rows = app_tables.portfolio_charts.search(q.fetch_only('computed_on'), tables.order_by('computed_on', ascending=False))
+  for chart_row in list(chart_rows)[CHARTS_CACHED:]:
+    chart_row.delete()
+
+@anvil.server.callable
+def fetch_portfolio_chart(target_points=CHART_TARGET_POINTS):
+  '''
+  Downsampled chart payload of the balances summed over all loans.
+  Stored in portfolio_charts by a digest of the version hashes of all schedules, so it is rebuilt only after a schedule changes;
+  a stored payload costs one read of the version hashes.
+  '''
+  schedule_rows = {schedule_row['loan'].get_id(): schedule_row
+                   for schedule_row in app_tables.loan_schedules.search(q.fetch_only('loan', 'stale', 'version_hash'))}
+  current_rows = []
+  for loan in app_tables.loans.search(q.fetch_only('loan_id')):
+    schedule_row = schedule_rows.get(loan.get_id())
+    if schedule_row is None or schedule_row['stale']:
+      schedule_row = materialize_loan_schedule(loan)
+    current_rows.append(schedule_row)
+  digest = hashlib.sha256()
+  for version_hash in sorted(schedule_row['version_hash'] for schedule_row in current_rows):
+    digest.update(version_hash.encode('utf-8'))
+  version_digest = digest.hexdigest()
+  chart_row = app_tables.portfolio_charts.get(version_digest=version_digest, target_points=target_points)
+  if chart_row is not None:
+    return chart_row['payload']
+  payload = portfolio_chart_payload([columns_from_simple_object(schedule_row['schedule']) for schedule_row in current_rows],
+                                    target_points)
+  _store_portfolio_chart(version_digest, target_points, payload)
+  return payload
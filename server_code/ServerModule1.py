@@ -8,6 +8,8 @@ from anvil.tables import app_tables
 import anvil.server
 from datetime import datetime, timedelta
 from uuid import uuid4
+import hashlib
+from .ScheduleStore import invalidate_loan_schedule, delete_loan_schedule
 
 
 # This is a server module. It runs on the Anvil server,
@@ -26,7 +28,11 @@ from uuid import uuid4
 @anvil.server.callable
 def delete_loan(loan):
   if app_tables.loans.has_row(loan):
+    loan_id = loan['loan_id']
+    delete_loan_schedule(loan)
     loan.delete()
+    # Tombstone for the client's loans list
+    return {'loan_id': loan_id, 'deleted': True}
   else:
     raise Exception("Loan does not exist")
     
@@ -35,20 +41,98 @@ def update_loan(loan, edited_loan):
   if app_tables.loans.has_row(loan):
     edited_loan['updated'] = datetime.now()
     loan.update(**edited_loan)
+    invalidate_loan_schedule(loan)
+    return _loans_list_item(loan)
   else:
     raise Exception("Loan does not exist")
 
 @anvil.server.callable
 def add_loan(new_loan):
-  app_tables.loans.add_row(
+  loan = app_tables.loans.add_row(
     loan_id=str(str(uuid4())),
     created_on = datetime.now(),
     **new_loan)
+  return _loans_list_item(loan)
+
+# Event tables by the event_type used in CalcCore
+EVENT_TABLES = {
+  'Interest rate': app_tables.interest_rates,
+  'Lending': app_tables.principal_lendings,
+  'Repayment': app_tables.repayments,
+}
+
+@anvil.server.callable
+def add_loan_event(loan, event_type, event):
+  if not app_tables.loans.has_row(loan):
+    raise Exception("Loan does not exist")
+  event_row = EVENT_TABLES[event_type].add_row(loan=loan, event_id=str(uuid4()), **event)
+  invalidate_loan_schedule(loan)
+  return event_row
+
+@anvil.server.callable
+def update_loan_event(event_type, event_row, edited_event):
+  if EVENT_TABLES[event_type].has_row(event_row):
+    previous_loan = event_row['loan']
+    event_row.update(**edited_event)
+    invalidate_loan_schedule(event_row['loan'])
+    # The edit may have moved the event to another loan
+    if previous_loan is not None and previous_loan != event_row['loan']:
+      invalidate_loan_schedule(previous_loan)
+  else:
+    raise Exception("Event does not exist")
+
+@anvil.server.callable
+def delete_loan_event(event_type, event_row):
+  if EVENT_TABLES[event_type].has_row(event_row):
+    loan = event_row['loan']
+    event_row.delete()
+    invalidate_loan_schedule(loan)
+  else:
+    raise Exception("Event does not exist")
 
 @anvil.server.callable
 def fetch_loans_info():
   return app_tables.loans.search()
 
+# Loans list (Forms.LoanView): only rendered columns, lender/borrower names resolved in the same query.
+# add_loan/update_loan return a changed item in this form so the client can patch its list.
+LOANS_PAGE_SIZE = 50
+# Largest page a client may ask for
+LOANS_MAX_PAGE_SIZE = 200
+LOANS_SORT_COLUMNS = ['created_on', 'contract_start_date', 'credentials', 'updated']
+
+def _loans_list_item(loan):
+  return {
+    'loan': loan,
+    'loan_id': loan['loan_id'],
+    'credentials': loan['credentials'],
+    'contract_start_date': loan['contract_start_date'],
+    'lender_name': loan['lender']['company_name'] if loan['lender'] else None,
+    'borrower_name': loan['borrower']['company_name'] if loan['borrower'] else None,
+  }
+
+@anvil.server.callable
+def fetch_loans_page(page_token=None, page_size=LOANS_PAGE_SIZE, sort_by='created_on', ascending=False):
+  """One page of the loans list; reference_data_version is stamped on the first page only (None on later pages)."""
+  if sort_by not in LOANS_SORT_COLUMNS:
+    raise Exception(f"Cannot sort loans by {sort_by}")
+  offset = int(page_token or 0)
+  page_size = max(1, min(int(page_size), LOANS_MAX_PAGE_SIZE))
+  loans = app_tables.loans.search(
+    q.fetch_only('loan_id', 'credentials', 'contract_start_date',
+                 lender=q.fetch_only('company_name'), borrower=q.fetch_only('company_name')),
+    tables.order_by(sort_by, ascending=ascending))
+  # One extra row tells whether there is a next page
+  page = list(loans[offset:offset + page_size + 1])
+  next_page_token = str(offset + page_size) if len(page) > page_size else None
+  reference_data_version = None
+  if page_token is None:
+    companies = app_tables.companies.search(q.fetch_only('company_name', 'edited_on'), tables.order_by('company_name'))
+    reference_data_version = _reference_data_version(companies)
+  return {'items': [_loans_list_item(loan) for loan in page[:page_size]],
+          'next_page_token': next_page_token,
+          'reference_data_version': reference_data_version}
+
 @anvil.server.callable
 def fetch_companies_dropdown():
   return [(company['company_name'], company) for company in app_tables.companies.search()]
@@ -60,20 +144,49 @@ def fetch_companies():
 @anvil.server.callable
 def fetch_user_info():
   user_info_keys= ['email', 'signed_up']
-  user_info = {key: dict(anvil.users.get_user())[key] for key in user_info_keys}
+  current_user = anvil.users.get_user()
+  user_info = {key: current_user[key] for key in user_info_keys}
   user_info['signed_up'] = user_info['signed_up'].date().strftime('%Y-%m-%d')
   return user_info
 
 @anvil.server.callable
-def fetch_subscriptions():
+def fetch_session_bootstrap():
+  '''
+  User info, subscriptions and their loans/companies counts for the landing page in one response.
+  Subscriptions are read from the table (refreshing the session cache), since their counts change outside this app.
+  '''
+  subscriptions = fetch_subscriptions(refresh=True)
+  return {
+    'user': fetch_user_info(),
+    'subscriptions': subscriptions,
+    'counts': {
+      'loans_count': sum(subscription['loans_count'] or 0 for subscription in subscriptions),
+      'companies_count': sum(subscription['companies_count'] or 0 for subscription in subscriptions),
+    },
+  }
+
+# Subscription columns sent to the client (Start, MainLayout_Rails.Subscriptions)
+SUBSCRIPTION_COLUMNS = ['uuid', 'loan_bank_name', 'created_on', 'expiry_date', 'tarif', 'loans_count', 'companies_count']
+
+def _subscription_item(subscription):
+  item = {key: subscription[key] for key in SUBSCRIPTION_COLUMNS}
+  if item['created_on']:
+    item['created_on'] = item['created_on'].date()
+  return item
+
+@anvil.server.callable
+def fetch_subscriptions(refresh=False):
+  """Subscriptions of the current user; linked rows resolved in one query and cached in the session (refresh re-reads them)."""
   current_user = anvil.users.get_user()
-  subscription = [dict(r) for r in app_tables.subscription_admin.search(user=current_user)]
-  subscriptions = [ ] 
-  for s in subscription:
-    sub_copy = dict(s.get('subscription')).copy()
-    if 'created_on' in sub_copy and isinstance(sub_copy['created_on'], datetime):
-      sub_copy['created_on'] = sub_copy['created_on'].strftime('%Y-%m-%d')
-    subscriptions.append(sub_copy)
+  if current_user is None:
+    return []
+  cached = anvil.server.session.get('subscriptions')
+  if not refresh and cached is not None and cached['user_id'] == current_user.get_id():
+    return cached['items']
+  subscription_admins = app_tables.subscription_admin.search(
+    q.fetch_only(subscription=q.fetch_only(*SUBSCRIPTION_COLUMNS)), user=current_user)
+  subscriptions = [_subscription_item(r['subscription']) for r in subscription_admins if r['subscription']]
+  anvil.server.session['subscriptions'] = {'user_id': current_user.get_id(), 'items': subscriptions}
   return subscriptions
   
 @anvil.server.callable
@@ -82,7 +195,26 @@ def add_subscrition(Loan_DB_name):
     created_on=datetime.now(),
     Loan_DB_profile_name=Loan_DB_name
   )
+  anvil.server.session.pop('subscriptions', None)
   
+def _reference_data_version(companies):
+  """Changes whenever a company is added, renamed, edited or removed, or the static lists change."""
+  stamp = [(company.get_id(), company['company_name'], str(company['edited_on'])) for company in companies]
+  stamp.append((get_interest_rate_bases(), get_currency_ticker()))
+  return hashlib.sha256(repr(stamp).encode('utf-8')).hexdigest()
+
+@anvil.server.callable
+def fetch_reference_data():
+  """Everything Forms.LoanEdit needs for its dropdowns, with a version stamp for client-side caching."""
+  companies = list(app_tables.companies.search(q.fetch_only('company_name', 'edited_on'),
+                                               tables.order_by('company_name')))
+  return {
+    'version': _reference_data_version(companies),
+    'companies': [(company['company_name'], company) for company in companies],
+    'interest_rate_bases': get_interest_rate_bases(),
+    'currency_tickers': get_currency_ticker(),
+  }
+
 @anvil.server.callable
 def get_interest_rate_bases():
   interest_rate_bases =['360', '365', 'calendar']
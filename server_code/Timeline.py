@@ -0,0 +1,918 @@
+'''
+Loan schedule engine.
+
+Callable version of the 20250209_sandbox_timeline.py pipeline:
+raw events -> Event -> aggregated by start date -> generated calendar dates -> balances & interest.
+Works for any number of loans in one run; events are partitioned by loan_id in a single pass.
+'''
+
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Union, Literal, Iterable, Any, Tuple, Set
+from datetime import datetime, date, timedelta
+from collections import defaultdict
+from bisect import bisect_left, bisect_right, insort
+from decimal import Decimal, localcontext
+import calendar
+import copy
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+
+from . import NumpyAccrual
+from .Instrumentation import stage, count
+
+
+# Precision of the accrual loop. Applied through a local context so the engine
+# does not change the process-wide Decimal context of other server modules.
+DECIMAL_PRECISION = 28
+# Accrual implementations selectable per call: the Decimal loop, or the NumPy kernel run on the same rows.
+# 'numpy' cross-checks NumpyAccrual against the Decimal loop; converting every row to arrays and back
+# makes it slower than 'decimal', so portfolio runs that want the kernel's speed use EventBatch instead.
+ACCRUAL_BACKENDS = ('decimal', 'numpy')
+# Day numbers of the NumPy kernel count from 1970-01-01 (datetime64[D])
+UNIX_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# Date columns of schedule_to_columns(); stored as ISO strings in simpleObject columns
+SCHEDULE_DATE_COLUMNS = ('event_fact_date', 'event_start_date', 'event_end_date')
+
+# ==============================
+# 1. Data Classes
+# ==============================
+# Slotted: a portfolio run holds one AggregatedEvent per timeline row (millions for large books),
+# so rows carry no per-instance __dict__.
+@dataclass(slots=True)
+class Loan:
+    loan_id: Any
+    base_currency: str
+    interest_rate_base: Union[Literal[360, 365], Literal['calendar']] = 365
+    lending_date_exclusive_counting: bool = False
+    repayment_date_exclusive_counting: bool = True
+    capitalization: bool = False
+
+@dataclass(frozen=True, slots=True)
+class Currency:
+    currency_amount: Decimal
+    ticker: str
+    currency_to_loan_rate: Decimal = Decimal('1.0')  # Conversion rate to loan currency
+    def converted_amount(self) -> Decimal:
+        return self.currency_amount * self.currency_to_loan_rate
+
+# Shared currency detail of rows without an event amount (generated dates, aggregated rows)
+ZERO_CURRENCY = Currency(currency_amount=Decimal('0.0'), ticker=None, currency_to_loan_rate=None)
+
+@dataclass(slots=True)
+class Event:
+    '''
+    Populated with None values for safety reasons.
+    Default values are overwritten by build_event (None or input for each event);
+    Currency detail is only allocated for amounts the raw event actually has.
+    '''
+    loan: Optional[Loan] = None
+    event_fact_date: Optional[datetime] = None
+    event_start_date: Optional[datetime] = None
+    event_id: Optional[Any] = None
+    principal_lending_currency: Optional[Currency] = None
+    principal_lending: Optional[Decimal] = None
+    capitalization: Decimal = None
+    interest_rate: Optional[Decimal] = None
+    interest_rate_base: Decimal = None
+
+    principal_repayment_currency: Optional[Currency] = None
+    principal_repayment: Optional[Decimal] = None
+    interest_repayment_currency: Optional[Currency] = None
+    interest_repayment: Optional[Decimal] = None
+
+    principal_balance_correction: Optional[Decimal] = None
+    interest_balance_correction: Optional[Decimal] = None
+
+@dataclass(slots=True)
+class AggregatedEvent:
+    '''
+    Default values are Decimal('0.0') so aggregation only has to add provided values.
+    Avoids NoneType errors when performing balance calculations.
+    Currency detail defaults to the immutable ZERO_CURRENCY sentinel instead of three new objects per row.
+    '''
+    loan: Loan
+    event_fact_date: datetime
+    event_start_date: Optional[datetime]
+    event_end_date: Optional[datetime] = None
+    days_count: int = 0
+    event_ids: List[Any] = field(default_factory=list)
+    principal_lending_currency: Currency = ZERO_CURRENCY
+    principal_lending: Decimal = Decimal('0.0')
+    capitalization: Decimal = Decimal('0.0')
+    interest_rate: Decimal = Decimal('0.0')
+    interest_rate_base: Decimal = None
+
+    principal_repayment_currency: Currency = ZERO_CURRENCY
+    principal_repayment: Decimal = Decimal('0.0')
+    interest_repayment_currency: Currency = ZERO_CURRENCY
+    interest_repayment: Decimal = Decimal('0.0')
+
+    principal_balance_correction: Decimal = Decimal('0.0')
+    interest_balance_correction: Decimal = Decimal('0.0')
+    principal_balance: Decimal = Decimal('0.0')
+    interest_accrued: Decimal  = Decimal('0.0')
+    interest_balance: Decimal  = Decimal ('0.0')
+
+@dataclass(slots=True)
+class Checkpoint:
+    '''
+    Accrual state just before the timeline row starting on a period boundary (MS date).
+    Enough to restart the balance loop from that row without replaying the history.
+    '''
+    event_start_date: datetime
+    row_index: int
+    principal_balance: Decimal = Decimal('0.0')
+    interest_balance: Decimal = Decimal('0.0')
+    interest_rate: Decimal = Decimal('0.0')
+
+# ==============================
+# 2. Input normalization (Loans, Events)
+# ==============================
+def to_datetime(value: Union[str, date, datetime]) -> datetime:
+    """Normalize 'YYYY-MM-DD' strings, dates and datetimes to a datetime."""
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return datetime.strptime(value, "%Y-%m-%d")
+
+def to_decimal(value: Any) -> Decimal:
+    """Floats go through str() so 0.06 stays 0.06 and not 0.0599999999999999977795..."""
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+def build_loan(loan_raw: Dict[str, Any]) -> Loan:
+    """Build a Loan from a loans table row (dict) or a sample dict, ignoring unrelated columns."""
+    interest_rate_base = loan_raw.get('interest_rate_base') or 365
+    if interest_rate_base != 'calendar':
+        interest_rate_base = int(interest_rate_base)
+    def flag(key: str, default: bool) -> bool:
+        value = loan_raw.get(key)
+        return default if value is None else bool(value)
+    return Loan(
+        loan_id=loan_raw['loan_id'],
+        base_currency=loan_raw.get('base_currency'),
+        interest_rate_base=interest_rate_base,
+        lending_date_exclusive_counting=flag('lending_date_exclusive_counting', False),
+        repayment_date_exclusive_counting=flag('repayment_date_exclusive_counting', True),
+        capitalization=flag('capitalization', False))
+
+def _convert_currency(loan: Loan, event_raw: Dict[str, Any], amount_key: str, fx_rates=None) -> Tuple[Currency, Decimal]:
+    '''
+    Returns the event amount in event currency and converted to loan currency.
+    A missing currency_to_loan_rate is looked up in fx_rates (FxRates.FxRateIndex) as of the event date.
+    '''
+    currency_ticker = event_raw.get("currency", loan.base_currency)  # Event currency
+    currency_rate = event_raw.get("currency_to_loan_rate", None)  # Fetch conversion rate
+    # Without a loan currency there is nothing to look up; the missing rate is reported below
+    if currency_ticker != loan.base_currency and currency_rate is None and fx_rates is not None and loan.base_currency is not None:
+        currency_rate = fx_rates.rate(currency_ticker, loan.base_currency, event_raw["event_fact_date"])
+    # If currencies are different but no conversion rate is provided, raise an error
+    if currency_ticker != loan.base_currency and currency_rate is None:
+        raise ValueError(
+            f"Missing currency conversion rate for Event ID {event_raw['event_id']}: "
+            f"{currency_ticker} → {loan.base_currency}"
+        )
+    # Default to 1.0 if same currency
+    currency_rate = to_decimal(currency_rate) if currency_rate is not None else Decimal('1.0')
+    amount_currency = Currency(
+        currency_amount=to_decimal(event_raw[amount_key]),
+        ticker=currency_ticker,
+        currency_to_loan_rate=currency_rate
+    )
+    # Convert amount if necessary
+    amount = (
+        amount_currency.converted_amount()
+        if currency_ticker != loan.base_currency
+        else amount_currency.currency_amount
+    )
+    return amount_currency, amount
+
+def build_event(loan: Loan, event_raw: Dict[str, Any], fx_rates=None) -> Event:
+    """Convert one raw event dict into an `Event` with Currency attributes."""
+    event_fact_date = to_datetime(event_raw["event_fact_date"])
+    event_start_date = event_fact_date
+    event = Event(event_id=event_raw["event_id"], event_fact_date=event_fact_date, loan=loan)
+
+    if "principal_lending_currency" in event_raw:
+        event.principal_lending_currency, event.principal_lending = _convert_currency(loan, event_raw, "principal_lending_currency", fx_rates)
+        if loan.lending_date_exclusive_counting == True:
+            event_start_date += timedelta(days=1)
+        else:
+            event_start_date = event_fact_date
+    if "principal_repayment_currency" in event_raw:
+        event.principal_repayment_currency, event.principal_repayment = _convert_currency(loan, event_raw, "principal_repayment_currency", fx_rates)
+        if loan.repayment_date_exclusive_counting == True:
+            event_start_date += timedelta(days=1)
+        else:
+            event_start_date = event_fact_date
+    if "interest_repayment_currency" in event_raw:
+        event.interest_repayment_currency, event.interest_repayment = _convert_currency(loan, event_raw, "interest_repayment_currency", fx_rates)
+        if loan.repayment_date_exclusive_counting == True:
+            event_start_date += timedelta(days=1)
+        else:
+            event_start_date = event_fact_date
+
+    if "capitalization" in event_raw:
+        event.capitalization = to_decimal(event_raw["capitalization"])
+    if "interest_rate" in event_raw:
+        event.interest_rate = to_decimal(event_raw["interest_rate"])
+    if "principal_balance_correction" in event_raw:
+        event.principal_balance_correction = to_decimal(event_raw["principal_balance_correction"])
+    if "interest_balance_correction" in event_raw:
+        event.interest_balance_correction = to_decimal(event_raw["interest_balance_correction"])
+    event.event_start_date = event_start_date
+    return event
+
+def build_events(loan: Loan, events_raw: Iterable[Dict[str, Any]], fx_rates=None) -> List[Event]:
+    """Build and sort a loan's events by event_start_date and event_id."""
+    events_list = [build_event(loan, event_raw, fx_rates) for event_raw in events_raw]
+    return sorted(events_list, key=lambda e: (e.event_start_date, e.event_id))
+
+def partition_events_by_loan(events_raw: Iterable[Dict[str, Any]]) -> Dict[Any, List[Dict[str, Any]]]:
+    """Group raw events by loan_id in a single pass over the event list."""
+    events_by_loan: Dict[Any, List[Dict[str, Any]]] = defaultdict(list)
+    for event_raw in events_raw:
+        events_by_loan[event_raw.get("loan_id")].append(event_raw)
+    return events_by_loan
+
+# ==============================
+# 3. Aggregate Events by Date
+# ==============================
+def aggregate_events(loan: Loan, events_sorted: Iterable[Event]) -> Dict[datetime, AggregatedEvent]:
+    '''
+    Sum existing values for each event_start_date.
+    Keep default values from AggregatedEvent if event does not have a value (None).
+    '''
+    aggregated_events: Dict[datetime, AggregatedEvent] = defaultdict(lambda: AggregatedEvent(loan=loan,
+                                                                                            event_fact_date=None,
+                                                                                            event_start_date=None))
+    for event in events_sorted:
+        date_key = event.event_start_date
+        aggregated_event = aggregated_events[date_key]
+        if aggregated_event.event_start_date is None:
+            aggregated_event.event_start_date = event.event_start_date
+        if aggregated_event.event_fact_date is None:
+            aggregated_event.event_fact_date = event.event_fact_date
+        if event.principal_lending:
+            aggregated_event.principal_lending += event.principal_lending
+        if event.principal_repayment:
+            aggregated_event.principal_repayment += event.principal_repayment
+        if event.interest_repayment:
+            aggregated_event.interest_repayment += event.interest_repayment
+        # Other fields are assumed to be in base currency
+        if event.capitalization:
+            aggregated_event.capitalization += event.capitalization
+        if event.interest_rate:
+            aggregated_event.interest_rate = event.interest_rate
+        if event.principal_balance_correction:
+            aggregated_event.principal_balance_correction += event.principal_balance_correction
+        if event.interest_balance_correction:
+            aggregated_event.interest_balance_correction += event.interest_balance_correction
+        aggregated_event.event_ids.append(event.event_id)
+    return dict(aggregated_events)
+
+# ==============================
+# 4. Generate Dates
+# ==============================
+def generate_date_list(dates_generator_range_start: Union[str, datetime],
+                      dates_generator_range_end: Union[str, datetime],
+                      dates_generator_frequency: str) -> List[datetime]:
+    """Generate a list of datetime objects at a given frequency."""
+    return pd.date_range(start=dates_generator_range_start,
+                        end=dates_generator_range_end,
+                        freq=dates_generator_frequency,
+                        inclusive='left').to_pydatetime().tolist()
+
+def add_generated_dates(loan: Loan,
+                        aggregated_events: Dict[datetime, AggregatedEvent],
+                        dates_generator_range_start: Optional[datetime] = None,
+                        dates_generator_range_end: Optional[datetime] = None) -> Set[datetime]:
+    '''
+    Add capitalization (QS), year switch (YS, calendar base only) and reporting (MS) dates to aggregated_events.
+    Returns the capitalization dates (empty if the loan does not capitalize interest).
+    Dates already carrying events are kept as they are.
+    The range defaults to the entire timeline; LoanSchedule passes a tail range.
+    '''
+    if dates_generator_range_start is None:
+        dates_generator_range_start = min(aggregated_events.keys())
+    if dates_generator_range_end is None:
+        dates_generator_range_end = max(aggregated_events.keys()) + timedelta(days=31)
+    frequencies = ["MS"]
+    capitalization_generated_dates: Set[datetime] = set()
+    if loan.capitalization == True:
+        capitalization_generated_dates = set(generate_date_list(dates_generator_range_start,
+                                                                dates_generator_range_end,
+                                                                "QS"))
+    if loan.interest_rate_base == 'calendar':
+        frequencies.append("YS")
+    generated_dates = set(capitalization_generated_dates)
+    for frequency in frequencies:
+        generated_dates.update(generate_date_list(dates_generator_range_start,
+                                                  dates_generator_range_end,
+                                                  frequency))
+    for generated_date in generated_dates:
+        if generated_date not in aggregated_events:
+            aggregated_events[generated_date] = AggregatedEvent(loan=loan,
+                                                                event_fact_date=generated_date,
+                                                                event_start_date=generated_date)
+    return capitalization_generated_dates
+
+# ==============================
+# 5. Calculate Principal Balances, Days Count & Interest
+# ==============================
+def interest_rate_base_for(loan: Loan, event_start_date: datetime) -> int:
+    """Days count base of the period starting on event_start_date."""
+    if loan.interest_rate_base == 'calendar':
+        return 366 if calendar.isleap(event_start_date.year) else 365
+    return loan.interest_rate_base
+
+def calculate_balances(loan: Loan,
+                       events_list_date_aggregated_sorted: List[AggregatedEvent],
+                       capitalization_generated_dates: Set[datetime],
+                       checkpoint: Optional[Checkpoint] = None) -> None:
+    """Fill balances, days count and interest of the sorted timeline in place, starting from checkpoint state if given."""
+    checkpoint = checkpoint or Checkpoint(event_start_date=None, row_index=0)
+    principal_balance = checkpoint.principal_balance
+    interest_balance = checkpoint.interest_balance
+    current_interest_rate = checkpoint.interest_rate  # Default interest rate
+    last_index = len(events_list_date_aggregated_sorted) - 1
+
+    with localcontext() as ctx:
+        ctx.prec = DECIMAL_PRECISION
+        for i, event in enumerate(events_list_date_aggregated_sorted):
+            # Update current_interest_rate if there's a rate change on this date
+            if event.interest_rate > 0:
+                current_interest_rate = event.interest_rate
+            event.interest_rate = current_interest_rate
+
+            if event.event_start_date in capitalization_generated_dates:
+                event.capitalization = interest_balance
+            # Update principal balance
+            principal_balance += (
+                event.principal_lending +
+                event.capitalization -
+                event.principal_repayment +
+                event.principal_balance_correction
+            )
+            event.principal_balance = principal_balance
+
+            # Days until the next timeline row; last row has no next date
+            if i < last_index:
+                event.days_count = (events_list_date_aggregated_sorted[i + 1].event_start_date - event.event_start_date).days
+            else:
+                event.days_count = 0
+            if i < last_index and event.days_count > 1:
+                event.event_end_date = event.event_start_date + timedelta(event.days_count - 1)
+            else:
+                event.event_end_date = event.event_start_date
+
+            # Calculate interest accrued
+            interest_rate_base = interest_rate_base_for(loan, event.event_start_date)
+            event.interest_accrued = (current_interest_rate / interest_rate_base) * event.days_count * principal_balance
+            event.interest_rate_base = interest_rate_base
+            # Update interest balance
+            interest_balance += (
+                event.interest_accrued -
+                event.capitalization -
+                event.interest_repayment +
+                event.interest_balance_correction
+            )
+            event.interest_balance = interest_balance
+
+def calculate_balances_numpy(loan: Loan,
+                             events_list_date_aggregated_sorted: List[AggregatedEvent],
+                             capitalization_generated_dates: Set[datetime],
+                             checkpoint: Optional[Checkpoint] = None) -> None:
+    """Same results as calculate_balances (within float precision), computed by the NumPy kernel; a cross-check, not a fast path."""
+    rows = events_list_date_aggregated_sorted
+    if not rows:
+        return
+    checkpoint = checkpoint or Checkpoint(event_start_date=None, row_index=0)
+    def column(name: str) -> np.ndarray:
+        return np.array([float(getattr(event, name)) for event in rows], dtype=np.float64)
+    start_dates = [event.event_start_date for event in rows]
+    result = NumpyAccrual.accrue(
+        start_days=np.array([start_date.toordinal() for start_date in start_dates], dtype=np.int64) - UNIX_EPOCH_ORDINAL,
+        principal_lending=column('principal_lending'),
+        capitalization=column('capitalization'),
+        principal_repayment=column('principal_repayment'),
+        principal_balance_correction=column('principal_balance_correction'),
+        interest_rate=column('interest_rate'),
+        interest_repayment=column('interest_repayment'),
+        interest_balance_correction=column('interest_balance_correction'),
+        interest_rate_base=loan.interest_rate_base,
+        capitalization_mask=np.array([start_date in capitalization_generated_dates for start_date in start_dates], dtype=bool),
+        initial_principal_balance=float(checkpoint.principal_balance),
+        initial_interest_balance=float(checkpoint.interest_balance),
+        initial_interest_rate=float(checkpoint.interest_rate))
+    columns = zip(result['days_count'].tolist(), result['interest_rate'].tolist(), result['interest_rate_base'].tolist(),
+                  result['capitalization'].tolist(), result['principal_balance'].tolist(),
+                  result['interest_accrued'].tolist(), result['interest_balance'].tolist())
+    for event, (days_count, interest_rate, interest_rate_base, capitalization,
+                principal_balance, interest_accrued, interest_balance) in zip(rows, columns):
+        event.days_count = days_count
+        event.event_end_date = event.event_start_date + timedelta(days_count - 1) if days_count > 1 else event.event_start_date
+        # Through str(), like to_decimal, so a 0.06 rate stays 0.06 rather than its binary expansion
+        event.interest_rate = to_decimal(interest_rate)
+        event.interest_rate_base = interest_rate_base
+        event.capitalization = to_decimal(capitalization)
+        event.principal_balance = to_decimal(principal_balance)
+        event.interest_accrued = to_decimal(interest_accrued)
+        event.interest_balance = to_decimal(interest_balance)
+
+BALANCE_CALCULATORS = {'decimal': calculate_balances, 'numpy': calculate_balances_numpy}
+
+# ==============================
+# 6. Schedules: single loan and portfolio
+# ==============================
+def calculate_schedule(loan: Loan,
+                       events_raw: Iterable[Dict[str, Any]],
+                       backend: str = 'decimal',
+                       fx_rates=None) -> List[AggregatedEvent]:
+    '''
+    Full timeline of one loan, sorted by event_start_date. Empty if the loan has no events.
+    fx_rates (FxRates.FxRateIndex) fills in conversion rates missing from foreign currency events.
+    '''
+    if backend not in ACCRUAL_BACKENDS:
+        raise ValueError(f"Unknown accrual backend {backend!r}, expected one of {ACCRUAL_BACKENDS}")
+    with stage('parse'):
+        events_list_sorted = build_events(loan, events_raw, fx_rates)
+    if not events_list_sorted:
+        return []
+    with stage('aggregate'):
+        aggregated_events = aggregate_events(loan, events_list_sorted)
+    event_rows_count = len(aggregated_events)
+    with stage('calendar'):
+        capitalization_generated_dates = add_generated_dates(loan, aggregated_events)
+    with stage('accrual'):
+        events_list_date_aggregated_sorted = sorted(aggregated_events.values(), key=lambda e: e.event_start_date)
+        BALANCE_CALCULATORS[backend](loan, events_list_date_aggregated_sorted, capitalization_generated_dates)
+    count('loans')
+    count('events_processed', len(events_list_sorted))
+    count('rows_generated', len(aggregated_events) - event_rows_count)
+    count('timeline_rows', len(aggregated_events))
+    return events_list_date_aggregated_sorted
+
+def calculate_portfolio(loans_raw: Iterable[Dict[str, Any]],
+                        events_raw: Iterable[Dict[str, Any]],
+                        backend: str = 'decimal',
+                        fx_rates=None) -> Dict[Any, List[AggregatedEvent]]:
+    '''
+    Schedules for every loan in one run, keyed by loan_id.
+    Raises ValueError for events referencing an unknown loan.
+    '''
+    loan_mapping = {loan.loan_id: loan for loan in (build_loan(loan_raw) for loan_raw in loans_raw)}
+    events_by_loan = partition_events_by_loan(events_raw)
+    unknown_loan_ids = set(events_by_loan) - set(loan_mapping)
+    if unknown_loan_ids:
+        raise ValueError(f"Loan with ID {sorted(map(str, unknown_loan_ids))[0]} not found.")
+    return {loan_id: calculate_schedule(loan, events_by_loan.get(loan_id, []), backend, fx_rates)
+            for loan_id, loan in loan_mapping.items()}
+
+def schedule_to_columns(schedule: List[AggregatedEvent]) -> Dict[str, list]:
+    """Compact, serializable (dates and floats) column-oriented copy of a schedule."""
+    return {
+        'event_fact_date': [event.event_fact_date.date() for event in schedule],
+        'event_start_date': [event.event_start_date.date() for event in schedule],
+        'event_end_date': [event.event_end_date.date() for event in schedule],
+        'days_count': [event.days_count for event in schedule],
+        'principal_lending': [float(event.principal_lending) for event in schedule],
+        'capitalization': [float(event.capitalization) for event in schedule],
+        'principal_repayment': [float(event.principal_repayment) for event in schedule],
+        'principal_balance': [float(event.principal_balance) for event in schedule],
+        'interest_rate': [float(event.interest_rate) for event in schedule],
+        'interest_rate_base': [event.interest_rate_base for event in schedule],
+        'interest_accrued': [float(event.interest_accrued) for event in schedule],
+        'interest_repayment': [float(event.interest_repayment) for event in schedule],
+        'interest_balance': [float(event.interest_balance) for event in schedule],
+        'event_ids': [list(event.event_ids) for event in schedule],
+    }
+
+def columns_to_simple_object(columns: Dict[str, list]) -> Dict[str, list]:
+    """schedule_to_columns() output with ISO date strings, for simpleObject storage."""
+    stored = dict(columns)
+    for key in SCHEDULE_DATE_COLUMNS:
+        stored[key] = [value.isoformat() for value in columns[key]]
+    return stored
+
+def columns_from_simple_object(stored: Dict[str, list]) -> Dict[str, list]:
+    """Inverse of columns_to_simple_object."""
+    columns = dict(stored)
+    for key in SCHEDULE_DATE_COLUMNS:
+        columns[key] = [date.fromisoformat(value) for value in stored[key]]
+    return columns
+
+def schedule_version_hash(loan_raw: Dict[str, Any], events_raw: Iterable[Dict[str, Any]], fx_rates=None) -> str:
+    '''
+    Hash of everything a schedule depends on: loan terms, raw events and the FX rates filled in from fx_rates.
+    Independent of event order, so it can be compared across fetches.
+    '''
+    def with_filled_rate(event_raw: Dict[str, Any]) -> Dict[str, Any]:
+        currency_ticker = event_raw.get("currency", loan_raw.get('base_currency'))
+        if fx_rates is None or event_raw.get("currency_to_loan_rate") is not None or currency_ticker == loan_raw.get('base_currency') \
+                or loan_raw.get('base_currency') is None:
+            return event_raw
+        return {**event_raw, "currency_to_loan_rate": fx_rates.rate(currency_ticker, loan_raw.get('base_currency'),
+                                                                     event_raw["event_fact_date"])}
+    events = sorted(json.dumps(with_filled_rate(event_raw), sort_keys=True, default=str) for event_raw in events_raw)
+    payload = json.dumps({'loan': loan_raw, 'events': events}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# ==============================
+# 7. Analytical Function: Balance Report
+# ==============================
+def balance_report(data: List[AggregatedEvent], report_date: str) -> float:
+    """Returns the principal balance on a given event_fact_date."""
+    report_date = datetime.strptime(report_date, "%Y-%m-%d")
+
+    if not data or report_date < data[0].event_fact_date:
+        return 0  # Before any recorded events
+
+    previous_balance = 0
+    for event in data:
+        if event.event_start_date == report_date:
+            return float(event.principal_balance)
+        elif event.event_fact_date > report_date:
+            return previous_balance  # Last known balance before the report_date
+        previous_balance = float(event.principal_balance)
+
+    return previous_balance  # Return last balance if report_date is in the future
+
+class ScheduleIndex:
+    '''
+    Sorted date index over a computed schedule for O(log n) as-of queries.
+    Balances are as of the end of the report date; a row's values apply from its event_start_date,
+    and interest of the row containing the report date accrues up to (and including) that date.
+    Built from schedule_to_columns() output so stored schedules can be indexed without recomputing.
+    '''
+    def __init__(self, columns: Dict[str, list]):
+        self.start_ordinals = [start_date.toordinal() for start_date in columns['event_start_date']]
+        self.days_count = columns['days_count']
+        self.principal_balance = columns['principal_balance']
+        self.interest_rate = columns['interest_rate']
+        self.interest_rate_base = columns['interest_rate_base']
+        self.interest_accrued = columns['interest_accrued']
+        self.interest_balance = columns['interest_balance']
+        # accrued_before[i]: interest accrued by all rows before row i
+        self.accrued_before = [0.0]
+        for interest_accrued in self.interest_accrued:
+            self.accrued_before.append(self.accrued_before[-1] + interest_accrued)
+
+    @classmethod
+    def from_schedule(cls, schedule: List[AggregatedEvent]) -> 'ScheduleIndex':
+        return cls(schedule_to_columns(schedule))
+
+    def _row(self, report_ordinal: int) -> int:
+        """Index of the last row starting on or before the report date, -1 if before the first row."""
+        return bisect_right(self.start_ordinals, report_ordinal) - 1
+
+    def _accrued_in_row(self, i: int, report_ordinal: int) -> float:
+        days = report_ordinal - self.start_ordinals[i] + 1
+        if i < len(self.start_ordinals) - 1:
+            days = min(days, self.days_count[i])
+        return self.interest_rate[i] / self.interest_rate_base[i] * days * self.principal_balance[i]
+
+    def as_of(self, report_date: Union[str, date, datetime]) -> Dict[str, float]:
+        """Principal balance, interest balance and interest accrued since the first event, as of report_date."""
+        report_ordinal = to_datetime(report_date).toordinal()
+        i = self._row(report_ordinal)
+        if i < 0:
+            return {'principal': 0.0, 'interest': 0.0, 'accrued': 0.0}
+        accrued_in_row = self._accrued_in_row(i, report_ordinal)
+        return {
+            'principal': self.principal_balance[i],
+            'interest': self.interest_balance[i] - self.interest_accrued[i] + accrued_in_row,
+            'accrued': self.accrued_before[i] + accrued_in_row,
+        }
+
+    def principal(self, report_date: Union[str, date, datetime]) -> float:
+        return self.as_of(report_date)['principal']
+
+    def interest(self, report_date: Union[str, date, datetime]) -> float:
+        return self.as_of(report_date)['interest']
+
+    def accrued(self, report_date: Union[str, date, datetime]) -> float:
+        return self.as_of(report_date)['accrued']
+
+def balance_matrix(indexes: Dict[Any, ScheduleIndex],
+                   loan_ids: List[Any],
+                   report_dates: List[Union[str, date, datetime]]) -> Dict[str, Any]:
+    '''
+    As-of balances for many loans x many report dates.
+    Each of 'principal', 'interest' and 'accrued' is a matrix with one row per loan and one column per date.
+    '''
+    matrix = {'loan_ids': list(loan_ids), 'report_dates': list(report_dates),
+              'principal': [], 'interest': [], 'accrued': []}
+    for loan_id in loan_ids:
+        index = indexes[loan_id]
+        balances = [index.as_of(report_date) for report_date in report_dates]
+        for key in ('principal', 'interest', 'accrued'):
+            matrix[key].append([balance[key] for balance in balances])
+    return matrix
+
+class BalanceSnapshots:
+    '''
+    Compact as-of state of one loan: a snapshot at every MS reporting date add_generated_dates() produces,
+    plus one at every intra-month change point (rows carrying events). Each snapshot holds the balances at
+    the start of its day, the rate in force and interest accrued before it, so a balance on any date is one
+    bisect plus a short accrual top-up from the last snapshot. Same results as ScheduleIndex.as_of.
+    '''
+    def __init__(self, ordinals: List[int], principal: List[float], interest: List[float],
+                 rate: List[float], base: List[int], accrued: List[float]):
+        self.ordinals = ordinals
+        self.principal = principal
+        self.interest = interest
+        self.rate = rate
+        self.base = base
+        self.accrued = accrued
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, list]) -> 'BalanceSnapshots':
+        """Snapshots of a schedule_to_columns() schedule (every row is an MS date or a change point)."""
+        accrued_before = [0.0]
+        for interest_accrued in columns['interest_accrued'][:-1]:
+            accrued_before.append(accrued_before[-1] + interest_accrued)
+        return cls(ordinals=[start_date.toordinal() for start_date in columns['event_start_date']],
+                   principal=list(columns['principal_balance']),
+                   interest=[interest_balance - interest_accrued for interest_balance, interest_accrued
+                             in zip(columns['interest_balance'], columns['interest_accrued'])],
+                   rate=list(columns['interest_rate']),
+                   base=list(columns['interest_rate_base']),
+                   accrued=accrued_before[:len(columns['event_start_date'])])
+
+    def to_simple_object(self) -> Dict[str, list]:
+        return {'ordinals': self.ordinals, 'principal': self.principal, 'interest': self.interest,
+                'rate': self.rate, 'base': self.base, 'accrued': self.accrued}
+
+    @classmethod
+    def from_simple_object(cls, stored: Dict[str, list]) -> 'BalanceSnapshots':
+        return cls(**stored)
+
+    def as_of(self, report_date: Union[str, date, datetime]) -> Dict[str, float]:
+        """Principal balance, interest balance and interest accrued since the first event, as of the end of report_date."""
+        report_ordinal = to_datetime(report_date).toordinal()
+        i = bisect_right(self.ordinals, report_ordinal) - 1
+        if i < 0:
+            return {'principal': 0.0, 'interest': 0.0, 'accrued': 0.0}
+        days = report_ordinal - self.ordinals[i] + 1
+        if i < len(self.ordinals) - 1:
+            days = min(days, self.ordinals[i + 1] - self.ordinals[i])
+        top_up = self.rate[i] / self.base[i] * days * self.principal[i]
+        return {'principal': self.principal[i], 'interest': self.interest[i] + top_up, 'accrued': self.accrued[i] + top_up}
+
+def portfolio_totals(snapshots: Iterable[BalanceSnapshots], report_date: Union[str, date, datetime]) -> Dict[str, float]:
+    """Principal, interest and accrued interest summed over loans as of report_date; O(loans · log n)."""
+    totals = {'principal': 0.0, 'interest': 0.0, 'accrued': 0.0, 'loans': 0}
+    for loan_snapshots in snapshots:
+        balances = loan_snapshots.as_of(report_date)
+        for key in ('principal', 'interest', 'accrued'):
+            totals[key] += balances[key]
+        totals['loans'] += 1
+    return totals
+
+class AccrualSegments:
+    '''
+    Interest accrual as a piecewise-constant daily amount (principal × rate / day-count base) per segment,
+    with prefix sums of the interest accrued before each segment start. Consecutive rows accruing the same
+    daily amount share one segment. Accrued interest over any [from, to) interval is two bisects,
+    without inserting rows into the timeline. The last segment runs on, as in BalanceSnapshots.as_of.
+    '''
+    def __init__(self, ordinals: List[int], daily: List[float], accrued_before: List[float]):
+        self.ordinals = ordinals
+        self.daily = daily
+        self.accrued_before = accrued_before
+
+    @classmethod
+    def from_snapshots(cls, snapshots: BalanceSnapshots) -> 'AccrualSegments':
+        ordinals, daily, accrued_before = [], [], []
+        for i, ordinal in enumerate(snapshots.ordinals):
+            daily_accrual = snapshots.rate[i] / snapshots.base[i] * snapshots.principal[i]
+            if daily and daily[-1] == daily_accrual:
+                continue
+            if ordinals and ordinals[-1] == ordinal:
+                # Several rows starting on one day: only the last one accrues
+                ordinals.pop()
+                daily.pop()
+                accrued_before.pop()
+            ordinals.append(ordinal)
+            daily.append(daily_accrual)
+            accrued_before.append(snapshots.accrued[i])
+        return cls(ordinals, daily, accrued_before)
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, list]) -> 'AccrualSegments':
+        return cls.from_snapshots(BalanceSnapshots.from_columns(columns))
+
+    def to_simple_object(self) -> Dict[str, list]:
+        return {'ordinals': self.ordinals, 'daily': self.daily, 'accrued_before': self.accrued_before}
+
+    @classmethod
+    def from_simple_object(cls, stored: Dict[str, list]) -> 'AccrualSegments':
+        return cls(**stored)
+
+    def accrued_until(self, day_ordinal: int) -> float:
+        """Interest accrued on all days before day_ordinal."""
+        i = bisect_left(self.ordinals, day_ordinal) - 1
+        if i < 0:
+            return 0.0
+        return self.accrued_before[i] + self.daily[i] * (day_ordinal - self.ordinals[i])
+
+    def accrued(self, from_date: Union[str, date, datetime], to_date: Union[str, date, datetime]) -> float:
+        """Interest accrued from from_date (inclusive) to to_date (exclusive)."""
+        from_ordinal = to_datetime(from_date).toordinal()
+        to_ordinal = to_datetime(to_date).toordinal()
+        if to_ordinal < from_ordinal:
+            raise ValueError(f"Interval end {to_date} is before its start {from_date}")
+        return self.accrued_until(to_ordinal) - self.accrued_until(from_ordinal)
+
+    def daily_accrual(self, on_date: Union[str, date, datetime]) -> float:
+        """Interest accruing on on_date."""
+        i = bisect_right(self.ordinals, to_datetime(on_date).toordinal()) - 1
+        return self.daily[i] if i >= 0 else 0.0
+
+# ==============================
+# 8. Incremental schedules
+# ==============================
+class LoanSchedule:
+    '''
+    Schedule of one loan that can be changed event by event.
+    A Checkpoint is kept at every month start (MS row), so inserting, editing or deleting an event
+    recomputes only from the last checkpoint before the affected date: rows before it are reused as they are,
+    and only the tail's events are re-aggregated and only the tail's calendar dates regenerated.
+    Inserting before the first event (or deleting it) moves the timeline start and rebuilds everything.
+    '''
+    def __init__(self, loan: Loan, events_raw: Iterable[Dict[str, Any]] = (), backend: str = 'decimal', fx_rates=None):
+        if backend not in ACCRUAL_BACKENDS:
+            raise ValueError(f"Unknown accrual backend {backend!r}, expected one of {ACCRUAL_BACKENDS}")
+        self.loan = loan
+        self.backend = backend
+        self.fx_rates = fx_rates
+        self.events: List[Event] = build_events(loan, events_raw, fx_rates)
+        self.rows: List[AggregatedEvent] = []
+        self.checkpoints: List[Checkpoint] = []
+        self.range_start: Optional[datetime] = None
+        self.recalculated_rows = 0  # Rows recomputed by the last change
+        self._recalculate_from(None)
+
+    @staticmethod
+    def _event_key(event: Event):
+        return (event.event_start_date, event.event_id)
+
+    # Event changes
+    def insert_event(self, event_raw: Dict[str, Any]) -> None:
+        event = build_event(self.loan, event_raw, self.fx_rates)
+        insort(self.events, event, key=self._event_key)
+        self._recalculate_from(event.event_start_date)
+
+    def delete_event(self, event_id: Any) -> None:
+        removed = self._remove_events(event_id)
+        if not removed:
+            raise KeyError(f"Event ID {event_id} not found.")
+        self._recalculate_from(min(event.event_start_date for event in removed))
+
+    def update_event(self, event_id: Any, event_raw: Dict[str, Any]) -> None:
+        """Replace the event(s) with event_id by event_raw."""
+        removed = self._remove_events(event_id)
+        if not removed:
+            raise KeyError(f"Event ID {event_id} not found.")
+        event = build_event(self.loan, event_raw, self.fx_rates)
+        insort(self.events, event, key=self._event_key)
+        self._recalculate_from(min([event.event_start_date] + [removed_event.event_start_date for removed_event in removed]))
+
+    def apply_changes(self, events_raw: Iterable[Dict[str, Any]] = (), deleted_event_ids: Iterable[Any] = ()) -> None:
+        """Delete events by ID and insert events_raw, recomputing once from the earliest affected date."""
+        affected_dates = []
+        for event_id in deleted_event_ids:
+            removed = self._remove_events(event_id)
+            if not removed:
+                raise KeyError(f"Event ID {event_id} not found.")
+            affected_dates += [event.event_start_date for event in removed]
+        for event_raw in events_raw:
+            event = build_event(self.loan, event_raw, self.fx_rates)
+            insort(self.events, event, key=self._event_key)
+            affected_dates.append(event.event_start_date)
+        if affected_dates:
+            self._recalculate_from(min(affected_dates))
+
+    # Scenarios
+    def fork(self) -> 'LoanSchedule':
+        '''
+        Copy for what-if changes that shares every event, row and checkpoint object with this schedule.
+        Recalculation never modifies rows before its checkpoint, it replaces the tail with new ones,
+        so changing the fork leaves this schedule as it is and the rows before the divergence stay shared.
+        '''
+        forked = copy.copy(self)
+        forked.events = list(self.events)
+        forked.rows = list(self.rows)
+        forked.checkpoints = list(self.checkpoints)
+        forked.recalculated_rows = 0
+        return forked
+
+    def _remove_events(self, event_id: Any) -> List[Event]:
+        removed = [event for event in self.events if event.event_id == event_id]
+        for event in removed:
+            self.events.remove(event)
+        return removed
+
+    # Recalculation
+    def _checkpoint_before(self, affected_date: datetime) -> Optional[Checkpoint]:
+        """Last checkpoint strictly before affected_date."""
+        i = bisect_left(self.checkpoints, affected_date, key=lambda checkpoint: checkpoint.event_start_date) - 1
+        return self.checkpoints[i] if i >= 0 else None
+
+    def _recalculate_from(self, affected_date: Optional[datetime]) -> None:
+        if not self.events:
+            self.rows, self.checkpoints, self.range_start = [], [], None
+            self.recalculated_rows = 0
+            return
+        range_start = self.events[0].event_start_date
+        range_end = self.events[-1].event_start_date + timedelta(days=31)
+        checkpoint = self._checkpoint_before(affected_date) if affected_date is not None else None
+        if checkpoint is not None and (range_start != self.range_start or checkpoint.event_start_date >= range_end):
+            checkpoint = None
+        tail_start = checkpoint.event_start_date if checkpoint else range_start
+        first_event = bisect_left(self.events, tail_start, key=lambda event: event.event_start_date)
+        aggregated_events = aggregate_events(self.loan, self.events[first_event:])
+        capitalization_generated_dates = add_generated_dates(self.loan, aggregated_events, tail_start, range_end)
+        tail = sorted(aggregated_events.values(), key=lambda e: e.event_start_date)
+        BALANCE_CALCULATORS[self.backend](self.loan, tail, capitalization_generated_dates, checkpoint)
+
+        keep = checkpoint.row_index if checkpoint else 0
+        self.rows = self.rows[:keep] + tail
+        self.range_start = range_start
+        self.recalculated_rows = len(tail)
+        self._update_checkpoints(checkpoint)
+
+    def _update_checkpoints(self, checkpoint: Optional[Checkpoint]) -> None:
+        """Replace checkpoints from checkpoint (or all of them) with ones built from the recomputed rows."""
+        keep = checkpoint.row_index if checkpoint else 0
+        self.checkpoints = self.checkpoints[:bisect_left(self.checkpoints, keep, key=lambda c: c.row_index)]
+        for i in range(keep, len(self.rows)):
+            row = self.rows[i]
+            if row.event_start_date.day == 1:
+                previous_row = self.rows[i - 1] if i > 0 else None
+                self.checkpoints.append(Checkpoint(
+                    event_start_date=row.event_start_date,
+                    row_index=i,
+                    principal_balance=previous_row.principal_balance if previous_row else Decimal('0.0'),
+                    interest_balance=previous_row.interest_balance if previous_row else Decimal('0.0'),
+                    interest_rate=previous_row.interest_rate if previous_row else Decimal('0.0')))
+
+# Totals compared by scenario_delta()
+SCENARIO_TOTAL_KEYS = ('principal_lending', 'principal_repayment', 'interest_accrued', 'interest_repayment', 'capitalization')
+
+def _row_as_of(rows: List[AggregatedEvent], on_date: datetime) -> Optional[AggregatedEvent]:
+    i = bisect_right(rows, on_date, key=lambda row: row.event_start_date) - 1
+    return rows[i] if i >= 0 else None
+
+def scenario_delta(baseline: LoanSchedule, scenario: LoanSchedule) -> Dict[str, Any]:
+    '''
+    Differences of a forked scenario against its baseline (scenario minus baseline), as floats:
+    rows shared with the baseline and the date they diverge from, totals of SCENARIO_TOTAL_KEYS,
+    final balances, and principal and interest balances on every row date of either divergent tail.
+    '''
+    shared_rows = 0
+    for baseline_row, scenario_row in zip(baseline.rows, scenario.rows):
+        if baseline_row is not scenario_row:
+            break
+        shared_rows += 1
+    baseline_tail, scenario_tail = baseline.rows[shared_rows:], scenario.rows[shared_rows:]
+    tail_dates = sorted({row.event_start_date for row in baseline_tail} | {row.event_start_date for row in scenario_tail})
+
+    def compared(baseline_value: Decimal, scenario_value: Decimal) -> Dict[str, float]:
+        return {'baseline': float(baseline_value), 'scenario': float(scenario_value),
+                'delta': float(scenario_value - baseline_value)}
+
+    # Shared rows add the same amounts to both totals, so they are summed once
+    totals = {}
+    for key in SCENARIO_TOTAL_KEYS:
+        shared_total = sum((getattr(row, key) for row in baseline.rows[:shared_rows]), Decimal('0.0'))
+        totals[key] = compared(sum((getattr(row, key) for row in baseline_tail), shared_total),
+                               sum((getattr(row, key) for row in scenario_tail), shared_total))
+    balances = []
+    for tail_date in tail_dates:
+        baseline_row, scenario_row = _row_as_of(baseline.rows, tail_date), _row_as_of(scenario.rows, tail_date)
+        balances.append({
+            'date': tail_date.date(),
+            'principal_balance': compared(baseline_row.principal_balance if baseline_row else Decimal('0.0'),
+                                          scenario_row.principal_balance if scenario_row else Decimal('0.0')),
+            'interest_balance': compared(baseline_row.interest_balance if baseline_row else Decimal('0.0'),
+                                         scenario_row.interest_balance if scenario_row else Decimal('0.0')),
+        })
+    last_baseline_row = baseline.rows[-1] if baseline.rows else None
+    last_scenario_row = scenario.rows[-1] if scenario.rows else None
+    return {
+        'shared_rows': shared_rows,
+        'recalculated_rows': scenario.recalculated_rows,
+        'diverges_from': tail_dates[0].date() if tail_dates else None,
+        'totals': totals,
+        'final_principal_balance': compared(last_baseline_row.principal_balance if last_baseline_row else Decimal('0.0'),
+                                            last_scenario_row.principal_balance if last_scenario_row else Decimal('0.0')),
+        'final_interest_balance': compared(last_baseline_row.interest_balance if last_baseline_row else Decimal('0.0'),
+                                           last_scenario_row.interest_balance if last_scenario_row else Decimal('0.0')),
+        'balances': balances,
+    }
@@ -0,0 +1,212 @@
+'''
+Equivalence checks of the Timeline engine and its fast paths on small fixtures.
+Run from the app root: python -m pytest -q tests
+Timings live in benchmarks/Benchmarks.py; these only check that every path computes the same schedule.
+'''
+
+import csv
+import os
+import pickle
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from server_code.Timeline import (calculate_portfolio, calculate_schedule, build_loan, build_events, schedule_to_columns,
+                                  schedule_version_hash, LoanSchedule, ScheduleIndex, BalanceSnapshots, AccrualSegments,
+                                  portfolio_totals, scenario_delta)
+from server_code.EventBatch import EventBatch, calculate_batch, calculate_portfolio_batch
+from server_code.FxRates import FxRateIndex, LazyFxRateIndex
+from server_code.ParallelPortfolio import calculate_portfolio_columns
+from server_code.ChartData import loan_chart_payload, portfolio_chart_payload
+from server_code.EventImport import parse_records, import_records
+from server_code.EventStream import interest_rate_event, lending_event, repayment_event, fetch_event_streams
+from server_code.Instrumentation import INSTRUMENTATION
+from benchmarks import SampleData
+from benchmarks.Benchmarks import synthetic_portfolio, synthetic_import_csv, synthetic_event_tables
+
+FX_FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fixtures', 'fx_rates.csv')
+# Schedule columns compared between accrual paths, to the cent
+COMPARED_COLUMNS = ('principal_balance', 'capitalization', 'interest_accrued', 'interest_balance')
+CENT = 0.005
+
+PORTFOLIOS = {
+    'sample': (SampleData.loans_list_raw, SampleData.events_list_raw),
+    'synthetic': synthetic_portfolio(5, 80),
+    # EventBatch rounds converted amounts to cents while parsing, so it is compared without conversions
+    'synthetic_base_currency': synthetic_portfolio(5, 80, foreign_currency_share=0.0),
+}
+
+
+def fixture_fx_rows():
+    with open(FX_FIXTURE_PATH, newline='') as file:
+        return list(csv.DictReader(file))
+
+def long_loan_events(events_count=300, years=10, seed=7):
+    rnd = random.Random(seed)
+    start_date = date(2010, 1, 1)
+    events_raw = [{"event_id": 0, "event_fact_date": start_date, "principal_lending_currency": 1000000, "loan_id": 1},
+                  {"event_id": -1, "event_fact_date": start_date, "interest_rate": 0.05, "loan_id": 1}]
+    events_raw += [{"event_id": i + 1, "event_fact_date": start_date + timedelta(days=rnd.randrange(1, years * 365)),
+                    "principal_repayment_currency": rnd.randrange(10, 200), "loan_id": 1} for i in range(events_count)]
+    return events_raw
+
+LONG_LOAN = build_loan({'loan_id': 1, 'base_currency': 'USD', 'interest_rate_base': 'calendar', 'capitalization': True})
+
+
+@pytest.mark.parametrize('portfolio', PORTFOLIOS)
+def test_numpy_backend_matches_decimal_to_the_cent(portfolio):
+    loans_raw, events_raw = PORTFOLIOS[portfolio]
+    numpy_schedules = calculate_portfolio(loans_raw, events_raw, backend='numpy')
+    for loan_id, decimal_schedule in calculate_portfolio(loans_raw, events_raw, backend='decimal').items():
+        numpy_schedule = numpy_schedules[loan_id]
+        assert [row.days_count for row in decimal_schedule] == [row.days_count for row in numpy_schedule]
+        for decimal_row, numpy_row in zip(decimal_schedule, numpy_schedule):
+            for column in COMPARED_COLUMNS:
+                assert abs(float(getattr(decimal_row, column)) - float(getattr(numpy_row, column))) < CENT
+
+def test_numpy_backend_keeps_decimal_rates():
+    schedule = calculate_portfolio(SampleData.loans_list_raw, SampleData.events_list_raw, backend='numpy')[101]
+    assert str(schedule[0].interest_rate) == '0.06'
+
+@pytest.mark.parametrize('portfolio', ('sample', 'synthetic_base_currency'))
+def test_event_batch_matches_decimal(portfolio):
+    loans_raw, events_raw = PORTFOLIOS[portfolio]
+    schedule_batch = calculate_batch(EventBatch.from_raw(loans_raw, events_raw))
+    batch_columns = schedule_batch.to_columns()
+    for loan_id, schedule in calculate_portfolio(loans_raw, events_raw).items():
+        expected = schedule_to_columns(schedule)
+        columns = schedule_batch.loan_columns(loan_id)
+        assert batch_columns[loan_id] == columns
+        for column in ('event_fact_date', 'event_start_date', 'event_end_date', 'days_count', 'event_ids'):
+            assert expected[column] == columns[column]
+        for column in COMPARED_COLUMNS:
+            for expected_value, value in zip(expected[column], columns[column]):
+                assert abs(expected_value - value) < CENT
+
+def test_incremental_changes_equal_a_rebuild():
+    events_raw = long_loan_events()
+    schedule = LoanSchedule(LONG_LOAN, events_raw)
+    last_date = max(event_raw["event_fact_date"] for event_raw in events_raw)
+    for new_event_id, days_back in enumerate((20, 365, 3000), start=1000):
+        new_event_raw = {"event_id": new_event_id, "event_fact_date": last_date - timedelta(days=days_back),
+                         "principal_repayment_currency": 100, "loan_id": 1}
+        schedule.insert_event(new_event_raw)
+        events_raw.append(new_event_raw)
+        assert schedule.recalculated_rows < len(schedule.rows)
+        assert schedule_to_columns(schedule.rows) == schedule_to_columns(LoanSchedule(LONG_LOAN, events_raw).rows)
+    schedule.delete_event(1000)
+    events_raw = [event_raw for event_raw in events_raw if event_raw["event_id"] != 1000]
+    assert schedule_to_columns(schedule.rows) == schedule_to_columns(LoanSchedule(LONG_LOAN, events_raw).rows)
+
+def test_parallel_equals_serial_and_merges_worker_stages():
+    loans_raw, events_raw = synthetic_portfolio(12, 40)
+    serial = calculate_portfolio_columns(loans_raw, events_raw, 1)
+    INSTRUMENTATION.reset()
+    assert calculate_portfolio_columns(loans_raw, events_raw, 2) == serial
+    assert INSTRUMENTATION.counters['loans'] == len(loans_raw)
+
+def test_scenario_forks_equal_a_rebuild_and_leave_the_baseline():
+    events_raw = long_loan_events()
+    baseline = LoanSchedule(LONG_LOAN, events_raw)
+    baseline_columns = schedule_to_columns(baseline.rows)
+    last_date = max(event_raw["event_fact_date"] for event_raw in events_raw)
+    for i, days_back in enumerate((40, 400)):
+        event_raw = {'event_id': 10 ** 9 + i, 'loan_id': 1, 'event_fact_date': last_date - timedelta(days=days_back)}
+        event_raw['interest_rate' if i % 2 else 'principal_repayment_currency'] = 0.13 if i % 2 else 50000
+        scenario = baseline.fork()
+        scenario.apply_changes([event_raw])
+        report = scenario_delta(baseline, scenario)
+        rebuilt = LoanSchedule(LONG_LOAN, events_raw + [event_raw])
+        assert schedule_to_columns(scenario.rows) == schedule_to_columns(rebuilt.rows)
+        assert report['final_principal_balance']['scenario'] == float(rebuilt.rows[-1].principal_balance)
+        assert report['shared_rows'] > 0
+    assert schedule_to_columns(baseline.rows) == baseline_columns
+
+def test_fx_fill_matches_manually_entered_rates():
+    rnd = random.Random(5)
+    fx_rates = FxRateIndex.from_csv(FX_FIXTURE_PATH)
+    loan = build_loan({'loan_id': 1, 'base_currency': 'USD', 'interest_rate_base': 365})
+    events_raw = [{"event_id": i, "event_fact_date": date(2022, 1, 3) + timedelta(days=rnd.randrange(4 * 365 - 3)),
+                   "principal_lending_currency": rnd.randrange(100, 5000), "currency": rnd.choice(('EUR', 'GBP', 'JPY')),
+                   "loan_id": 1} for i in range(200)]
+    manual = build_events(loan, [{**event_raw, "currency_to_loan_rate": fx_rates.rate(event_raw["currency"], 'USD', event_raw["event_fact_date"])}
+                                 for event_raw in events_raw])
+    assert [event.principal_lending for event in build_events(loan, events_raw, fx_rates)] == \
+           [event.principal_lending for event in manual]
+
+def test_lazy_fx_rates_load_only_for_missing_rates():
+    fx_rates = LazyFxRateIndex(lambda: fixture_fx_rows())
+    loan_raw = {'loan_id': 1, 'base_currency': 'USD'}
+    events_raw = [{"event_id": 1, "event_fact_date": date(2024, 1, 3), "principal_lending_currency": 100, "loan_id": 1},
+                  {"event_id": 2, "event_fact_date": date(2024, 1, 3), "principal_lending_currency": 100, "currency": 'EUR',
+                   "currency_to_loan_rate": 1.1, "loan_id": 1}]
+    schedule_version_hash(loan_raw, events_raw, fx_rates)
+    calculate_schedule(build_loan(loan_raw), events_raw, fx_rates=fx_rates)
+    assert not fx_rates.loaded
+
+def test_foreign_event_without_loan_currency_raises_value_error():
+    loan_raw = {'loan_id': 1, 'base_currency': None}
+    events_raw = [{"event_id": 1, "event_fact_date": date(2024, 1, 3), "principal_lending_currency": 100, "currency": 'EUR',
+                   "loan_id": 1}]
+    for fx_rates in (None, FxRateIndex.from_csv(FX_FIXTURE_PATH)):
+        schedule_version_hash(loan_raw, events_raw, fx_rates)
+        with pytest.raises(ValueError):
+            calculate_schedule(build_loan(loan_raw), events_raw, fx_rates=fx_rates)
+        with pytest.raises(ValueError):
+            calculate_portfolio_batch([loan_raw], events_raw, fx_rates=fx_rates)
+
+def test_event_import_resolves_loans_once():
+    content = synthetic_import_csv(5, 40)
+    loans = {loan_raw['loan_id']: object() for loan_raw in synthetic_portfolio(5, 0)[0]}
+    resolve_calls, written = [], []
+    def resolve_loans(loan_ids):
+        resolve_calls.append(len(loan_ids))
+        return {loan_id: loans[loan_id] for loan_id in loan_ids if loan_id in loans}
+    import_result = import_records(parse_records(content, 'csv'), resolve_loans,
+                                   lambda event_type, events: written.append(len(events)), 50)
+    assert len(resolve_calls) == 1
+    assert import_result.rows_imported == sum(written)
+    assert import_result.rows_imported + len(import_result.errors) == import_result.rows_total
+
+def test_concurrent_fetch_returns_the_sequential_events():
+    tables = synthetic_event_tables(5, 40)
+    readers = [lambda: [interest_rate_event(item, item['loan_id']) for item in tables['interest_rates']],
+               lambda: [lending_event(item, item['loan_id']) for item in tables['principal_lendings']],
+               lambda: [repayment_event(item, item['loan_id']) for item in tables['repayments']]]
+    assert fetch_event_streams(readers, 3) == fetch_event_streams(readers, 1)
+
+def test_stored_snapshots_and_segments_match_schedule_index():
+    loans_raw, events_raw = synthetic_portfolio(8, 60)
+    columns_list = [schedule_to_columns(schedule) for schedule in calculate_portfolio(loans_raw, events_raw).values()]
+    indexes = [ScheduleIndex(columns) for columns in columns_list]
+    snapshots = [BalanceSnapshots.from_simple_object(BalanceSnapshots.from_columns(columns).to_simple_object())
+                 for columns in columns_list]
+    for report_date in (date(2016, 1, 15) + timedelta(days=200 * i) for i in range(10)):
+        expected = sum(index.as_of(report_date)['principal'] for index in indexes)
+        assert abs(expected - portfolio_totals(snapshots, report_date)['principal']) < CENT
+    rnd = random.Random(1)
+    for columns, index in zip(columns_list, indexes):
+        segments = AccrualSegments.from_simple_object(AccrualSegments.from_columns(columns).to_simple_object())
+        for _ in range(20):
+            from_date = date(2015, 1, 1) + timedelta(days=rnd.randrange(4000))
+            to_date = from_date + timedelta(days=rnd.randrange(1, 62))
+            expected = index.accrued(to_date - timedelta(days=1)) - index.accrued(from_date - timedelta(days=1))
+            assert abs(expected - segments.accrued(from_date, to_date)) < 1e-6 * max(1.0, abs(expected))
+
+def test_chart_payloads_keep_every_repayment():
+    loans_raw, events_raw = synthetic_portfolio(6, 200, seed=2)
+    columns_list = [schedule_to_columns(schedule) for schedule in calculate_portfolio(loans_raw, events_raw).values()]
+    for build in (lambda points: loan_chart_payload(columns_list[0], points),
+                  lambda points: portfolio_chart_payload(columns_list, points)):
+        payload = build(100)
+        full_payload = build(payload['source_points'])
+        repayment_dates = set(payload['repayments']['x'])
+        assert repayment_dates == set(full_payload['repayments']['x'])
+        if len(repayment_dates) <= 50:
+            assert repayment_dates <= set(payload['series']['principal_balance']['x'])
+
+def test_lazy_fx_rates_pickle_as_the_loaded_index():
+    fx_rates = pickle.loads(pickle.dumps(LazyFxRateIndex(lambda: fixture_fx_rows())))
+    assert fx_rates.loaded
+    assert fx_rates.rate('EUR', 'USD', date(2024, 1, 3)) == FxRateIndex.from_csv(FX_FIXTURE_PATH).rate('EUR', 'USD', date(2024, 1, 3))